@@ -2,6 +2,14 @@ import hashlib
 from assets.credential import Credentials
 import os
 import binascii
+import struct
+from micropython import const
+from log import log_debug
+
+# Log credential hashes in development builds. Compiled out when 0.
+_TRACE = const(0)
+
+_SESSION_ID_MASK = const(0x3FFFFFFF)
 
 
 class AndroidDevice:
@@ -19,6 +27,8 @@ class AndroidDevice:
         self._password = password
         self._ip_address = ip_address
         self._token = token
+        self._protocol_version = 0
+        self._session_id = None
 
     @property
     def username(self):
@@ -60,6 +70,44 @@ class AndroidDevice:
         """
         return self._token
 
+    @property
+    def protocol_version(self):
+        """
+        Get the binary command protocol version negotiated for this device.
+
+        Returns:
+            int: The protocol version, or 0 if only JSON commands are used.
+        """
+        return self._protocol_version
+
+    @property
+    def session_id(self):
+        """
+        Get the session id that binary commands must carry.
+
+        Returns:
+            int or None: The session id if a binary protocol was negotiated, None otherwise.
+        """
+        return self._session_id
+
+    def open_session(self, version):
+        """
+        Start a binary protocol session with a new random session id.
+
+        Parameters:
+        version (int): The negotiated protocol version. 0 closes the binary session.
+
+        Returns:
+            int or None: The new session id, or None if version is 0.
+        """
+        self._protocol_version = version
+        self._session_id = None
+        if version:
+            # 30 bits, so the id is a small int on the board and checking it allocates
+            # nothing (see command_protocol.Command).
+            self._session_id = struct.unpack("<I", os.urandom(4))[0] & _SESSION_ID_MASK
+        return self._session_id
+
     @staticmethod
     def __generate_random_token():
         """
@@ -98,7 +146,8 @@ class AndroidDevice:
         hash_user_hex = binascii.hexlify(hash_user.digest()).decode("utf-8")
         hash_pass_hex = binascii.hexlify(hash_pass.digest()).decode("utf-8")
 
-        print(hash_user_hex, hash_pass_hex)
+        if _TRACE:
+            log_debug("Credential hashes:", hash_user_hex, hash_pass_hex)
         if hash_user_hex == Credentials.get(
             "username"
         ) and hash_pass_hex == Credentials.get("password"):
@@ -0,0 +1,123 @@
+"""
+Adaptive advertising schedule.
+
+A phone finds the device quickly only if it advertises often, but every advertising event
+costs radio time and battery. After boot, and whenever a device disconnects (when the app
+is most likely to reconnect), the device advertises at a fast interval for a limited
+window, then falls back to a slow interval until a central connects.
+"""
+
+from micropython import const
+import aioble
+import asyncio
+import time
+from log import log_info
+
+PHASE_IDLE = const(0)
+PHASE_FAST = const(1)
+PHASE_SLOW = const(2)
+
+PHASE_NAMES = ("idle", "fast", "slow")
+
+
+class AdvertisingSchedule:
+    """
+    Advertises at a fast interval for a window after boot or a disconnect, then slowly.
+    """
+
+    def __init__(self, adv_data, resp_data, fast_interval_us, slow_interval_us, fast_window_ms):
+        """
+        Initialize an AdvertisingSchedule instance, starting the fast window.
+
+        Args:
+            adv_data (bytes): The advertising data.
+            resp_data (bytes): The scan response data.
+            fast_interval_us (int): The advertising interval during the fast window.
+            slow_interval_us (int): The advertising interval after the fast window.
+            fast_window_ms (int): How long to advertise at the fast interval.
+        """
+        self._adv_data = adv_data
+        self._resp_data = resp_data
+        self._fast_interval_us = fast_interval_us
+        self._slow_interval_us = slow_interval_us
+        self._fast_window_ms = fast_window_ms
+        self._fast_until = time.ticks_add(time.ticks_ms(), fast_window_ms)
+        self._task = None
+        self._restarting = False
+        # The phase advertising is in, the number of connections made in each phase, and
+        # how long advertising had been going on when the last central connected.
+        self.phase = PHASE_IDLE
+        self.connects = [0, 0, 0]
+        self.last_connect_ms = None
+
+    def restart_fast(self):
+        """
+        Start a new fast window, e.g. after a disconnect.
+
+        If the device is advertising slowly, it switches to the fast interval at once.
+        """
+        self._fast_until = time.ticks_add(time.ticks_ms(), self._fast_window_ms)
+        if self._task is not None and self.phase == PHASE_SLOW:
+            self._restarting = True
+            self._task.cancel()
+
+    async def advertise(self):
+        """
+        Advertise until a central connects.
+
+        Returns:
+            DeviceConnection: The connection.
+
+        Raises:
+            asyncio.CancelledError: If cancelled, after advertising has stopped.
+        """
+        started = time.ticks_ms()
+        while True:
+            remaining = time.ticks_diff(self._fast_until, time.ticks_ms())
+            if remaining > 0:
+                self.phase = PHASE_FAST
+                interval_us = self._fast_interval_us
+            else:
+                self.phase = PHASE_SLOW
+                interval_us = self._slow_interval_us
+                remaining = None
+            self._task = asyncio.create_task(
+                aioble.advertise(
+                    interval_us,
+                    adv_data=self._adv_data,
+                    resp_data=self._resp_data,
+                    timeout_ms=remaining,
+                )
+            )
+            try:
+                connection = await self._task
+            except asyncio.TimeoutError:
+                log_info("Fast advertising window over")
+                continue
+            except asyncio.CancelledError:
+                if self._restarting:
+                    # restart_fast() cancelled the advertising task before it started.
+                    self._restarting = False
+                    continue
+                self._task.cancel()
+                self.phase = PHASE_IDLE
+                raise
+            finally:
+                self._task = None
+
+            if connection is None:
+                if not self._restarting:
+                    # This task was cancelled, and the cancellation was passed on to the
+                    # advertising task, which stopped advertising.
+                    self.phase = PHASE_IDLE
+                    raise asyncio.CancelledError
+                # Advertising was stopped by restart_fast().
+                self._restarting = False
+                continue
+            self.last_connect_ms = time.ticks_diff(time.ticks_ms(), started)
+            self.connects[self.phase] += 1
+            log_info(
+                "Connected after", self.last_connect_ms, "ms,", PHASE_NAMES[self.phase], "phase"
+            )
+            self.phase = PHASE_IDLE
+            return connection
@@ -6,26 +6,36 @@ from micropython import const
 from .device import Device, DeviceDisconnectedError
 from .core import log_info, log_warn, log_error, GattError, config, stop
 
-try:
-    from .peripheral import advertise
-except:
-    log_info("Peripheral support disabled")
+# The role modules are only imported on first use, so a peripheral never
+# pays for (or registers the IRQ handlers of) the central, client or L2CAP
+# code. A role whose module was left out of the build raises ImportError
+# when used.
+_attrs = {
+    "advertise": "peripheral",
+    "advertising_payload": "peripheral",
+    "scan": "central",
+    "Service": "server",
+    "Characteristic": "server",
+    "BufferedCharacteristic": "server",
+    "Descriptor": "server",
+    "register_services": "server",
+    "services_hash": "server",
+    "L2CAPChannel": "l2cap",
+    "L2CAPDisconnectedError": "l2cap",
+    "L2CAPConnectionError": "l2cap",
+}
 
-try:
-    from .central import scan
-except:
-    log_info("Central support disabled")
 
-try:
-    from .server import (
-        Service,
-        Characteristic,
-        BufferedCharacteristic,
-        Descriptor,
-        register_services,
-    )
-except:
-    log_info("GATT server support disabled")
+# Lazy loader, effectively does:
+#   global attr
+#   from .mod import attr
+def __getattr__(attr):
+    mod = _attrs.get(attr, None)
+    if mod is None:
+        raise AttributeError(attr)
+    value = getattr(__import__(mod, globals(), None, (attr,), 1), attr)
+    globals()[attr] = value
+    return value
 
 
 ADDR_PUBLIC = const(0)
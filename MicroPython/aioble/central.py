@@ -43,6 +43,8 @@ _ADV_TYPE_UUID128_COMPLETE = const(0x7)
 _ADV_TYPE_APPEARANCE = const(0x19)
 _ADV_TYPE_MANUFACTURER = const(0xFF)
 
+_SCAN_QUEUE_LEN = const(32)
+
 
 # Keep track of the active scanner so IRQs can be delivered to it.
 _active_scanner = None
@@ -58,8 +60,7 @@ def _central_irq(event, data):
         addr_type, addr, adv_type, rssi, adv_data = data
         if not _active_scanner:
             return
-        _active_scanner._queue.append((addr_type, bytes(addr), adv_type, rssi, bytes(adv_data)))
-        _active_scanner._event.set()
+        _active_scanner._irq_result(addr_type, addr, adv_type, rssi, adv_data)
     elif event == _IRQ_SCAN_DONE:
         if not _active_scanner:
             return
@@ -93,7 +94,11 @@ def _central_shutdown():
     _connecting = set()
 
 
-register_irq_handler(_central_irq, _central_shutdown)
+register_irq_handler(
+    _central_irq,
+    _central_shutdown,
+    (_IRQ_SCAN_RESULT, _IRQ_SCAN_DONE, _IRQ_PERIPHERAL_CONNECT, _IRQ_PERIPHERAL_DISCONNECT),
+)
 
 
 # Cancel an in-progress scan.
@@ -104,7 +109,9 @@ async def _cancel_pending():
 
 # Start connecting to a peripheral.
 # Call device.connect() rather than using method directly.
-async def _connect(connection, timeout_ms):
+async def _connect(
+    connection, timeout_ms, scan_duration_ms, min_conn_interval_us, max_conn_interval_us
+):
     device = connection.device
     if device in _connecting:
         return
@@ -122,7 +129,13 @@ async def _connect(connection, timeout_ms):
 
     try:
         with DeviceTimeout(None, timeout_ms):
-            ble.gap_connect(device.addr_type, device.addr)
+            ble.gap_connect(
+                device.addr_type,
+                device.addr,
+                scan_duration_ms,
+                min_conn_interval_us,
+                max_conn_interval_us,
+            )
 
             # Wait for the connected IRQ.
             await connection._event.wait()
@@ -135,9 +148,18 @@ async def _connect(connection, timeout_ms):
         _connecting.remove(device)
 
 
+# Marks a ScanResult field that hasn't been decoded since the payload changed.
+_UNDECODED = object()
+
+
 # Represents a single device that has been found during a scan. The scan
 # iterator will return the same ScanResult instance multiple times as its data
 # changes (i.e. changing RSSI or advertising data).
+#
+# The payloads are parsed once, on the first query after they change, into the
+# offsets of their fields. The name, services and manufacturer data are then
+# decoded from those on first use and kept, so code that checks the same
+# results over and over (e.g. by name and service) doesn't parse them again.
 class ScanResult:
     def __init__(self, device):
         self.device = device
@@ -145,6 +167,15 @@ class ScanResult:
         self.resp_data = None
         self.rssi = None
         self.connectable = False
+        self._invalidate()
+
+    def _invalidate(self):
+        # (type, 0 for adv_data or 1 for resp_data, start, end) of every
+        # field, flattened, or None if not parsed yet.
+        self._fields = None
+        self._name = _UNDECODED
+        self._services = None
+        self._manufacturer = None
 
     # New scan result available, return true if it changes our state.
     def _update(self, adv_type, rssi, adv_data):
@@ -158,14 +189,18 @@ class ScanResult:
             if adv_data != self.adv_data:
                 self.adv_data = adv_data
                 self.connectable = adv_type == _ADV_IND
+                self._invalidate()
                 updated = True
         elif adv_type == _ADV_SCAN_IND:
-            if adv_data != self.adv_data and self.resp_data:
-                updated = True
-            self.adv_data = adv_data
+            if adv_data != self.adv_data:
+                if self.resp_data:
+                    updated = True
+                self.adv_data = adv_data
+                self._invalidate()
         elif adv_type == _SCAN_RSP and adv_data:
             if adv_data != self.resp_data:
                 self.resp_data = adv_data
+                self._invalidate()
                 updated = True
 
         return updated
@@ -173,59 +208,146 @@ class ScanResult:
     def __str__(self):
         return "Scan result: {} {}".format(self.device, self.rssi)
 
-    # Gets all the fields for the specified types.
-    def _decode_field(self, *adv_type):
+    def _parse(self):
         # Advertising payloads are repeated packets of the following form:
         #   1 byte data length (N + 1)
         #   1 byte type (see constants below)
         #   N bytes type-specific data
-        for payload in (self.adv_data, self.resp_data):
+        fields = []
+        for p, payload in ((0, self.adv_data), (1, self.resp_data)):
             if not payload:
                 continue
             i = 0
             while i + 1 < len(payload):
-                if payload[i + 1] in adv_type:
-                    yield payload[i + 2 : i + payload[i] + 1]
+                end = min(i + payload[i] + 1, len(payload))
+                fields.extend((payload[i + 1], p, i + 2, end))
                 i += 1 + payload[i]
+        self._fields = fields
+
+    # Gets all the fields for the specified types.
+    def _decode_field(self, *adv_type):
+        if self._fields is None:
+            self._parse()
+        fields = self._fields
+        for i in range(0, len(fields), 4):
+            if fields[i] in adv_type:
+                payload = self.resp_data if fields[i + 1] else self.adv_data
+                yield payload[fields[i + 2] : fields[i + 3]]
 
     # Returns the value of the complete (or shortened) advertised name, if available.
     def name(self):
-        for n in self._decode_field(_ADV_TYPE_NAME, _ADV_TYPE_SHORT_NAME):
-            return str(n, "utf-8") if n else ""
+        if self._name is _UNDECODED:
+            name = None
+            for n in self._decode_field(_ADV_TYPE_NAME, _ADV_TYPE_SHORT_NAME):
+                name = str(n, "utf-8") if n else ""
+                break
+            self._name = name
+        return self._name
 
-    # Generator that enumerates the service UUIDs that are advertised.
+    # Iterator that enumerates the service UUIDs that are advertised.
     def services(self):
-        for uuid_len, codes in (
-            (2, (_ADV_TYPE_UUID16_INCOMPLETE, _ADV_TYPE_UUID16_COMPLETE)),
-            (4, (_ADV_TYPE_UUID32_INCOMPLETE, _ADV_TYPE_UUID32_COMPLETE)),
-            (16, (_ADV_TYPE_UUID128_INCOMPLETE, _ADV_TYPE_UUID128_COMPLETE)),
-        ):
-            for u in self._decode_field(*codes):
-                for i in range(0, len(u), uuid_len):
-                    yield bluetooth.UUID(u[i : i + uuid_len])
+        if self._services is None:
+            services = []
+            for uuid_len, codes in (
+                (2, (_ADV_TYPE_UUID16_INCOMPLETE, _ADV_TYPE_UUID16_COMPLETE)),
+                (4, (_ADV_TYPE_UUID32_INCOMPLETE, _ADV_TYPE_UUID32_COMPLETE)),
+                (16, (_ADV_TYPE_UUID128_INCOMPLETE, _ADV_TYPE_UUID128_COMPLETE)),
+            ):
+                for u in self._decode_field(*codes):
+                    for i in range(0, len(u), uuid_len):
+                        services.append(bluetooth.UUID(u[i : i + uuid_len]))
+            self._services = tuple(services)
+        return iter(self._services)
 
     # Generator that returns (manufacturer_id, data) tuples.
     def manufacturer(self, filter=None):
-        for u in self._decode_field(_ADV_TYPE_MANUFACTURER):
-            if len(u) < 2:
-                continue
-            m = struct.unpack("<H", u[0:2])[0]
-            if filter is None or m == filter:
-                yield (m, u[2:])
+        if self._manufacturer is None:
+            manufacturer = []
+            for u in self._decode_field(_ADV_TYPE_MANUFACTURER):
+                if len(u) < 2:
+                    continue
+                manufacturer.append((struct.unpack("<H", u[0:2])[0], u[2:]))
+            self._manufacturer = tuple(manufacturer)
+        for m in self._manufacturer:
+            if filter is None or m[0] == filter:
+                yield m
+
+
+# Returns true if the advertising payload has a field of one of the given
+# types whose value contains needle at a multiple of step (i.e. one of the
+# UUIDs in a UUID list), or starts with it if step is 0. Compares byte by
+# byte, so filtering out a packet in the IRQ allocates nothing.
+def _has_field(payload, types, needle, step):
+    n = len(needle)
+    i = 0
+    while i + 1 < len(payload):
+        end = min(i + 1 + payload[i], len(payload))
+        if payload[i + 1] in types:
+            j = i + 2
+            while j + n <= end:
+                k = 0
+                while k < n and payload[j + k] == needle[k]:
+                    k += 1
+                if k == n:
+                    return True
+                if not step:
+                    break
+                j += step
+        i = end
+    return False
+
+
+_UUID_TYPES = {
+    2: (_ADV_TYPE_UUID16_INCOMPLETE, _ADV_TYPE_UUID16_COMPLETE),
+    4: (_ADV_TYPE_UUID32_INCOMPLETE, _ADV_TYPE_UUID32_COMPLETE),
+    16: (_ADV_TYPE_UUID128_INCOMPLETE, _ADV_TYPE_UUID128_COMPLETE),
+}
+_NAME_TYPES = (_ADV_TYPE_NAME, _ADV_TYPE_SHORT_NAME)
 
 
 # Use with:
 # async with aioble.scan(...) as scanner:
 #   async for result in scanner:
 #     ...
+#
+# With services (a list of bluetooth.UUID) and/or name_prefix, only devices
+# that advertise one of the services or a name starting with the prefix are
+# reported. Other advertisements are dropped in the IRQ, before anything is
+# allocated for them.
 class scan:
-    def __init__(self, duration_ms, interval_us=None, window_us=None, active=False):
-        self._queue = []
+    def __init__(
+        self,
+        duration_ms,
+        interval_us=None,
+        window_us=None,
+        active=False,
+        services=None,
+        name_prefix=None,
+        queue_len=_SCAN_QUEUE_LEN,
+    ):
+        # Raw results from the IRQ, as ((addr_type, addr), adv_type, rssi,
+        # adv_data), in a ring that overwrites the oldest one when full.
+        self._queue = [None] * queue_len
+        self._queue_head = 0
+        self._queue_count = 0
         self._event = asyncio.ThreadSafeFlag()
         self._done = False
 
-        # Keep track of what we've already seen.
-        self._results = set()
+        # Keep track of what we've already seen, by (addr_type, addr).
+        self._results = {}
+
+        self._services = tuple(bytes(u) for u in services) if services else ()
+        if isinstance(name_prefix, str):
+            name_prefix = name_prefix.encode()
+        self._name_prefix = name_prefix
+        # Devices whose advertising matched the filter, so that their scan
+        # responses (which often carry just the name) are let through too.
+        self._matched = set()
+
+        # Results discarded because the queue was full, and advertisements
+        # dropped by the filter.
+        self.dropped = 0
+        self.filtered = 0
 
         # Ideally we'd start the scan here and avoid having to save these
         # values, but we need to stop any previous scan first via awaiting
@@ -253,6 +375,39 @@ class scan:
         assert _active_scanner == self
         return self
 
+    def _matches(self, adv_data):
+        for uuid in self._services:
+            if _has_field(adv_data, _UUID_TYPES.get(len(uuid), ()), uuid, len(uuid)):
+                return True
+        return self._name_prefix is not None and _has_field(
+            adv_data, _NAME_TYPES, self._name_prefix, 0
+        )
+
+    # Called from the IRQ. addr and adv_data are only valid during the call.
+    def _irq_result(self, addr_type, addr, adv_type, rssi, adv_data):
+        if self._services or self._name_prefix is not None:
+            if self._matches(adv_data):
+                if adv_type != _SCAN_RSP:
+                    self._matched.add((addr_type, bytes(addr)))
+            elif adv_type != _SCAN_RSP or (addr_type, bytes(addr)) not in self._matched:
+                self.filtered += 1
+                return
+
+        size = len(self._queue)
+        n = self._queue_count
+        if n == size:
+            self.dropped += 1
+            self._queue_head = (self._queue_head + 1) % size
+            n -= 1
+        self._queue[(self._queue_head + n) % size] = (
+            (addr_type, bytes(addr)),
+            adv_type,
+            rssi,
+            bytes(adv_data),
+        )
+        self._queue_count = n + 1
+        self._event.set()
+
     async def __anext__(self):
         global _active_scanner
 
@@ -261,19 +416,18 @@ class scan:
             raise StopAsyncIteration
 
         while True:
-            while self._queue:
-                addr_type, addr, adv_type, rssi, adv_data = self._queue.pop()
-
-                # Try to find an existing ScanResult for this device.
-                for r in self._results:
-                    if r.device.addr_type == addr_type and r.device.addr == addr:
-                        result = r
-                        break
-                else:
+            while self._queue_count:
+                head = self._queue_head
+                key, adv_type, rssi, adv_data = self._queue[head]
+                self._queue[head] = None
+                self._queue_head = (head + 1) % len(self._queue)
+                self._queue_count -= 1
+
+                result = self._results.get(key)
+                if result is None:
                     # New device, create a new Device & ScanResult.
-                    device = Device(addr_type, addr)
-                    result = ScanResult(device)
-                    self._results.add(result)
+                    result = ScanResult(Device(*key))
+                    self._results[key] = result
 
                 # Add the new information from this event.
                 if result._update(adv_type, rssi, adv_data):
@@ -79,7 +79,23 @@ def _client_irq(event, data):
         ClientCharacteristic._on_indicate(conn_handle, value_handle, bytes(indicate_data))
 
 
-register_irq_handler(_client_irq, None)
+register_irq_handler(
+    _client_irq,
+    None,
+    (
+        _IRQ_GATTC_SERVICE_RESULT,
+        _IRQ_GATTC_SERVICE_DONE,
+        _IRQ_GATTC_CHARACTERISTIC_RESULT,
+        _IRQ_GATTC_CHARACTERISTIC_DONE,
+        _IRQ_GATTC_DESCRIPTOR_RESULT,
+        _IRQ_GATTC_DESCRIPTOR_DONE,
+        _IRQ_GATTC_READ_RESULT,
+        _IRQ_GATTC_READ_DONE,
+        _IRQ_GATTC_WRITE_DONE,
+        _IRQ_GATTC_NOTIFY,
+        _IRQ_GATTC_INDICATE,
+    ),
+)
 
 
 # Async generator for discovering services, characteristics, descriptors.
@@ -154,6 +170,27 @@ class ClientDiscover:
                 discover._event.set()
 
 
+# Async generator over the results of an earlier discovery, bound to a
+# connection from a discovery cache (see gatt_cache.py). Used in place of
+# ClientDiscover, so iterating them costs no round trips.
+class CachedDiscover:
+    def __init__(self, items, uuid=None):
+        self._items = items
+        self._uuid = uuid
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self._index < len(self._items):
+            item = self._items[self._index]
+            self._index += 1
+            if self._uuid is None or item.uuid == self._uuid:
+                return item
+        raise StopAsyncIteration
+
+
 # Represents a single service supported by a connection. Do not construct this
 # class directly, instead use `async for service in connection.services([uuid])` or
 # `await connection.service(uuid)`.
@@ -168,6 +205,9 @@ class ClientService:
         # Allows comparison to a known uuid.
         self.uuid = uuid
 
+        # Characteristics bound from a discovery cache, if any.
+        self._cached = None
+
     def __str__(self):
         return "Service: {} {} {}".format(self._start_handle, self._end_handle, self.uuid)
 
@@ -186,6 +226,8 @@ class ClientService:
     #     async for characteristic in service.characteristics():
     # Note: must allow the loop to run to completion.
     def characteristics(self, uuid=None, timeout_ms=2000):
+        if self._cached is not None:
+            return CachedDiscover(self._cached, uuid)
         return ClientDiscover(self.connection, ClientCharacteristic, self, timeout_ms, uuid)
 
     # For ClientDiscover
@@ -316,6 +358,9 @@ class ClientCharacteristic(BaseClientCharacteristic):
 
         super().__init__(value_handle, properties, uuid)
 
+        # Descriptors bound from a discovery cache, if any.
+        self._cached = None
+
         if properties & _FLAG_NOTIFY:
             # Fired when a notification arrives.
             self._notify_event = asyncio.ThreadSafeFlag()
@@ -349,6 +394,8 @@ class ClientCharacteristic(BaseClientCharacteristic):
     #     async for descriptor in characteristic.descriptors():
     # Note: must allow the loop to run to completion.
     def descriptors(self, timeout_ms=2000):
+        if self._cached is not None:
+            return CachedDiscover(self._cached)
         return ClientDiscover(self.connection, ClientDescriptor, self, timeout_ms)
 
     # For ClientDiscover
@@ -1,11 +1,16 @@
 # MicroPython aioble module
 # MIT license; Copyright (c) 2021 Jim Mussared
 
+from micropython import const
 import bluetooth
 
 
 log_level = 1
 
+# Set to 1 to log every IRQ at log level 3. The check is folded at compile time, so
+# when 0 the IRQ path pays nothing for it.
+_LOG_IRQS = const(0)
+
 
 def log_error(*args):
     if log_level > 0:
@@ -46,13 +51,24 @@ def config(*args, **kwargs):
 # Because different functionality is enabled by which files are available the
 # different modules can register their IRQ handlers and shutdown handlers
 # dynamically.
-_irq_handlers = []
 _shutdown_handlers = []
 
+# Event code -> tuple of the handlers that take it, in registration order, so an
+# IRQ only reaches the modules that handle it however many roles are loaded.
+_irq_table = {}
+# Handlers registered without a list of events, which get every event.
+_irq_fallback = []
+
 
-def register_irq_handler(irq, shutdown):
+def register_irq_handler(irq, shutdown, events=None):
     if irq:
-        _irq_handlers.append(irq)
+        if events is None:
+            _irq_fallback.append(irq)
+            for event in _irq_table:
+                _irq_table[event] += (irq,)
+        else:
+            for event in events:
+                _irq_table[event] = _irq_table.get(event, tuple(_irq_fallback)) + (irq,)
     if shutdown:
         _shutdown_handlers.append(shutdown)
 
@@ -65,14 +81,17 @@ def stop():
 
 # Dispatch IRQs to the registered sub-modules.
 def ble_irq(event, data):
-    log_info(event, data)
+    if _LOG_IRQS:
+        log_info(event, data)
 
-    for handler in _irq_handlers:
+    for handler in _irq_table.get(event, _irq_fallback):
         result = handler(event, data)
         if result is not None:
             return result
 
 
-# TODO: Allow this to be injected.
+# The backend is whatever `bluetooth.BLE()` returns. It can be injected by
+# providing an alternative `bluetooth` module before aioble is imported (e.g.
+# the simulated radio installed by sim.install() for host-side testing).
 ble = bluetooth.BLE()
 ble.irq(ble_irq)
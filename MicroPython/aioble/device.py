@@ -26,7 +26,7 @@ def _device_irq(event, data):
                 device._mtu_event.set()
 
 
-register_irq_handler(_device_irq, None)
+register_irq_handler(_device_irq, None, (_IRQ_MTU_EXCHANGED,))
 
 
 # Context manager to allow an operation to be cancelled by timeout or device
@@ -132,14 +132,26 @@ class Device:
     def addr_hex(self):
         return binascii.hexlify(self.addr, ":").decode()
 
-    async def connect(self, timeout_ms=10000):
+    async def connect(
+        self,
+        timeout_ms=10000,
+        scan_duration_ms=None,
+        min_conn_interval_us=None,
+        max_conn_interval_us=None,
+    ):
         if self._connection:
             return self._connection
 
         # Forward to implementation in central.py.
         from .central import _connect
 
-        await _connect(DeviceConnection(self), timeout_ms)
+        await _connect(
+            DeviceConnection(self),
+            timeout_ms,
+            scan_duration_ms,
+            min_conn_interval_us,
+            max_conn_interval_us,
+        )
 
         # Start the device task that will clean up after disconnection.
         self._connection._run_task()
@@ -176,6 +188,9 @@ class DeviceConnection:
         # conn_handle,value_handle can route to them). See
         # ClientCharacteristic._find for where this is used.
         self._characteristics = {}
+        # Services bound from a discovery cache (see gatt_cache.py), which
+        # services() then returns instead of discovering them.
+        self._cached = None
 
         self._task = None
 
@@ -243,8 +258,10 @@ class DeviceConnection:
     # Note: must allow the loop to run to completion.
     # TODO: disconnection / timeout
     def services(self, uuid=None, timeout_ms=2000):
-        from .client import ClientDiscover, ClientService
+        from .client import ClientDiscover, ClientService, CachedDiscover
 
+        if self._cached is not None:
+            return CachedDiscover(self._cached, uuid)
         return ClientDiscover(self, ClientService, self, timeout_ms, uuid)
 
     async def pair(self, *args, **kwargs):
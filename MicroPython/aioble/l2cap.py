@@ -21,14 +21,6 @@ _listening = False
 
 
 def _l2cap_irq(event, data):
-    if event not in (
-        _IRQ_L2CAP_CONNECT,
-        _IRQ_L2CAP_DISCONNECT,
-        _IRQ_L2CAP_RECV,
-        _IRQ_L2CAP_SEND_READY,
-    ):
-        return
-
     # All the L2CAP events start with (conn_handle, cid, ...)
     if connection := DeviceConnection._connected.get(data[0], None):
         if channel := connection._l2cap_channel:
@@ -59,7 +51,11 @@ def _l2cap_shutdown():
     _listening = False
 
 
-register_irq_handler(_l2cap_irq, _l2cap_shutdown)
+register_irq_handler(
+    _l2cap_irq,
+    _l2cap_shutdown,
+    (_IRQ_L2CAP_CONNECT, _IRQ_L2CAP_DISCONNECT, _IRQ_L2CAP_RECV, _IRQ_L2CAP_SEND_READY),
+)
 
 
 # The channel was disconnected during a send/recvinto/flush.
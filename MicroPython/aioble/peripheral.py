@@ -24,6 +24,7 @@ _IRQ_CENTRAL_DISCONNECT = const(2)
 
 
 _ADV_TYPE_FLAGS = const(0x01)
+_ADV_TYPE_SHORT_NAME = const(0x08)
 _ADV_TYPE_NAME = const(0x09)
 _ADV_TYPE_UUID16_COMPLETE = const(0x3)
 _ADV_TYPE_UUID32_COMPLETE = const(0x5)
@@ -36,10 +37,19 @@ _ADV_TYPE_MANUFACTURER = const(0xFF)
 
 _ADV_PAYLOAD_MAX_LEN = const(31)
 
+_PAYLOAD_CACHE_LIMIT = const(4)
+
 
 _incoming_connection = None
 _connect_event = None
 
+# Payloads built from advertise() kwargs, by configuration.
+_payload_cache = {}
+
+# The (adv_data, resp_data) last given to the controller, which keeps using
+# them until it is given new ones.
+_current_payload = None
+
 
 def _peripheral_irq(event, data):
     global _incoming_connection
@@ -64,33 +74,100 @@ def _peripheral_irq(event, data):
 
 
 def _peripheral_shutdown():
-    global _incoming_connection, _connect_event
+    global _incoming_connection, _connect_event, _current_payload
     _incoming_connection = None
     _connect_event = None
+    _current_payload = None
 
 
-register_irq_handler(_peripheral_irq, _peripheral_shutdown)
+register_irq_handler(
+    _peripheral_irq, _peripheral_shutdown, (_IRQ_CENTRAL_CONNECT, _IRQ_CENTRAL_DISCONNECT)
+)
 
 
 # Advertising payloads are repeated packets of the following form:
 #   1 byte data length (N + 1)
 #   1 byte type (see constants below)
 #   N bytes type-specific data
-def _append(adv_data, resp_data, adv_type, value):
-    data = struct.pack("BB", len(value) + 1, adv_type) + value
-
-    if len(data) + len(adv_data) < _ADV_PAYLOAD_MAX_LEN:
-        adv_data += data
-        return resp_data
+def _field(adv_type, value):
+    return struct.pack("BB", len(value) + 1, adv_type) + value
 
-    if len(data) + (len(resp_data) if resp_data else 0) < _ADV_PAYLOAD_MAX_LEN:
-        if not resp_data:
-            # Overflow into resp_data for the first time.
-            resp_data = bytearray()
-        resp_data += data
-        return resp_data
 
-    raise ValueError("Advertising payload too long")
+# Build the (adv_data, resp_data) for a configuration, packing the fields
+# into the two 31-byte payloads.
+def advertising_payload(
+    limited_disc=False,
+    br_edr=False,
+    name=None,
+    services=None,
+    appearance=0,
+    manufacturer=None,
+):
+    # The flags must be in the advertising data. Services are prioritised to
+    # go there too because iOS supports filtering scan results by service
+    # only, so they are placed first.
+    adv_data = _field(
+        _ADV_TYPE_FLAGS,
+        struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
+    )
+    resp_data = b""
+
+    fields = []
+    if services:
+        for uuid_len, code in (
+            (2, _ADV_TYPE_UUID16_COMPLETE),
+            (4, _ADV_TYPE_UUID32_COMPLETE),
+            (16, _ADV_TYPE_UUID128_COMPLETE),
+        ):
+            if uuids := [bytes(uuid) for uuid in services if len(bytes(uuid)) == uuid_len]:
+                fields.append(_field(code, b"".join(uuids)))
+    for field in fields:
+        if len(adv_data) + len(field) <= _ADV_PAYLOAD_MAX_LEN:
+            adv_data += field
+        elif len(resp_data) + len(field) <= _ADV_PAYLOAD_MAX_LEN:
+            resp_data += field
+        else:
+            raise ValueError("Advertising payload too long")
+
+    # Place the other fields largest first, each in the payload it fills
+    # best (the one with the least space that still holds it).
+    fields = []
+    if appearance:
+        # See org.bluetooth.characteristic.gap.appearance.xml
+        fields.append(_field(_ADV_TYPE_APPEARANCE, struct.pack("<H", appearance)))
+    if manufacturer:
+        fields.append(
+            _field(_ADV_TYPE_MANUFACTURER, struct.pack("<H", manufacturer[0]) + manufacturer[1])
+        )
+    if name:
+        if isinstance(name, str):
+            name = name.encode()
+        fields.append(_field(_ADV_TYPE_NAME, name))
+    fields.sort(key=len, reverse=True)
+    for field in fields:
+        adv_space = _ADV_PAYLOAD_MAX_LEN - len(adv_data)
+        resp_space = _ADV_PAYLOAD_MAX_LEN - len(resp_data)
+        if len(field) <= min(adv_space, resp_space):
+            if adv_space <= resp_space:
+                adv_data += field
+            else:
+                resp_data += field
+        elif len(field) <= adv_space:
+            adv_data += field
+        elif len(field) <= resp_space:
+            resp_data += field
+        elif field[1] == _ADV_TYPE_NAME and max(adv_space, resp_space) > 2:
+            # Send as much of the name as fits, as a shortened name.
+            space = max(adv_space, resp_space)
+            field = _field(_ADV_TYPE_SHORT_NAME, name[: space - 2])
+            if adv_space >= resp_space:
+                adv_data += field
+            else:
+                resp_data += field
+        else:
+            raise ValueError("Advertising payload too long")
+
+    return adv_data, resp_data
 
 
 async def advertise(
@@ -106,56 +183,45 @@ async def advertise(
     manufacturer=None,
     timeout_ms=None,
 ):
-    global _incoming_connection, _connect_event
+    global _incoming_connection, _connect_event, _current_payload
 
     ensure_active()
 
     if not adv_data and not resp_data:
         # If the user didn't manually specify adv_data / resp_data then
-        # construct them from the kwargs. Keep adding fields to adv_data,
-        # overflowing to resp_data if necessary.
-        # TODO: Try and do better bin-packing than just concatenating in
-        # order?
-
-        adv_data = bytearray()
-
-        resp_data = _append(
-            adv_data,
-            resp_data,
-            _ADV_TYPE_FLAGS,
-            struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
+        # construct them from the kwargs, once per configuration.
+        key = (
+            limited_disc,
+            br_edr,
+            name,
+            tuple(bytes(uuid) for uuid in services) if services else None,
+            appearance,
+            manufacturer and (manufacturer[0], bytes(manufacturer[1])),
         )
-
-        # Services are prioritised to go in the advertising data because iOS supports
-        # filtering scan results by service only, so services must come first.
-        if services:
-            for uuid_len, code in (
-                (2, _ADV_TYPE_UUID16_COMPLETE),
-                (4, _ADV_TYPE_UUID32_COMPLETE),
-                (16, _ADV_TYPE_UUID128_COMPLETE),
-            ):
-                if uuids := [bytes(uuid) for uuid in services if len(bytes(uuid)) == uuid_len]:
-                    resp_data = _append(adv_data, resp_data, code, b"".join(uuids))
-
-        if name:
-            resp_data = _append(adv_data, resp_data, _ADV_TYPE_NAME, name)
-
-        if appearance:
-            # See org.bluetooth.characteristic.gap.appearance.xml
-            resp_data = _append(
-                adv_data, resp_data, _ADV_TYPE_APPEARANCE, struct.pack("<H", appearance)
-            )
-
-        if manufacturer:
-            resp_data = _append(
-                adv_data,
-                resp_data,
-                _ADV_TYPE_MANUFACTURER,
-                struct.pack("<H", manufacturer[0]) + manufacturer[1],
+        payload = _payload_cache.get(key)
+        if payload is None:
+            payload = advertising_payload(
+                limited_disc, br_edr, name, services, appearance, manufacturer
             )
+            if len(_payload_cache) >= _PAYLOAD_CACHE_LIMIT:
+                _payload_cache.clear()
+            _payload_cache[key] = payload
+        adv_data, resp_data = payload
 
     _connect_event = _connect_event or asyncio.ThreadSafeFlag()
-    ble.gap_advertise(interval_us, adv_data=adv_data, resp_data=resp_data, connectable=connectable)
+    if (
+        _current_payload
+        and adv_data is _current_payload[0]
+        and resp_data is _current_payload[1]
+        and isinstance(adv_data, bytes)
+    ):
+        # The controller still has this (immutable) payload; don't copy it again.
+        ble.gap_advertise(interval_us, connectable=connectable)
+    else:
+        ble.gap_advertise(
+            interval_us, adv_data=adv_data, resp_data=resp_data, connectable=connectable
+        )
+        _current_payload = (adv_data, resp_data)
 
     try:
         # Allow optional timeout for a central to connect to us (or just to stop advertising).
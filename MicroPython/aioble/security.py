@@ -156,7 +156,11 @@ def _security_shutdown():
     _path = None
 
 
-register_irq_handler(_security_irq, _security_shutdown)
+register_irq_handler(
+    _security_irq,
+    _security_shutdown,
+    (_IRQ_ENCRYPTION_UPDATE, _IRQ_GET_SECRET, _IRQ_SET_SECRET, _IRQ_PASSKEY_ACTION),
+)
 
 
 # Use device.pair() rather than calling this directly.
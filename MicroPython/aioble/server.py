@@ -2,9 +2,10 @@
 # MIT license; Copyright (c) 2021 Jim Mussared
 
 from micropython import const
-from collections import deque
 import bluetooth
 import asyncio
+import hashlib
+import struct
 
 from .core import (
     ensure_active,
@@ -19,6 +20,10 @@ from .device import DeviceConnection, DeviceTimeout
 
 _registered_characteristics = {}
 
+# Identifies the layout of the registered services, see services_hash().
+_services_hash = None
+
+_IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_GATTS_WRITE = const(3)
 _IRQ_GATTS_READ_REQUEST = const(4)
 _IRQ_GATTS_INDICATE_DONE = const(20)
@@ -41,6 +46,14 @@ _FLAG_WRITE_CAPTURE = const(0x10000)
 
 _WRITE_CAPTURE_QUEUE_LIMIT = const(10)
 
+# ATT allows a single unconfirmed indication per connection, so indications
+# to a connection (on any characteristic) wait their turn in a FIFO, while
+# indications to different connections are in flight concurrently.
+# conn_handle -> list of _Indication, the head is the one sent.
+_indications = {}
+
+_INDICATE_QUEUE_LIMIT = const(10)
+
 
 def _server_irq(event, data):
     if event == _IRQ_GATTS_WRITE:
@@ -52,20 +65,22 @@ def _server_irq(event, data):
     elif event == _IRQ_GATTS_INDICATE_DONE:
         conn_handle, value_handle, status = data
         Characteristic._indicate_done(conn_handle, value_handle, status)
+    elif event == _IRQ_CENTRAL_CONNECT:
+        BufferedCharacteristic._flush_batches()
 
 
 def _server_shutdown():
-    global _registered_characteristics
+    global _registered_characteristics, _indications, _services_hash
     _registered_characteristics = {}
-    if hasattr(BaseCharacteristic, "_capture_task"):
-        BaseCharacteristic._capture_task.cancel()
-        del BaseCharacteristic._capture_queue
-        del BaseCharacteristic._capture_write_event
-        del BaseCharacteristic._capture_consumed_event
-        del BaseCharacteristic._capture_task
+    _indications = {}
+    _services_hash = None
 
 
-register_irq_handler(_server_irq, _server_shutdown)
+register_irq_handler(
+    _server_irq,
+    _server_shutdown,
+    (_IRQ_GATTS_WRITE, _IRQ_GATTS_READ_REQUEST, _IRQ_GATTS_INDICATE_DONE, _IRQ_CENTRAL_CONNECT),
+)
 
 
 class Service:
@@ -100,41 +115,22 @@ class BaseCharacteristic:
         else:
             ble.gatts_write(self._value_handle, data, send_update)
 
-    # When the a capture-enabled characteristic is created, create the
-    # necessary events (if not already created).
-    @staticmethod
-    def _init_capture():
-        if hasattr(BaseCharacteristic, "_capture_queue"):
-            return
-
-        BaseCharacteristic._capture_queue = deque((), _WRITE_CAPTURE_QUEUE_LIMIT)
-        BaseCharacteristic._capture_write_event = asyncio.ThreadSafeFlag()
-        BaseCharacteristic._capture_consumed_event = asyncio.ThreadSafeFlag()
-        BaseCharacteristic._capture_task = asyncio.create_task(
-            BaseCharacteristic._run_capture_task()
-        )
-
-    # Monitor the shared queue for incoming characteristic writes and forward
-    # them sequentially to the individual characteristic events.
-    @staticmethod
-    async def _run_capture_task():
-        write = BaseCharacteristic._capture_write_event
-        consumed = BaseCharacteristic._capture_consumed_event
-        q = BaseCharacteristic._capture_queue
-
-        while True:
-            if len(q):
-                conn, data, characteristic = q.popleft()
-                # Let the characteristic waiting in `written()` know that it
-                # can proceed.
-                characteristic._write_data = (conn, data)
-                characteristic._write_event.set()
-                # Wait for the characteristic to complete `written()` before
-                # continuing.
-                await consumed.wait()
-
-            if not len(q):
-                await write.wait()
+    # When a capture-enabled characteristic is created, give it its own
+    # bounded queue of writes, so that a slow consumer of one characteristic
+    # never holds up delivery to another. The queue is a preallocated ring of
+    # connections and values, so queueing a write in the IRQ allocates nothing.
+    def _init_capture(self, queue_len):
+        self._capture_connections = [None] * queue_len
+        self._capture_values = [None] * queue_len
+        self._capture_head = 0
+        self._capture_count = 0
+        self._capture_queue_len = queue_len
+        # Number of writes discarded because the queue was full (the oldest
+        # queued write is dropped), and the largest queue length seen.
+        self.capture_dropped = 0
+        self.capture_peak = 0
+        # The connection that made the write last returned by receive().
+        self.writer = None
 
     # Wait for a write on this characteristic. Returns the connection that did
     # the write, or a tuple of (connection, value) if capture is enabled for
@@ -144,31 +140,78 @@ class BaseCharacteristic:
             # Not a writable characteristic.
             return
 
+        if self.flags & _FLAG_WRITE_CAPTURE:
+            value = await self.receive(timeout_ms)
+            return self.writer, value
+
         # If no write has been seen then we need to wait. If the event has
         # already been set this will clear the event and continue
-        # immediately. In regular mode, this is set by the write IRQ
-        # directly (in _remote_write). In capture mode, this is set when it's
-        # our turn by _capture_task.
+        # immediately. The event is set by the write IRQ (in _remote_write).
         with DeviceTimeout(None, timeout_ms):
             await self._write_event.wait()
 
-        # Return the write data and clear the stored copy.
-        # In default usage this will be just the connection handle.
-        # In capture mode this will be a tuple of (connection_handle, received_data)
+        # Return the connection of the write and clear the stored copy.
         data = self._write_data
         self._write_data = None
+        return data
 
-        if self.flags & _FLAG_WRITE_CAPTURE:
-            # Notify the shared queue monitor that the event has been consumed
-            # by the caller to `written()` and another characteristic can now
-            # proceed.
-            BaseCharacteristic._capture_consumed_event.set()
+    # Like written() with capture enabled, but only returns the value (the
+    # connection that wrote it is left in self.writer), so a consumer that
+    # handles every write doesn't allocate a tuple for each one.
+    async def receive(self, timeout_ms=None):
+        if not (self.flags & _FLAG_WRITE_CAPTURE):
+            raise ValueError("Not supported")
 
-        return data
+        # The event is set by the write IRQ whenever it queues a value. It may
+        # still be set from writes that were already consumed, so re-check the
+        # queue after every wakeup.
+        with DeviceTimeout(None, timeout_ms):
+            while not self._capture_count:
+                await self._write_event.wait()
+        return self._pop_write()
+
+    # Take the oldest captured write, leaving its connection in self.writer.
+    def _pop_write(self):
+        head = self._capture_head
+        self.writer = self._capture_connections[head]
+        value = self._capture_values[head]
+        self._capture_connections[head] = None
+        self._capture_values[head] = None
+        self._capture_head = (head + 1) % self._capture_queue_len
+        self._capture_count -= 1
+        return value
+
+    # Iterate over captured writes as they arrive, e.g.
+    #     async for connection, value in characteristic.writes():
+    def writes(self, timeout_ms=None):
+        if not (self.flags & _FLAG_WRITE_CAPTURE):
+            raise ValueError("Not supported")
+        return _CaptureIterator(self, timeout_ms)
 
     def on_read(self, connection):
         return 0
 
+    # For capture, we append the connection and the written value to this
+    # characteristic's queue.
+    def _capture_write(self, conn):
+        self._queue_write(conn, self.read())
+
+    # When the queue is full the oldest entry is overwritten, which we count.
+    def _queue_write(self, conn, value):
+        n = self._capture_count
+        size = self._capture_queue_len
+        if n == size:
+            self.capture_dropped += 1
+            self._capture_head = (self._capture_head + 1) % size
+            n -= 1
+        elif n + 1 > self.capture_peak:
+            self.capture_peak = n + 1
+        tail = (self._capture_head + n) % size
+        self._capture_connections[tail] = conn
+        self._capture_values[tail] = value
+        self._capture_count = n + 1
+        self._write_event.set()
+
     def _remote_write(conn_handle, value_handle):
         if characteristic := _registered_characteristics.get(value_handle, None):
             # If we've gone from empty to one item, then wake something
@@ -177,12 +220,7 @@ class BaseCharacteristic:
             conn = DeviceConnection._connected.get(conn_handle, None)
 
             if characteristic.flags & _FLAG_WRITE_CAPTURE:
-                # For capture, we append the connection and the written value
-                # value to the shared queue along with the matching characteristic object.
-                # The deque will enforce the max queue len.
-                data = characteristic.read()
-                BaseCharacteristic._capture_queue.append((conn, data, characteristic))
-                BaseCharacteristic._capture_write_event.set()
+                characteristic._capture_write(conn)
             else:
                 # Store the write connection handle to be later used to retrieve the data
                 # then set event to handle in written() task.
@@ -206,6 +244,7 @@ class Characteristic(BaseCharacteristic):
         indicate=False,
         initial=None,
         capture=False,
+        capture_queue_len=_WRITE_CAPTURE_QUEUE_LIMIT,
     ):
         service.characteristics.append(self)
         self.descriptors = []
@@ -222,22 +261,17 @@ class Characteristic(BaseCharacteristic):
                 # their values (and connection) in a queue. Otherwise we just
                 # track the connection of the most recent write.
                 flags |= _FLAG_WRITE_CAPTURE
-                BaseCharacteristic._init_capture()
+                self._init_capture(capture_queue_len)
 
-            # Set when this characteristic has a value waiting in self._write_data.
+            # Set when this characteristic has a value waiting in
+            # self._write_data, or a write was added to the capture queue.
             self._write_event = asyncio.ThreadSafeFlag()
-            # The connection of the most recent write, or a tuple of
-            # (connection, data) if capture is enabled.
+            # The connection of the most recent write (when not capturing).
             self._write_data = None
         if notify:
             flags |= _FLAG_NOTIFY
         if indicate:
             flags |= _FLAG_INDICATE
-            # TODO: This should probably be a dict of connection to (ev, status).
-            # Right now we just support a single indication at a time.
-            self._indicate_connection = None
-            self._indicate_event = asyncio.ThreadSafeFlag()
-            self._indicate_status = None
 
         self.uuid = uuid
         self.flags = flags
@@ -257,36 +291,73 @@ class Characteristic(BaseCharacteristic):
             raise ValueError("Not supported")
         ble.gatts_notify(connection._conn_handle, self._value_handle, data)
 
+    # Send an indication and wait for the central to confirm it. If another
+    # indication to the same connection is outstanding, this one is queued
+    # behind it; the timeout covers the time spent queued.
     async def indicate(self, connection, data=None, timeout_ms=1000):
         if not (self.flags & _FLAG_INDICATE):
             raise ValueError("Not supported")
-        if self._indicate_connection is not None:
-            raise ValueError("In progress")
         if not connection.is_connected():
             raise ValueError("Not connected")
 
-        self._indicate_connection = connection
-        self._indicate_status = None
+        conn_handle = connection._conn_handle
+        queue = _indications.get(conn_handle)
+        if queue is None:
+            queue = []
+            _indications[conn_handle] = queue
+        elif len(queue) >= _INDICATE_QUEUE_LIMIT:
+            raise ValueError("In progress")
+        indication = _Indication(self._value_handle)
+        queue.append(indication)
 
         try:
             with connection.timeout(timeout_ms):
-                ble.gatts_indicate(connection._conn_handle, self._value_handle, data)
-                await self._indicate_event.wait()
-                if self._indicate_status != 0:
-                    raise GattError(self._indicate_status)
+                while queue[0] is not indication:
+                    await indication.event.wait()
+                indication.sent = True
+                ble.gatts_indicate(conn_handle, self._value_handle, data)
+                while indication.status is None:
+                    await indication.event.wait()
+                if indication.status != 0:
+                    raise GattError(indication.status)
         finally:
-            self._indicate_connection = None
+            head = queue[0] is indication
+            queue.remove(indication)
+            if not queue:
+                if _indications.get(conn_handle) is queue:
+                    del _indications[conn_handle]
+            elif head:
+                queue[0].event.set()
 
     def _indicate_done(conn_handle, value_handle, status):
-        if characteristic := _registered_characteristics.get(value_handle, None):
-            if connection := DeviceConnection._connected.get(conn_handle, None):
-                if not characteristic._indicate_connection:
-                    # Timeout.
-                    return
-                # See TODO in __init__ to support multiple concurrent indications.
-                assert connection == characteristic._indicate_connection
-                characteristic._indicate_status = status
-                characteristic._indicate_event.set()
+        if queue := _indications.get(conn_handle, None):
+            indication = queue[0]
+            if indication.sent and indication.value_handle == value_handle:
+                indication.status = status
+                indication.event.set()
+            # Otherwise the indication timed out and was removed.
+
+
+# An indication waiting to be sent or confirmed.
+class _Indication:
+    def __init__(self, value_handle):
+        self.value_handle = value_handle
+        self.sent = False
+        self.status = None
+        self.event = asyncio.ThreadSafeFlag()
+
+
+# Async iterator returned by BaseCharacteristic.writes().
+class _CaptureIterator:
+    def __init__(self, characteristic, timeout_ms):
+        self._characteristic = characteristic
+        self._timeout_ms = timeout_ms
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._characteristic.written(self._timeout_ms)
 
 
 class BufferedCharacteristic(Characteristic):
@@ -294,11 +365,61 @@ class BufferedCharacteristic(Characteristic):
         super().__init__(*args, **kwargs)
         self._max_len = max_len
         self._append = append
+        # In append mode with capture, the connection whose writes are
+        # accumulating in the buffer without having been read yet.
+        self._batch_connection = None
 
     def _register(self, value_handle):
         super()._register(value_handle)
         ble.gatts_set_buffer(value_handle, self._max_len, self._append)
 
+    # In append mode the stack concatenates writes in the buffer, so rather
+    # than reading every write in the IRQ, let them accumulate and have
+    # written() read them all at once. Appended writes from different
+    # connections can't be told apart though, so while more than one central
+    # is connected each write is read as it arrives.
+    def _capture_write(self, conn):
+        if not self._append:
+            super()._capture_write(conn)
+        elif len(DeviceConnection._connected) > 1:
+            self._flush_batch()
+            self._queue_write(conn, self.read())
+        else:
+            self._batch_connection = conn
+            self._write_event.set()
+
+    # Move writes accumulated in the buffer to the capture queue.
+    def _flush_batch(self):
+        if conn := self._batch_connection:
+            self._batch_connection = None
+            if data := self.read():
+                self._queue_write(conn, data)
+
+    # Called when a central connects, while the buffer can only hold writes
+    # from the connection(s) that were already there.
+    def _flush_batches():
+        for characteristic in _registered_characteristics.values():
+            if isinstance(characteristic, BufferedCharacteristic):
+                characteristic._flush_batch()
+
+    # Like Characteristic.receive(), but in append mode the returned value is
+    # everything written since the previous call, which may be several writes.
+    async def receive(self, timeout_ms=None):
+        if not (self._append and self.flags & _FLAG_WRITE_CAPTURE):
+            return await super().receive(timeout_ms)
+
+        with DeviceTimeout(None, timeout_ms):
+            while True:
+                if self._capture_count:
+                    return self._pop_write()
+                if conn := self._batch_connection:
+                    self._batch_connection = None
+                    # May be empty if the IRQ flushed the batch meanwhile.
+                    if data := self.read():
+                        self.writer = conn
+                        return data
+                await self._write_event.wait()
+
 
 class Descriptor(BaseCharacteristic):
     def __init__(self, characteristic, uuid, read=False, write=False, initial=None):
@@ -338,3 +459,22 @@ def register_services(*services):
             for descriptor in characteristic.descriptors:
                 descriptor._register(service_handles[n])
                 n += 1
+
+    global _services_hash
+    h = hashlib.sha256()
+    for service in services:
+        h.update(bytes(service.uuid))
+        for characteristic in service.characteristics:
+            for attr in [characteristic] + characteristic.descriptors:
+                h.update(bytes(attr.uuid))
+                h.update(struct.pack("<IH", attr.flags, attr._value_handle))
+    _services_hash = h.digest()[:4]
+
+
+# A short hash of the UUIDs, flags and handles of the registered services,
+# which changes whenever the GATT table does (e.g. after a firmware update).
+# A peripheral can advertise it so that a client that cached the table (see
+# gatt_cache.py) knows whether the cached handles are still valid without
+# discovering them again.
+def services_hash():
+    return _services_hash
@@ -7,8 +7,8 @@ UUIDs are used to identify services and characteristics in a BLE network.
 Each UUID is a 128-bit value that uniquely identifies a service or characteristic.
 
 This module defines UUIDs for an authentication service and a run service.
-The authentication service includes UUIDs for username, password, token, and response.
-The run service includes UUIDs for command and response.
+The authentication service includes UUIDs for username, password, token, response, and resume.
+The run service includes UUIDs for command, response and diagnostics.
 """
 
 # UUID for Authentication Service
@@ -17,8 +17,10 @@ AUTH_USERNAME = bluetooth.UUID(0x1011)  # Characteristic UUID for Username
 AUTH_PASSWORD = bluetooth.UUID(0x1012)  # Characteristic UUID for Password
 AUTH_TOKEN = bluetooth.UUID(0x1013)  # Characteristic UUID for Authentication Token
 AUTH_RESPONSE = bluetooth.UUID(0x1014)  # Characteristic UUID for Authentication Response
+AUTH_RESUME = bluetooth.UUID(0x1015)  # Characteristic UUID for Session Resumption Ticket
 
 # UUID for Run Service
 RUN_SERVICE = bluetooth.UUID(0x1020)  # Service UUID for Running Commands
 RUN_COMMAND = bluetooth.UUID(0x1021)  # Characteristic UUID for Command to Run
 RUN_RESPONSE = bluetooth.UUID(0x1022)  # Characteristic UUID for Response of the Command
+RUN_DIAGNOSTICS = bluetooth.UUID(0x1023)  # Characteristic UUID for Command Latency Statistics
@@ -4,8 +4,10 @@ This script sets up Bluetooth configuration for a MicroPython-based device.
 Constants:
 - GENERIC_VALUE: A constant value used for a generic Bluetooth service characteristic.
 - ENV_SERVICE: A unique identifier for a custom Bluetooth service.
-- ADV_INTERVAL_MS: The interval in milliseconds between Bluetooth advertising packets.
+- ADV_FAST_INTERVAL_US, ADV_SLOW_INTERVAL_US, ADV_FAST_WINDOW_MS: The advertising schedule.
 - bluetooth_name: The name of the Bluetooth device.
+- HUB_*: The settings of a hub controlling several garments (see hub.py).
+- GATT_CACHE_*: The discovery cache of a hub (see gatt_cache.py).
 """
 
 import bluetooth
@@ -19,10 +21,111 @@ ENV_SERVICE = bluetooth.UUID(0x1000)
 # A unique identifier for a custom Bluetooth service. This UUID is used to identify the service
 # and its associated characteristics during Bluetooth discovery.
 
-ADV_INTERVAL_MS = 100_000
-# The interval in milliseconds between Bluetooth advertising packets. This interval determines
-# how frequently the device will broadcast its presence to other Bluetooth devices.
+ADV_FAST_INTERVAL_US = const(20_000)
+# The interval in microseconds between Bluetooth advertising packets after boot and after a
+# device disconnects, so the app finds the device (or reconnects) within a second.
+
+ADV_SLOW_INTERVAL_US = const(1_022_500)
+# The interval in microseconds between Bluetooth advertising packets once the fast window
+# is over, which keeps the radio mostly idle while nobody is looking for the device.
+
+ADV_FAST_WINDOW_MS = const(30_000)
+# How long in milliseconds the device advertises at the fast interval before falling back
+# to the slow one.
 
 bluetooth_name = "Febina EMS 10004"
 # The name of the Bluetooth device. This name is advertised during Bluetooth discovery, allowing
 # other devices to easily identify this device.
+
+COMMAND_BUFFER_SIZE = const(512)
+# The size in bytes of the buffer used to reassemble chunked commands written to the run
+# service. A single command, including its newline terminator, must fit in this buffer.
+
+COMMAND_QUEUE_LEN = const(32)
+# The number of command chunk writes that can be queued before the run service consumes
+# them. Bursts beyond this drop the oldest chunk.
+
+SESSION_CACHE_SIZE = const(4)
+# The number of authenticated sessions remembered for resumption. When full, the session
+# closest to expiring is forgotten.
+
+SESSION_TICKET_TTL_MS = const(600_000)
+# How long in milliseconds a device can stay away and still resume its session with the
+# ticket it was given, instead of logging in again with its username and password.
+
+DIAGNOSTICS_INTERVAL_MS = const(1000)
+# How often in milliseconds the command latency statistics are copied into the diagnostics
+# characteristic of the run service.
+
+MAX_CONNECTIONS = const(3)
+# The number of devices (e.g. a clinician's tablet and the patient's phone) that can be
+# connected at once, each with its own session. Must not exceed the connection limit of
+# the Bluetooth controller.
+
+COMMAND_WRITE_BUFFER_SIZE = const(1024)
+# The size in bytes of the command characteristic's append buffer, in which the Bluetooth
+# stack accumulates chunk writes until the run service drains them. Writes that would
+# overflow it are truncated, so it should hold everything the app can send between two
+# drains.
+
+PREFERRED_MTU = const(512)
+# The ATT MTU requested from each connected device. The connection uses the smaller of this
+# and what the device supports; at 512 a whole command fits in one write and any reply in
+# one notification.
+
+NOTIFY_QUEUE_LEN = const(8)
+# The number of notifications to a device that can wait while the Bluetooth controller's
+# transmit buffers are full. Replies beyond this make the run service wait for room, and
+# sending from a full queue without waiting drops the notification.
+
+BULK_PSM = const(0x0081)
+# The L2CAP protocol/service multiplexer (in the dynamic LE range 0x0080-0x00FF) on which
+# an authenticated device can open a channel to upload programs and download logs.
+
+BULK_MTU = const(512)
+# The largest L2CAP SDU the device may send on the bulk transfer channel.
+
+BULK_BUFFER_SIZE = const(2048)
+# The largest payload of a bulk transfer. One buffer of this size is kept per connection.
+
+HUB_MAX_GARMENTS = const(4)
+# The number of garments (electrode modules) a hub keeps connected at once. Must not exceed
+# the connection limit of the hub's Bluetooth controller (4 in MicroPython's ESP32 builds,
+# see CONFIG_BT_NIMBLE_MAX_CONNECTIONS).
+
+HUB_NAME_PREFIX = "Febina EMS"
+# A hub only connects to garments whose advertised name starts with this, besides
+# advertising ENV_SERVICE. Set to None to accept any name.
+
+HUB_SCAN_MS = const(5_000)
+# How long in milliseconds a hub scans for garments when it has free connection slots, and
+# how often it checks whether a garment has been lost.
+
+HUB_CONN_INTERVAL_US = const(15_000)
+# The connection interval a hub asks its garments for. Commands reach a garment in one to
+# two intervals, so a shorter interval gives a smaller skew between the start times of the
+# garments, at the cost of more radio time.
+
+HUB_COMMAND_TIMEOUT_MS = const(1_000)
+# How long in milliseconds a hub waits for a garment to acknowledge a command.
+
+HUB_START_LEAD_MS = const(250)
+# How far ahead in milliseconds a hub schedules the common start time of a RUN. It must
+# leave time to send the command to every garment.
+
+HUB_MAX_SKEW_MS = const(40)
+# The largest uncertainty in milliseconds between the start times of the garments that a
+# hub accepts for a RUN. Beyond it, the hub stops every garment instead.
+
+GATT_CACHE_COMPANY_ID = const(0xFFFF)
+# The company identifier of the manufacturer data in which a garment advertises the hash of
+# its GATT table. 0xFFFF is reserved by the Bluetooth SIG for internal use and testing;
+# replace it with an assigned identifier for products.
+
+GATT_CACHE_PATH = "gatt_cache.json"
+# The file in which a hub keeps the GATT tables of the garments it connected to, so it
+# doesn't discover them again when they reconnect.
+
+GATT_CACHE_SIZE = const(8)
+# The number of garments whose GATT tables a hub remembers. When full, the one used least
+# recently is forgotten.
@@ -0,0 +1,17 @@
+"""
+This script sets up the stimulation output of the device.
+
+Constants:
+- STIMULATION_PIN: The GPIO that drives the stimulation output stage.
+- STIMULATION_TIMER_ID: The hardware timer used to time the on/off cycles of a program.
+"""
+
+from micropython import const
+
+STIMULATION_PIN = const(25)
+# The GPIO driving the output stage. The waveform engine generates the stimulation pulses
+# on this pin with the PWM peripheral and holds it low while no program is running.
+
+STIMULATION_TIMER_ID = const(0)
+# The hardware timer whose periodic interrupt switches between the on and off phases of a
+# program and ends it after its duration.
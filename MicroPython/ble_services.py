@@ -3,32 +3,104 @@ from assets.ble_services_UUID import (
     AUTH_PASSWORD,
     AUTH_TOKEN,
     AUTH_RESPONSE,
+    AUTH_RESUME,
     AUTH_SERVICE,
     RUN_SERVICE,
     RUN_COMMAND,
     RUN_RESPONSE,
+    RUN_DIAGNOSTICS,
 )
 from assets.bluetooth_conf import (
     GENERIC_VALUE,
     ENV_SERVICE,
-    ADV_INTERVAL_MS,
+    ADV_FAST_INTERVAL_US,
+    ADV_SLOW_INTERVAL_US,
+    ADV_FAST_WINDOW_MS,
+    COMMAND_BUFFER_SIZE,
+    COMMAND_QUEUE_LEN,
+    COMMAND_WRITE_BUFFER_SIZE,
+    SESSION_CACHE_SIZE,
+    SESSION_TICKET_TTL_MS,
+    DIAGNOSTICS_INTERVAL_MS,
+    MAX_CONNECTIONS,
+    PREFERRED_MTU,
+    BULK_PSM,
+    BULK_MTU,
+    BULK_BUFFER_SIZE,
+    GATT_CACHE_COMPANY_ID,
     bluetooth_name,
 )
+from assets.stimulation_conf import STIMULATION_PIN, STIMULATION_TIMER_ID
 import aioble
+import asyncio
 import struct
+import time
 from Models import AndroidDevice
+from advertising import AdvertisingSchedule
+from device_session import DeviceSession
+from response_framing import ResponseFramer
+import bulk_transfer
+from bulk_transfer import BulkTransfer
+from frame_assembler import FrameAssembler
+from session_cache import SessionCache
+from waveform import WaveformEngine
+from latency import (
+    LatencyStats,
+    POINT_FRAME_COMPLETE,
+    POINT_PARSE_DONE,
+    POINT_DISPATCH_DONE,
+)
+import command_protocol
 import json
-import machine
+from micropython import const
+import log
+from log import log_debug, log_error, log_info, log_warn
+
+# Debug logging of received data on the command path. Set to 1 for development builds;
+# with 0 the compiler removes the `if _TRACE:` blocks entirely.
+_TRACE = const(0)
+
+_GATTS_ERROR_READ_NOT_PERMITTED = const(0x02)
+
+_DEFAULT_VALUE = struct.pack("<h", 0)
+
+# Sessions of the connected centrals, by DeviceConnection.
+device_sessions = {}
+
+
+class SessionCharacteristic(aioble.Characteristic):
+    """
+    A characteristic whose value depends on the connection reading it.
+
+    Before each read by a central, the value stored for it in its DeviceSession (or the
+    default value) is written into the GATT database, so a token, ticket or response is
+    only ever visible to the device it was meant for. Reads from connections without a
+    session are denied, and so are reads of authentication characteristics once the
+    session has disabled them.
+    """
+
+    def __init__(self, *args, auth_only=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._auth_only = auth_only
+
+    def on_read(self, connection):
+        session = device_sessions.get(connection)
+        if session is None or (self._auth_only and not session.auth_enabled):
+            return _GATTS_ERROR_READ_NOT_PERMITTED
+        self.write(session.value(self, _DEFAULT_VALUE))
+        return 0
+
 
 auth = aioble.Service(AUTH_SERVICE)
 run = aioble.Service(RUN_SERVICE)
 """
 Create and configure Bluetooth Low Energy (BLE) characteristics for authentication and run service.
 
-This function initializes BLE characteristics for username, password, token, and response
-for the authentication service, and data and result for the run service. The characteristics
-are configured with their respective UUIDs, read, write, notify, and capture permissions,
-and their initial values.
+This function initializes BLE characteristics for username, password, token, response, and
+resume for the authentication service, and data, result and diagnostics for the run service.
+The characteristics are configured with their respective UUIDs, read, write, notify, and
+capture permissions, and their initial values. Characteristics that hold a value for a
+specific device are SessionCharacteristics.
 
 Parameters:
 -----------
@@ -56,18 +128,29 @@ password = aioble.Characteristic(
     capture=True,
     initial=struct.pack("<h", 0),
 )
-token = aioble.Characteristic(
+token = SessionCharacteristic(
     auth,
     AUTH_TOKEN,
+    auth_only=True,
     read=True,
     write=False,
     notify=True,
     capture=True,
     initial=struct.pack("<h", 0),
 )
-response = aioble.Characteristic(
+response = SessionCharacteristic(
     auth,
     AUTH_RESPONSE,
+    auth_only=True,
+    read=True,
+    write=True,
+    notify=True,
+    capture=True,
+    initial=struct.pack("<h", 0),
+)
+resume = SessionCharacteristic(
+    auth,
+    AUTH_RESUME,
     read=True,
     write=True,
     notify=True,
@@ -75,16 +158,20 @@ response = aioble.Characteristic(
     initial=struct.pack("<h", 0),
 )
 
-data = aioble.Characteristic(
+# Writes are appended to a buffer by the stack and drained in batches, see handle_commands().
+# Not readable, since a read would see (and an initial value would prefix) pending writes.
+data = aioble.BufferedCharacteristic(
     run,
     RUN_COMMAND,
-    read=True,
+    read=False,
     write=True,
     notify=True,
     capture=True,
-    initial=struct.pack("<h", 0),
+    capture_queue_len=COMMAND_QUEUE_LEN,
+    max_len=COMMAND_WRITE_BUFFER_SIZE,
+    append=True,
 )
-res = aioble.Characteristic(
+res = SessionCharacteristic(
     run,
     RUN_RESPONSE,
     read=True,
@@ -94,12 +181,62 @@ res = aioble.Characteristic(
     initial=struct.pack("<h", 0),
 )
 
+# Processing latency statistics, see latency.py. Read-only.
+latency = LatencyStats()
+diagnostics = aioble.Characteristic(
+    run,
+    RUN_DIAGNOSTICS,
+    read=True,
+    write=False,
+    initial=bytes(latency.encode()),
+)
+
 # Register the services and activate them
 aioble.register_services(auth, run)
 
+# The largest MTU accepted in exchanges, whichever side starts them.
+aioble.config(mtu=PREFERRED_MTU)
+
 auth.active = True
 run.active = True
 
+# One per possible connection, reused so command reassembly never reallocates its buffer.
+free_frames = [FrameAssembler(COMMAND_BUFFER_SIZE) for _ in range(MAX_CONNECTIONS)]
+
+# Buffers for bulk transfers on L2CAP, one per connection that has opened a channel.
+free_transfers = [BulkTransfer(BULK_BUFFER_SIZE) for _ in range(MAX_CONNECTIONS)]
+
+# Sessions that a reconnecting device can resume with its ticket.
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_TICKET_TTL_MS)
+
+# Plays the stimulation programs sent with SET and started with RUN. There is a single
+# output stage, so all connected devices control the same engine.
+engine = WaveformEngine(STIMULATION_PIN, STIMULATION_TIMER_ID)
+
+# The session whose RUN command started the program that is playing.
+program_session = None
+
+# Splits replies that don't fit in one notification.
+framer = ResponseFramer(PREFERRED_MTU - 3)
+
+# Decodes binary commands. Commands are processed by a single task, so one is enough.
+command = command_protocol.Command()
+
+# The plain-text stop command.
+_STOP = b"STOP"
+
+# The advertising and scan response data, encoded once at boot. The hash of the services
+# lets a hub that cached them (see gatt_cache.py) skip discovery when it reconnects.
+adv_data, resp_data = aioble.advertising_payload(
+    name=bluetooth_name,
+    services=[ENV_SERVICE],
+    appearance=GENERIC_VALUE,
+    manufacturer=(GATT_CACHE_COMPANY_ID, aioble.services_hash()),
+)
+advertising = AdvertisingSchedule(
+    adv_data, resp_data, ADV_FAST_INTERVAL_US, ADV_SLOW_INTERVAL_US, ADV_FAST_WINDOW_MS
+)
+
 
 class AuthService:
     @staticmethod
@@ -109,7 +246,11 @@ class AuthService:
 
         This asynchronous function initiates Bluetooth Low Energy (BLE) advertising
         to make the device discoverable to nearby BLE-enabled devices. It uses
-        predefined constants and settings for the advertisement process.
+        predefined constants and settings for the advertisement process. The payload is
+        encoded once at boot, and the controller keeps it while the device is connected,
+        so advertising again after a disconnect only restarts it. The device advertises
+        at ADV_FAST_INTERVAL_US for ADV_FAST_WINDOW_MS after boot and after a device
+        disconnects, and at ADV_SLOW_INTERVAL_US otherwise (see advertising).
 
         Returns:
         --------
@@ -121,21 +262,119 @@ class AuthService:
         -----
         This function is a coroutine and should be called with await.
         """
-        return await aioble.advertise(
-            ADV_INTERVAL_MS,
-            name=bluetooth_name,
-            services=[ENV_SERVICE],
-            appearance=GENERIC_VALUE,
-        )
+        return await advertising.advertise()
+
+    @staticmethod
+    def open_session(connection):
+        """
+        Creates the session of a new connection.
+
+        Parameters:
+        -----------
+        connection : DeviceConnection
+            The new connection.
+
+        Returns:
+        --------
+        DeviceSession
+            The session, which receives the connection's writes from now on.
+
+        Raises:
+        -------
+        IndexError
+            If MAX_CONNECTIONS sessions are already open.
+        """
+        session = DeviceSession(connection, free_frames.pop())
+        device_sessions[connection] = session
+        return session
+
+    @staticmethod
+    def close_session(session):
+        """
+        Forgets the session of a connection that is gone, and frees its resources.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session to close.
+
+        Returns:
+        --------
+        None
+        """
+        if device_sessions.pop(session.connection, None) is None:
+            return
+        advertising.restart_fast()
+        notifications = session.notifications
+        if notifications.retried or notifications.dropped:
+            log_info(
+                "Notifications sent/retried/dropped/coalesced:",
+                notifications.sent,
+                notifications.retried,
+                notifications.dropped,
+                notifications.coalesced,
+            )
+        session.close()
+        free_frames.append(session.frames)
+
+    @staticmethod
+    def session_count():
+        """
+        Returns the number of open sessions.
+
+        Returns:
+        --------
+        int
+            The number of connected devices.
+        """
+        return len(device_sessions)
+
+    @staticmethod
+    async def route_writes(characteristic):
+        """
+        Delivers the writes to an authentication characteristic to the sessions that made them.
+
+        Runs forever; one task is started per characteristic by start().
+
+        Parameters:
+        -----------
+        characteristic : aioble.Characteristic
+            A capture-enabled characteristic of the authentication service.
+
+        Returns:
+        --------
+        None
+        """
+        async for connection, value in characteristic.writes():
+            session = device_sessions.get(connection)
+            if session is not None:
+                session.deliver(characteristic, value)
 
     @staticmethod
-    async def get_credentials():
+    def start():
+        """
+        Starts routing the writes to the authentication characteristics.
+
+        Returns:
+        --------
+        None
+        """
+        for characteristic in (username, password, response, resume):
+            asyncio.create_task(AuthService.route_writes(characteristic))
+
+    @staticmethod
+    async def get_credentials(session):
         """
         Asynchronously retrieves user credentials from BLE characteristics.
 
         This function waits for the username and password to be written to their
-        respective BLE characteristics. Once both are written, it reads the values
-        and decodes them from bytes to UTF-8 strings.
+        respective BLE characteristics by the session's device. Once both are written,
+        it decodes them from bytes to UTF-8 strings.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the device logging in.
 
         Returns:
         --------
@@ -148,119 +387,97 @@ class AuthService:
         -----
         This function is a coroutine and should be called with await.
         """
-        await username.written()
-        await password.written()
-        received_username_bytes = username.read()
-        received_password_bytes = password.read()
+        received_username_bytes = await session.written(username)
+        received_password_bytes = await session.written(password)
 
         return received_username_bytes.decode("utf-8"), received_password_bytes.decode(
             "utf-8"
         )
 
     @staticmethod
-    def send_token(tk, connection):
+    def send_token(tk, session):
         """
         Sends a token to the connected device after successful authentication.
 
-        This function encodes the provided token as UTF-8, writes it to the token
-        characteristic, and notifies the connected device of the update.
+        This function encodes the provided token as UTF-8, stores it as the value the
+        session's device reads from the token characteristic, and notifies that device.
+        Other connected devices can't read it.
 
         Args:
             tk (str): The authentication token to be sent to the connected device.
-            connection: The BLE connection object representing the active connection
-                        with the device that should receive the token.
+            session (DeviceSession): The session of the device that should receive the token.
 
         Returns:
             None
-
-        Note:
-            This function assumes that a global 'token' characteristic is available
-            and properly configured for writing and notifying.
         """
-        print("Credentials valid. Sending token:", tk)
+        log_info("Credentials valid. Sending token.")
+        if _TRACE:
+            log_debug("Token:", tk)
         tk_bytes = tk.encode("utf-8")
-        token.write(tk_bytes, send_update=True)
-        token.notify(connection)
+        session.set_value(token, tk_bytes)
+        session.notifications.notify(token, tk_bytes)
 
     @staticmethod
-    def reset_values():
+    def reset_values(session):
         """
-        Resets all characteristic values to their default state.
+        Resets the characteristic values of a session to their default state.
 
         This function is called when the authentication process needs to
-        be reset. It sets all BLE characteristics
-        (token, username, password, and response) back to their initial
-        state by writing a default value of 0 as a 16-bit integer.
-
-        The function also prints a message indicating that values are being
-        reset.
+        be reset. The token and response that the session's device reads
+        go back to the initial value of 0 as a 16-bit integer.
 
         Parameters:
         -----------
-        None
+        session : DeviceSession
+            The session to reset.
 
         Returns:
         --------
         None
-
-        Side Effects:
-        -------------
-        - Prints a message to the console.
-        - Modifies the global BLE characteristics: token, username, password, and response.
         """
-        print("Resetting values...")
-        token.write(struct.pack("<h", 0), send_update=True)
-        username.write(struct.pack("<h", 0), send_update=True)
-        password.write(struct.pack("<h", 0), send_update=True)
-        response.write(struct.pack("<h", 0), send_update=True)
+        log_debug("Resetting values...")
+        session.set_value(token, None)
+        session.set_value(response, None)
 
     @staticmethod
-    def disable_auth_service():
+    def disable_auth_service(session):
         """
-        Disables the authentication service by resetting characteristic values and making them unreadable.
+        Disables the authentication service for a session by resetting its values and making
+        them unreadable.
 
         This function performs the following actions:
-        1. Prints a message indicating that the authentication service is being disabled.
-        2. Resets all characteristic values to their default state using the reset_values() function.
-        3. Sets the 'read' attribute of username, password, token, and response characteristics to False,
-           making them unreadable.
+        1. Logs a message indicating that the authentication service is being disabled.
+        2. Resets the session's values to their default state using reset_values().
+        3. Denies further reads of the token and response characteristics by the
+           session's device.
 
         Parameters:
         -----------
-        None
+        session : DeviceSession
+            The session that completed authentication.
 
         Returns:
         --------
         None
-
-        Side Effects:
-        -------------
-        - Prints a message to the console.
-        - Resets values of BLE characteristics.
-        - Modifies the 'read' attribute of multiple BLE characteristics.
         """
-        print("Auth service disabled.")
-        AuthService.reset_values()
-        username.read = False
-        password.read = False
-        token.read = False
-        response.read = False
+        log_info("Auth service disabled.")
+        AuthService.reset_values(session)
+        session.disable_auth()
 
     @staticmethod
-    async def check_response_after_auth():
+    async def check_response_after_auth(session):
         """
         Asynchronously checks the response received after sending the authentication token.
 
-        This function waits for a response to be written to the 'response' characteristic,
-        reads the response, and checks if it matches the expected 'OK' value. If the response
-        is 'OK', it disables the authentication service. Otherwise, it resets all values.
+        This function waits for the session's device to write a response to the 'response'
+        characteristic, and checks if it matches the expected 'OK' value. If the response
+        is 'OK', it disables the authentication service for the session. Otherwise, it
+        resets the session's values.
 
         Parameters:
         -----------
-        connection : object
-            The BLE connection object representing the active connection with the client device.
-            This parameter is currently not used within the function but might be needed for
-            future implementations or consistency with other functions.
+        session : DeviceSession
+            The session of the device logging in.
 
         Returns:
         --------
@@ -270,25 +487,24 @@ class AuthService:
 
         Side Effects:
         -------------
-        - Prints messages to the console indicating the outcome of the response check.
+        - Logs messages indicating the outcome of the response check.
         - Calls disable_auth_service() if the response is 'OK'.
         - Calls reset_values() if the response is not 'OK'.
         """
-        await response.written()
-        received_response_bytes = response.read()
+        received_response_bytes = await session.written(response)
         received_response = received_response_bytes.decode("utf-8")
 
         if received_response == "OK":
-            print("Response OK received. Disabling auth service...")
-            AuthService.disable_auth_service()
+            log_info("Response OK received. Disabling auth service...")
+            AuthService.disable_auth_service(session)
             return True
         else:
-            print("Response not OK received. Resetting values...")
-            AuthService.reset_values()
+            log_warn("Response not OK received. Resetting values...")
+            AuthService.reset_values(session)
             return False
 
     @staticmethod
-    async def handle_auth_request(connection):
+    async def handle_auth_request(session):
         """
         Handles the authentication process by validating credentials and managing token response.
 
@@ -298,9 +514,9 @@ class AuthService:
 
         Parameters:
         -----------
-        connection : object
-            The BLE connection object representing the active connection with the client device.
-            This object is used for sending the authentication token.
+        session : DeviceSession
+            The session of the device logging in. Its connection is used for sending the
+            authentication token.
 
         Returns:
         --------
@@ -309,22 +525,23 @@ class AuthService:
             - un (str): The authenticated username
             - pw (str): The authenticated password
             - token (str): The authentication token sent to the client
-            If authentication fails or the process is interrupted, the function continues
-            to loop and does not return.
+            If the credentials are wrong, returns None and the caller should drop the
+            connection. If the token is not acknowledged, the function loops and waits for
+            new credentials.
 
         Side Effects:
         -------------
-        - Activates the authentication service
-        - Prints status messages to the console
-        - Modifies global BLE characteristics (through called functions)
-        - Sends BLE notifications to the connected device
+        - Logs status messages
+        - Modifies the session's characteristic values (through called functions)
+        - Sends BLE notifications to the session's device
         """
-        print("Waiting for username and password...")
+        log_info("Waiting for username and password...")
 
         while True:
             # Read and validate user credentials
-            received_username, received_password = await AuthService.get_credentials()
-            print("Received credentials:", received_username, received_password)
+            received_username, received_password = await AuthService.get_credentials(session)
+            if _TRACE:
+                log_debug("Received credentials for:", received_username)
 
             # Validate credentials using external AndroidDevice model
             is_auth, un, pw, tk = AndroidDevice.validate_credentials(
@@ -333,40 +550,152 @@ class AuthService:
 
             if is_auth:
                 # Send token if authentication is successful
-                AuthService.send_token(tk, connection)
+                AuthService.send_token(tk, session)
 
                 # Check if response after sending token is 'OK'
-                if await AuthService.check_response_after_auth():
+                if await AuthService.check_response_after_auth(session):
                     return un, pw, tk
                 else:
-                    print("Waiting for username and password again...")
+                    log_info("Waiting for username and password again...")
                     continue
             else:
-                # Reset values and await new credentials if authentication fails
-                AuthService.reset_values()
-                print("wrong credentials. resetting microcontroller...")
-                machine.soft_reset()
+                # Reset values and give up on this connection if authentication fails
+                AuthService.reset_values(session)
+                log_warn("Wrong credentials. Dropping connection...")
+                return None
+
+    @staticmethod
+    async def handle_resume_request(session):
+        """
+        Waits for the device to present a valid session resumption ticket.
+
+        A device that authenticated recently is given a ticket (see issue_ticket()). By
+        writing it to the resume characteristic it skips the credential hashing and the
+        token/OK handshake. Invalid or expired tickets are answered by resetting the resume
+        characteristic, and the device can then log in with its credentials as usual.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the connected device, whose address the ticket must have been
+            issued to.
+
+        Returns:
+        --------
+        tuple
+            (username, password, token) of the resumed session.
+        """
+        while True:
+            ticket = await session.written(resume)
+            credentials = session_cache.resume(session.mac_address, ticket)
+            if credentials is not None:
+                log_info("Session resumed.")
+                return credentials
+            log_warn("Invalid session ticket.")
+            session.set_value(resume, None)
+            session.notifications.notify(resume, _DEFAULT_VALUE)
+
+    @staticmethod
+    async def authenticate(session):
+        """
+        Authenticates the device either by session resumption or by credentials.
+
+        Both handshakes are awaited concurrently and the first one to finish decides the
+        outcome; the other is cancelled. If a handshake fails with an exception, it is
+        raised here, so the caller drops the connection.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the connected device.
+
+        Returns:
+        --------
+        tuple or None
+            (username, password, token) on success, or None if the credentials were wrong.
+        """
+        done = asyncio.Event()
+        result = []
+
+        async def attempt(handshake):
+            try:
+                result.append(await handshake)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result.append(e)
+            done.set()
+
+        tasks = (
+            asyncio.create_task(attempt(AuthService.handle_auth_request(session))),
+            asyncio.create_task(attempt(AuthService.handle_resume_request(session))),
+        )
+        try:
+            await done.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    @staticmethod
+    def issue_ticket(session):
+        """
+        Caches the authenticated session and sends the device a ticket to resume it.
+
+        The ticket is stored as the value the device reads from the resume characteristic
+        and notified to it. It is valid for SESSION_TICKET_TTL_MS and for one resumption
+        only; a new ticket is issued every time the device authenticates.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the authenticated device.
+
+        Returns:
+        --------
+        None
+        """
+        android_device = session.android_device
+        ticket = session_cache.issue(
+            session.mac_address,
+            android_device.username,
+            android_device.password,
+            android_device.token,
+        )
+        session.set_value(resume, ticket)
+        session.notifications.notify(resume, ticket)
 
 
 class RunService:
 
     @staticmethod
-    async def handle_command(connection, android_device):
+    async def handle_commands():
         """
-        Handles incoming commands from a connected BLE device and processes them accordingly.
+        Handles incoming commands from the connected BLE devices and processes them accordingly.
+
+        This asynchronous function continuously listens for incoming data from every
+        connection, feeds it to the frame assembler of the session that wrote it and
+        processes every complete newline-terminated command. The command characteristic is
+        in append mode, so while one device is connected all the chunks written since the
+        last wakeup are drained at once, and a long program streamed by the app costs one
+        wakeup per batch rather than per 20-byte write. Data is only scanned once for the
+        terminator, so reassembly is linear in the command size, and several pipelined
+        commands can be buffered at once. Binary frames (see command_protocol) between
+        text commands are decoded in place, without copying them. Writes from devices that
+        have not authenticated are ignored.
 
-        This asynchronous function continuously listens for incoming data chunks, assembles them
-        into complete commands, and processes them. It handles special commands like 'STOP' and
-        validates incoming tokens against the stored device token.
+        The received data is the only allocation per batch in the path to the waveform
+        engine: text commands are copied once into the session's frame assembler, and a
+        binary RUN or STOP is decoded and answered without allocating.
+
+        The loop serves every session, so a command that fails unexpectedly only stops the
+        program and is answered with STOP (see abort_command()); it doesn't end the loop.
 
         Parameters:
         -----------
-        connection : object
-            The BLE connection object representing the active connection with the client device.
-            Used for sending responses back to the client.
-        android_device : AndroidDevice
-            An object representing the authenticated Android device, containing the valid token
-            for command validation.
+        None
 
         Returns:
         --------
@@ -375,63 +704,332 @@ class RunService:
 
         Side Effects:
         -------------
-        - Prints received data and status messages to the console.
-        - Sends responses back to the connected device via BLE.
+        - Logs status messages, and received data in trace builds.
+        - Sends responses back to the connected devices via BLE.
         - Processes incoming commands and executes corresponding actions.
         """
+        log_info("Waiting for data...")
         while True:
-            full_data = ""
-            while True:
-                print("waiting for data...")
-                await data.written()
-                received_chunk = data.read()
-                decoded_chunk = received_chunk.decode("utf-8")
-                full_data += decoded_chunk
-                print("Received chunk:", decoded_chunk)
-                if "\n" in full_data:
-                    full_data = full_data.rstrip("\n")
-                    print("Full data received:", full_data)
+            received_chunk = await data.receive()
+            received_ticks = time.ticks_us()
+            session = device_sessions.get(data.writer)
+            if session is None or session.android_device is None:
+                if _TRACE:
+                    log_debug("Ignoring chunk from unauthenticated device")
+                continue
+            if _TRACE:
+                log_debug("Received data:", received_chunk)
+            frames = session.frames
+            offset = 0
+            while offset < len(received_chunk):
+                if frames.idle():
+                    if command_protocol.is_binary(received_chunk, offset):
+                        try:
+                            offset = await RunService.process_binary(
+                                received_chunk, offset, session, received_ticks
+                            )
+                        except Exception as e:
+                            await RunService.abort_command(
+                                session,
+                                e,
+                                command_protocol.encode_response(
+                                    command_protocol.OP_STOP, command_protocol.STATUS_MALFORMED
+                                ),
+                            )
+                            break
+                        continue
+                    session.frame_ticks = received_ticks
+                try:
+                    offset = frames.feed(received_chunk, offset)
+                except ValueError as e:
+                    log_warn("Invalid command, stopping service:", e)
+                    RunService.execute("STOP")
+                    await RunService.send_response("STOP", session)
                     break
 
-            if full_data == "STOP":
-                print("Stopping service...")
-                await RunService.send_response("STOP", connection)
+                frame = frames.pop()
+                while frame is not None:
+                    latency.start(session.frame_ticks)
+                    latency.mark(POINT_FRAME_COMPLETE)
+                    try:
+                        await RunService.process_command(frame, session)
+                    except Exception as e:
+                        await RunService.abort_command(session, e, "STOP")
+                    # Whatever is left over started in the data just fed.
+                    session.frame_ticks = received_ticks
+                    frame = frames.pop()
+
+    @staticmethod
+    async def negotiate_mtu(session):
+        """
+        Asks the device for the largest ATT MTU both sides support.
+
+        With a larger MTU the app can send a whole command in one write and receive any
+        reply in one notification, instead of 20-byte chunks. The negotiated value is kept
+        on the connection (see DeviceSession.payload_size). If the device doesn't answer,
+        or already started an exchange itself, the current MTU is kept.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the new connection.
+
+        Returns:
+        --------
+        int
+            The ATT MTU in use.
+        """
+        try:
+            await session.connection.exchange_mtu(PREFERRED_MTU)
+        except (OSError, asyncio.TimeoutError) as e:
+            log_warn("MTU exchange failed:", e)
+        log_info("MTU:", session.connection.mtu)
+        return session.payload_size + 3
+
+    @staticmethod
+    def close_session(session):
+        """
+        Discards the command state of a connection that is gone.
+
+        Stops the stimulation program if this session started it, so stimulation never
+        continues without the device that controls it.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the lost connection.
+
+        Returns:
+        --------
+        None
+        """
+        global program_session
+
+        if program_session is session:
+            engine.stop()
+            program_session = None
+
+    @staticmethod
+    def execute(command, info=None, session=None):
+        """
+        Applies a command to the waveform engine.
+
+        SET compiles the stimulation parameters into the engine's pulse schedule, RUN starts
+        playing it (after the delay given by a binary RUN, if any) and STOP stops it and
+        holds the output low. Other commands are ignored.
+
+        Parameters:
+        -----------
+        command : str
+            The command name: "SET", "RUN" or "STOP".
+        info : dict, str or int, optional
+            The stimulation parameters of a SET command, as a dict or the JSON string sent by
+            the app, or the start delay in milliseconds of a binary RUN command.
+        session : DeviceSession, optional
+            The session that sent the command. A RUN makes it the owner of the program.
+
+        Returns:
+        --------
+        None
+
+        Raises:
+        -------
+        ValueError
+            If the SET parameters are invalid, or RUN is received before SET.
+        """
+        global program_session
+
+        if command == "SET":
+            if isinstance(info, str):
+                info = json.loads(info)
+            engine.load(info)
+        elif command == "RUN":
+            engine.start(info if isinstance(info, int) else 0)
+            program_session = session
+        elif command == "STOP":
+            engine.stop()
+
+    @staticmethod
+    async def process_command(frame, session):
+        """
+        Decodes a single complete command and responds to it.
+
+        Parameters:
+        -----------
+        frame : memoryview
+            The command as received, without its newline terminator. It is only decoded
+            to a string if it is JSON.
+        session : DeviceSession
+            The session of the authenticated device, whose token the command must carry.
+
+        Returns:
+        --------
+        None
+        """
+        android_device = session.android_device
+        try:
+            if len(frame) == len(_STOP) and bytes(frame) == _STOP:
+                latency.mark(POINT_PARSE_DONE)
+                log_info("Stopping service...")
+                RunService.execute("STOP")
+                latency.mark(POINT_DISPATCH_DONE)
+                await RunService.send_response("STOP", session)
+                return
+
+            full_data = str(frame, "utf-8")
+            if _TRACE:
+                log_debug("Full data received:", full_data)
+            received_data_dict = json.loads(full_data)
+            if not isinstance(received_data_dict, dict):
+                raise ValueError("Not a JSON object")
+            latency.mark(POINT_PARSE_DONE)
+            received_token = received_data_dict.get("token")
+            received_cmd = received_data_dict.get("command")
+            received_info = received_data_dict.get("info", {})
+            if received_token == android_device.token and received_cmd == "PROTOCOL":
+                version = command_protocol.negotiate(received_data_dict.get("version"))
+                session_id = android_device.open_session(version)
+                latency.mark(POINT_DISPATCH_DONE)
+                log_info("Binary protocol version:", version)
+                if session_id is None:
+                    await RunService.send_response("PROTOCOL 0", session)
+                else:
+                    await RunService.send_response(
+                        "PROTOCOL {} {:08x}".format(version, session_id), session
+                    )
+            elif received_token == android_device.token:
+                if _TRACE:
+                    log_debug("Received command:", received_cmd, received_info)
+                RunService.execute(received_cmd, received_info, session)
+                latency.mark(POINT_DISPATCH_DONE)
+                await RunService.send_response(received_cmd, session)
             else:
+                log_warn("Invalid token, stopping service...")
+                RunService.execute("STOP")
+                await RunService.send_response("STOP", session)
+        except ValueError as e:
+            log_warn("Invalid command, stopping service:", e)
+            RunService.execute("STOP")
+            await RunService.send_response("STOP", session)
+
+    @staticmethod
+    async def abort_command(session, error, response):
+        """
+        Stops the program after a command failed with an unexpected error, and tells the
+        device that sent it.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the device that sent the command.
+        error : Exception
+            The error raised while processing the command.
+        response : str or bytes
+            The response to send: "STOP" for a text command, or a binary reply frame.
+
+        Returns:
+        --------
+        None
+        """
+        log_error("Command failed, stopping service:", repr(error))
+        RunService.execute("STOP")
+        try:
+            await RunService.send_response(response, session)
+        except Exception as e:
+            log_warn("Response not sent:", e)
+
+    @staticmethod
+    async def process_binary(chunk, offset, session, received_ticks):
+        """
+        Decodes and responds to consecutive binary command frames in received data.
+
+        Binary commands must carry the session id issued by the PROTOCOL command, except
+        for OP_STOP which is always honoured. Each frame is answered with a reply frame
+        holding its opcode and a status. Frames are decoded where they are in chunk.
+
+        Parameters:
+        -----------
+        chunk : bytes or memoryview
+            The received data, holding one or more complete binary frames from offset on.
+        offset : int
+            The offset in chunk of the first frame.
+        session : DeviceSession
+            The session of the authenticated device, whose binary session id the commands
+            must carry.
+        received_ticks : int
+            The time.ticks_us() at which the write was received, for latency statistics.
+
+        Returns:
+        --------
+        int
+            The offset in chunk of the first byte that is not part of a binary frame, or
+            len(chunk) if a malformed frame made the rest of the data unusable.
+        """
+        android_device = session.android_device
+        while command_protocol.is_binary(chunk, offset):
+            latency.start(received_ticks)
+            latency.mark(POINT_FRAME_COMPLETE)
+            try:
+                offset = command.decode(chunk, offset)
+            except ValueError as e:
+                log_warn("Invalid binary command:", e)
+                RunService.execute("STOP")
+                await RunService.send_response(
+                    command_protocol.encode_response(
+                        command_protocol.OP_STOP, command_protocol.STATUS_MALFORMED
+                    ),
+                    session,
+                )
+                return len(chunk)
+            latency.mark(POINT_PARSE_DONE)
+
+            opcode = command.opcode
+            info = command.info
+            if opcode == command_protocol.OP_STOP:
+                log_info("Stopping service...")
+                RunService.execute("STOP")
+                status = command_protocol.STATUS_OK
+            elif command.session_id != android_device.session_id:
+                log_warn("Invalid session, stopping service...")
+                RunService.execute("STOP")
+                opcode = command_protocol.OP_STOP
+                status = command_protocol.STATUS_INVALID_SESSION
+            else:
+                if _TRACE:
+                    log_debug("Received command:", command_protocol.OPCODE_NAMES[opcode], info)
                 try:
-                    received_data_dict = json.loads(full_data)
-                    received_token = received_data_dict.get("token")
-                    received_cmd = received_data_dict.get("command")
-                    received_info = received_data_dict.get("info", {})
-                    if received_token == android_device.token:
-                        print("Valid TOKEN")
-                        print("Received token:", received_token)
-                        print("Received command:", received_cmd)
-                        print("Received info:", received_info)
-                        await RunService.send_response(received_cmd, connection)
-                    else:
-                        print("Invalid TOKEN")
-                        print("Received token:", received_token)
-                        print("correct token:", android_device.token)
-                        await RunService.send_response("STOP", connection)
+                    RunService.execute(command_protocol.OPCODE_NAMES[opcode], info, session)
+                    status = command_protocol.STATUS_OK
                 except ValueError as e:
-                    print("Invalid JSON format")
-                    print("Stopping service...")
-                    await RunService.send_response("STOP", connection)
+                    log_warn("Command rejected:", e)
+                    RunService.execute("STOP")
+                    opcode = command_protocol.OP_STOP
+                    status = command_protocol.STATUS_MALFORMED
+            latency.mark(POINT_DISPATCH_DONE)
+            await RunService.send_response(
+                command_protocol.encode_response(opcode, status), session
+            )
+        return offset
 
     @staticmethod
-    async def send_response(response_data, connection):
+    async def send_response(response_data, session):
         """
         Sends a response back to the connected BLE device.
 
-        This asynchronous function encodes the response data as UTF-8, writes it to the
-        response characteristic, and notifies the connected device of the update.
+        This asynchronous function encodes the response data as UTF-8, stores it as the
+        value the session's device reads from the response characteristic, and notifies
+        that device only. A reply that doesn't fit in one notification at the connection's
+        MTU is sent as several framed fragments (see response_framing). Notifications go
+        through the session's queue, so when the controller's transmit buffers are full
+        they are retried rather than lost, and this waits only if the queue is full too.
 
         Parameters:
         -----------
-        response_data : str
-            The response data to be sent back to the connected device.
-        connection : object
-            The BLE connection object representing the active connection with the client device.
+        response_data : str or bytes
+            The response data to be sent back to the connected device. Binary protocol
+            replies are passed as bytes and sent unchanged.
+        session : DeviceSession
+            The session of the device the response is for.
 
         Returns:
         --------
@@ -439,9 +1037,139 @@ class RunService:
 
         Side Effects:
         -------------
-        - Writes the response data to the BLE characteristic.
-        - Sends a notification to the connected device.
+        - Sets the session's value of the response characteristic.
+        - Sends or queues notifications to the session's device.
+        - Adds the command being answered, if any, to the latency statistics.
+        """
+        if isinstance(response_data, str):
+            response_bytes = response_data.encode("utf-8")
+        else:
+            response_bytes = response_data
+        session.set_value(res, response_bytes)
+        notifications = session.notifications
+        if len(response_bytes) <= session.payload_size:
+            await notifications.send(res, response_bytes)
+        else:
+            for fragment in framer.fragments(response_bytes, session.payload_size):
+                await notifications.send(res, fragment)
+        latency.finish()
+
+    @staticmethod
+    def update_diagnostics():
+        """
+        Copies the current command latency statistics into the diagnostics characteristic.
+
+        Parameters:
+        -----------
+        None
+
+        Returns:
+        --------
+        None
         """
-        response_bytes = response_data.encode("utf-8")
-        res.write(response_bytes, send_update=True)
-        token.notify(connection)
+        diagnostics.write(latency.encode())
+
+    @staticmethod
+    async def publish_diagnostics():
+        """
+        Keeps the diagnostics characteristic up to date, every DIAGNOSTICS_INTERVAL_MS.
+
+        The statistics are published from this task rather than after every command, so
+        encoding them never delays a response. They cover all connections since boot.
+
+        Parameters:
+        -----------
+        None
+
+        Returns:
+        --------
+        None
+            This function runs in an infinite loop and does not return unless cancelled.
+        """
+        while True:
+            await asyncio.sleep_ms(DIAGNOSTICS_INTERVAL_MS)
+            RunService.update_diagnostics()
+
+
+class BulkService:
+
+    @staticmethod
+    async def serve(session):
+        """
+        Serves bulk transfers on L2CAP channels opened by an authenticated device.
+
+        Programs and logs of a few kilobytes take dozens of chunked GATT writes or
+        notifications, each waiting for the next connection event. On an L2CAP
+        connection-oriented channel they are sent as a single framed, checksummed message
+        (see bulk_transfer) in SDUs of up to BULK_MTU bytes. Each channel is served until
+        the device closes it, after which a new one is accepted.
+
+        Parameters:
+        -----------
+        session : DeviceSession
+            The session of the authenticated device.
+
+        Returns:
+        --------
+        None
+            Returns when the device disconnects, or at once if the Bluetooth stack has no
+            L2CAP channel support.
+        """
+        transfer = free_transfers.pop()
+        try:
+            while True:
+                channel = await session.connection.l2cap_accept(BULK_PSM, BULK_MTU)
+                log_info("Bulk channel open, MTU:", channel.peer_mtu)
+                try:
+                    while True:
+                        await BulkService.handle_request(channel, transfer, session)
+                except aioble.L2CAPDisconnectedError:
+                    log_info("Bulk channel closed")
+                except asyncio.TimeoutError:
+                    log_warn("Bulk transfer timed out")
+                    await channel.disconnect()
+        except aioble.DeviceDisconnectedError:
+            pass
+        except (AttributeError, OSError) as e:
+            log_warn("Bulk transfer unavailable:", e)
+        finally:
+            free_transfers.append(transfer)
+
+    @staticmethod
+    async def handle_request(channel, transfer, session):
+        """
+        Receives one bulk transfer request and replies to it.
+
+        OP_UPLOAD_PROGRAM carries the stimulation parameters of a SET command as JSON and
+        loads them into the waveform engine. OP_DOWNLOAD_LOG is answered with the log
+        records still held in RAM, one per line.
+
+        Parameters:
+        -----------
+        channel : L2CAPChannel
+            The channel opened by the device.
+        transfer : BulkTransfer
+            The buffer to receive the request and build the reply in.
+        session : DeviceSession
+            The session of the device.
+
+        Returns:
+        --------
+        None
+        """
+        opcode, status, payload = await transfer.receive(channel)
+        length = 0
+        if status != bulk_transfer.STATUS_OK:
+            log_warn("Bulk request rejected, status:", status)
+        elif opcode == bulk_transfer.OP_UPLOAD_PROGRAM:
+            try:
+                RunService.execute("SET", str(payload, "utf-8"), session)
+                log_info("Program uploaded:", len(payload), "bytes")
+            except ValueError as e:
+                log_warn("Program rejected:", e)
+                status = bulk_transfer.STATUS_REJECTED
+        elif opcode == bulk_transfer.OP_DOWNLOAD_LOG:
+            length = log.export(transfer.payload)
+        else:
+            status = bulk_transfer.STATUS_UNSUPPORTED
+        await transfer.send(channel, opcode, status, length)
@@ -0,0 +1,168 @@
+"""
+Framing of bulk transfers on an L2CAP connection-oriented channel.
+
+GATT moves at most ATT_MTU - 3 bytes per write or notification and waits for a response
+to every write. An L2CAP channel instead carries a credit-based byte stream in SDUs of up
+to the channel MTU, so a program or a log of a few kilobytes crosses in a handful of
+packets. Messages in both directions are frames of an 8-byte header followed by the
+payload (little-endian):
+
+    offset  size  field
+    0       1     opcode (OP_UPLOAD_PROGRAM, OP_DOWNLOAD_LOG)
+    1       1     status, 0 in requests (STATUS_*)
+    2       2     payload length
+    4       4     CRC-32 of the payload
+    8       n     payload
+
+Every request is answered with a frame carrying the same opcode. A request whose payload
+doesn't fit in the receive buffer is read and discarded, so the stream stays in sync and
+the reply reports STATUS_TOO_LARGE.
+"""
+
+from micropython import const
+import binascii
+import struct
+
+OP_UPLOAD_PROGRAM = const(1)
+OP_DOWNLOAD_LOG = const(2)
+
+STATUS_OK = const(0)
+STATUS_BAD_CHECKSUM = const(1)
+STATUS_TOO_LARGE = const(2)
+STATUS_REJECTED = const(3)
+STATUS_UNSUPPORTED = const(4)
+
+_HEADER_FORMAT = "<BBHI"
+_HEADER_SIZE = const(8)
+
+# Once a frame has started, the rest of it must arrive within this time.
+_PAYLOAD_TIMEOUT_MS = const(5000)
+
+
+class BulkTransfer:
+    """
+    Receives and sends bulk transfer frames in a preallocated buffer.
+
+    The same buffer holds the request being received and then the reply built from it, so
+    a transfer never allocates more than the payload views it returns.
+    """
+
+    def __init__(self, size):
+        """
+        Initialize a BulkTransfer instance.
+
+        Args:
+            size (int): The largest payload that can be received or sent.
+        """
+        self._buf = bytearray(_HEADER_SIZE + size)
+        self._mv = memoryview(self._buf)
+
+    @property
+    def payload(self):
+        """
+        Get the payload area of the buffer, to build a reply in.
+
+        Returns:
+            memoryview: The writable payload area.
+        """
+        return self._mv[_HEADER_SIZE:]
+
+    @staticmethod
+    async def _recv_exact(channel, mv, timeout_ms):
+        received = 0
+        while received < len(mv):
+            received += await channel.recvinto(mv[received:], timeout_ms)
+
+    async def receive(self, channel):
+        """
+        Wait for the next request frame on a channel.
+
+        Args:
+            channel (L2CAPChannel): The connected channel.
+
+        Returns:
+            tuple: (opcode, status, payload), where status is STATUS_OK,
+                STATUS_BAD_CHECKSUM or STATUS_TOO_LARGE and payload is a view of the
+                buffer, valid until the next call.
+
+        Raises:
+            L2CAPDisconnectedError: If the channel is closed.
+            asyncio.TimeoutError: If a started frame isn't completed in time.
+        """
+        mv = self._mv
+        await self._recv_exact(channel, mv[:_HEADER_SIZE], None)
+        opcode, _, length, crc = struct.unpack_from(_HEADER_FORMAT, self._buf, 0)
+
+        capacity = len(mv) - _HEADER_SIZE
+        if length > capacity:
+            while length:
+                n = min(length, capacity)
+                discard = mv[_HEADER_SIZE : _HEADER_SIZE + n]
+                await self._recv_exact(channel, discard, _PAYLOAD_TIMEOUT_MS)
+                length -= n
+            return opcode, STATUS_TOO_LARGE, mv[_HEADER_SIZE:_HEADER_SIZE]
+
+        payload = mv[_HEADER_SIZE : _HEADER_SIZE + length]
+        await self._recv_exact(channel, payload, _PAYLOAD_TIMEOUT_MS)
+        if binascii.crc32(payload) != crc:
+            return opcode, STATUS_BAD_CHECKSUM, payload
+        return opcode, STATUS_OK, payload
+
+    async def send(self, channel, opcode, status, length=0):
+        """
+        Send a reply frame whose payload has been written to the payload area.
+
+        Args:
+            channel (L2CAPChannel): The connected channel.
+            opcode (int): The opcode of the request answered.
+            status (int): One of the STATUS_* constants.
+            length (int): The number of payload bytes written.
+
+        Raises:
+            L2CAPDisconnectedError: If the channel is closed.
+        """
+        mv = self._mv
+        crc = binascii.crc32(mv[_HEADER_SIZE : _HEADER_SIZE + length])
+        struct.pack_into(_HEADER_FORMAT, self._buf, 0, opcode, status, length, crc)
+        await channel.send(mv[: _HEADER_SIZE + length])
+        await channel.flush()
+
+
+def encode(opcode, payload=b"", status=STATUS_OK):
+    """
+    Build a frame, for the app side and tests.
+
+    Args:
+        opcode (int): The opcode.
+        payload (bytes): The payload.
+        status (int): The status, STATUS_OK in requests.
+
+    Returns:
+        bytes: The frame.
+    """
+    header = struct.pack(_HEADER_FORMAT, opcode, status, len(payload), binascii.crc32(payload))
+    return header + bytes(payload)
+
+
+def decode(frame):
+    """
+    Unpack a complete frame, for the app side and tests.
+
+    Args:
+        frame (bytes): The frame.
+
+    Returns:
+        tuple: (opcode, status, payload).
+
+    Raises:
+        ValueError: If the frame is truncated or its checksum doesn't match.
+    """
+    if len(frame) < _HEADER_SIZE:
+        raise ValueError("Truncated frame")
+    opcode, status, length, crc = struct.unpack_from(_HEADER_FORMAT, frame, 0)
+    payload = bytes(frame[_HEADER_SIZE : _HEADER_SIZE + length])
+    if len(payload) != length:
+        raise ValueError("Truncated frame")
+    if binascii.crc32(payload) != crc:
+        raise ValueError("Bad checksum")
+    return opcode, status, payload
@@ -0,0 +1,261 @@
+"""
+Compact binary framing for commands on the run service.
+
+A binary frame is distinguished from the newline-terminated JSON commands by the high
+bit of its first byte, which is never set in ASCII text. The layout (little-endian) is:
+
+    offset  size  field
+    0       1     0x80 | protocol version
+    1       1     payload length (bytes after the 7-byte header)
+    2       1     opcode (OP_SET, OP_RUN, OP_STOP)
+    3       4     session id, issued by the PROTOCOL command
+    7       n     payload
+
+The OP_SET payload packs the stimulation parameters of the app's Electrotherapy model:
+
+    frequency (uint16, Hz), pulse width (uint16, us), on time (uint8, 0.1 s),
+    off time (uint8, 0.1 s), duration (uint8, minutes), stimulation type (uint8, index
+    into STIMULATION_TYPES), muscle (uint8, index into MUSCLES)
+
+so a SET is 16 bytes and fits in a single 20-byte ATT write. The OP_RUN payload is
+either empty, to start at once, or a start delay (uint16, ms), which lets a hub controlling
+several modules have them all start at the same time (see hub.py). Several frames may be
+sent back to back in one write, but a frame never spans writes.
+
+Replies are 3-byte frames: 0x80 | version, opcode, status.
+
+The firmware decodes frames with a Command, which is reused for every frame so that
+decoding a RUN or STOP allocates nothing.
+"""
+
+import struct
+from micropython import const
+
+PROTOCOL_VERSION = const(1)
+
+_FRAME_MARKER = const(0x80)
+_VERSION_MASK = const(0x7F)
+
+OP_SET = const(1)
+OP_RUN = const(2)
+OP_STOP = const(3)
+
+STATUS_OK = const(0)
+STATUS_INVALID_SESSION = const(1)
+STATUS_MALFORMED = const(2)
+
+_HEADER_FORMAT = "<BBBI"
+_HEADER_SIZE = const(7)
+_SET_FORMAT = "<HHBBBBB"
+_SET_SIZE = const(9)
+_RUN_DELAY_FORMAT = "<H"
+_RUN_DELAY_SIZE = const(2)
+
+STIMULATION_TYPES = ("EMS", "TENS")
+
+MUSCLES = (
+    "ABDOMINALS",
+    "OBLIQUES",
+    "TRAPEZIUS",
+    "LATISSIMUS DORSI",
+    "BICEPS",
+    "TRICEPS",
+    "FRONT DELTOIDS",
+    "REAR DELTOIDS",
+    "VASTUS MEDIALIS",
+    "VASTUS LATERALIS",
+    "QUADRICEPS & GRACILIS",
+    "HAMSTRINGS",
+    "GLUTEUS MAXIMUS",
+    "CALVES",
+    "FOREARMS",
+)
+
+OPCODE_NAMES = {OP_SET: "SET", OP_RUN: "RUN", OP_STOP: "STOP"}
+
+# Every possible reply, indexed by opcode then status, so replying allocates nothing.
+_RESPONSES = tuple(
+    tuple(
+        bytes((_FRAME_MARKER | PROTOCOL_VERSION, opcode, status))
+        for status in (STATUS_OK, STATUS_INVALID_SESSION, STATUS_MALFORMED)
+    )
+    for opcode in (0, OP_SET, OP_RUN, OP_STOP)
+)
+
+
+def is_binary(chunk, offset=0):
+    """
+    Check whether received data starts a binary frame rather than text.
+
+    Args:
+        chunk (bytes): The written data.
+        offset (int): Offset of the byte to check.
+
+    Returns:
+        bool: True if the byte at offset has the frame marker bit set.
+    """
+    return len(chunk) > offset and chunk[offset] & _FRAME_MARKER != 0
+
+
+class Command:
+    """
+    A decoded command frame, overwritten by each call to decode().
+    """
+
+    def __init__(self):
+        """
+        Initialize a Command instance.
+        """
+        self.opcode = 0
+        self.session_id = 0
+        # The stimulation parameters of an OP_SET (the same dict is updated by every
+        # OP_SET), the start delay in milliseconds of an OP_RUN, None for OP_STOP.
+        self.info = None
+        self._set_info = {}
+
+    def decode(self, buf, offset=0):
+        """
+        Decode the binary frame starting at offset.
+
+        The header is read byte by byte rather than with struct, and session ids issued
+        by the firmware fit in a small int, so only an OP_SET allocates (its parameters).
+
+        Args:
+            buf (bytes or memoryview): The received data, possibly holding several frames.
+            offset (int): Where the frame starts in buf.
+
+        Returns:
+            int: The offset of the byte after the frame.
+
+        Raises:
+            ValueError: If the frame is truncated, of an unsupported version or malformed.
+        """
+        if len(buf) - offset < _HEADER_SIZE:
+            raise ValueError("Truncated header")
+        if buf[offset] & _VERSION_MASK != PROTOCOL_VERSION:
+            raise ValueError("Unsupported version")
+        length = buf[offset + 1]
+        opcode = buf[offset + 2]
+        payload = offset + _HEADER_SIZE
+        if len(buf) - payload < length:
+            raise ValueError("Truncated payload")
+
+        info = None
+        if opcode == OP_SET:
+            if length != _SET_SIZE:
+                raise ValueError("Bad SET length")
+            frequency, pulse_width, on_time, off_time, duration, stim_type, muscle = (
+                struct.unpack_from(_SET_FORMAT, buf, payload)
+            )
+            if stim_type >= len(STIMULATION_TYPES) or muscle >= len(MUSCLES):
+                raise ValueError("Bad SET parameters")
+            info = self._set_info
+            info["muscle"] = MUSCLES[muscle]
+            info["frequency"] = frequency
+            info["pulseWidth"] = pulse_width
+            info["stimulationType"] = STIMULATION_TYPES[stim_type]
+            info["onTime"] = on_time / 10
+            info["offTime"] = off_time / 10
+            info["duration"] = duration
+        elif opcode == OP_RUN:
+            if length == _RUN_DELAY_SIZE:
+                info = buf[payload] | buf[payload + 1] << 8
+            elif length == 0:
+                info = 0
+            else:
+                raise ValueError("Bad RUN length")
+        elif opcode not in OPCODE_NAMES:
+            raise ValueError("Unknown opcode")
+
+        self.opcode = opcode
+        self.session_id = (
+            buf[offset + 3]
+            | buf[offset + 4] << 8
+            | buf[offset + 5] << 16
+            | buf[offset + 6] << 24
+        )
+        self.info = info
+        return payload + length
+
+
+def decode(buf, offset=0):
+    """
+    Decode the binary frame starting at offset.
+
+    Args:
+        buf (bytes): The received data, possibly holding several frames.
+        offset (int): Where the frame starts in buf.
+
+    Returns:
+        tuple: (opcode, session_id, info, next_offset), where info is a dict with the
+        same keys as the app's JSON `info` for OP_SET, the start delay in milliseconds
+        for OP_RUN and None for OP_STOP.
+
+    Raises:
+        ValueError: If the frame is truncated, of an unsupported version or malformed.
+    """
+    command = Command()
+    offset = command.decode(buf, offset)
+    return command.opcode, command.session_id, command.info, offset
+
+
+def encode(opcode, session_id, info=None):
+    """
+    Encode a command frame, as sent by the app.
+
+    Args:
+        opcode (int): OP_SET, OP_RUN or OP_STOP.
+        session_id (int): The session id returned by the PROTOCOL command.
+        info (dict or int, optional): The stimulation parameters for OP_SET, using the
+            keys of the app's JSON `info`, or the start delay in milliseconds for OP_RUN.
+
+    Returns:
+        bytes: The encoded frame.
+    """
+    payload = b""
+    if opcode == OP_SET:
+        payload = struct.pack(
+            _SET_FORMAT,
+            info["frequency"],
+            info["pulseWidth"],
+            round(info["onTime"] * 10),
+            round(info["offTime"] * 10),
+            info["duration"],
+            STIMULATION_TYPES.index(info["stimulationType"]),
+            MUSCLES.index(info["muscle"]),
+        )
+    elif opcode == OP_RUN and isinstance(info, int) and info:
+        payload = struct.pack(_RUN_DELAY_FORMAT, info)
+    header = struct.pack(
+        _HEADER_FORMAT, _FRAME_MARKER | PROTOCOL_VERSION, len(payload), opcode, session_id
+    )
+    return header + payload
+
+
+def encode_response(opcode, status):
+    """
+    Encode the reply to a binary command.
+
+    Args:
+        opcode (int): The opcode being answered.
+        status (int): STATUS_OK, STATUS_INVALID_SESSION or STATUS_MALFORMED.
+
+    Returns:
+        bytes: The 3-byte reply frame.
+    """
+    return _RESPONSES[opcode][status]
+
+
+def negotiate(requested_version):
+    """
+    Pick the protocol version to use for a PROTOCOL request.
+
+    Args:
+        requested_version (int): The highest version the app supports.
+
+    Returns:
+        int: The agreed version, or 0 if only JSON commands can be used.
+    """
+    if not isinstance(requested_version, int) or requested_version < 1:
+        return 0
+    return min(requested_version, PROTOCOL_VERSION)
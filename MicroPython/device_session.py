@@ -0,0 +1,197 @@
+from micropython import const
+from collections import deque
+import asyncio
+from assets.bluetooth_conf import NOTIFY_QUEUE_LEN
+from notification_queue import NotificationQueue
+
+_INBOX_LEN = const(4)
+_DEFAULT_ATT_MTU = const(23)
+
+
+class DeviceSession:
+    """
+    The state of one connected central.
+
+    Several phones or tablets can be connected at once, and the GATT database they share
+    holds a single value per characteristic. A DeviceSession keeps what belongs to one of
+    them: the values it should see when it reads a characteristic (its own token, ticket
+    or response), the writes it made to the authentication characteristics, the frame
+    assembler for its commands, the queue of notifications to it and, once it has logged
+    in, its AndroidDevice.
+    """
+
+    def __init__(self, connection, frames):
+        """
+        Initialize a DeviceSession instance for a new connection.
+
+        Args:
+            connection (DeviceConnection): The connection of the central.
+            frames (FrameAssembler): The assembler used for this connection's commands.
+                It is reset here and should be returned to its owner after close().
+        """
+        self._connection = connection
+        self._mac_address = ":".join(f"{byte:02x}" for byte in connection.device.addr)
+        self._frames = frames
+        self._android_device = None
+        self._auth_enabled = True
+        # characteristic -> value this connection reads
+        self._values = {}
+        # characteristic -> (queued writes, flag set when a write is queued)
+        self._inboxes = {}
+        self._notifications = NotificationQueue(connection, NOTIFY_QUEUE_LEN)
+        # Arrival time of the chunk holding the start of the command being assembled.
+        self.frame_ticks = 0
+        frames.reset()
+
+    @property
+    def connection(self):
+        """
+        Get the connection of the central.
+
+        Returns:
+            DeviceConnection: The connection.
+        """
+        return self._connection
+
+    @property
+    def mac_address(self):
+        """
+        Get the address of the central.
+
+        Returns:
+            str: The address, as colon-separated hex bytes.
+        """
+        return self._mac_address
+
+    @property
+    def payload_size(self):
+        """
+        Get the largest value that fits in one notification to this connection.
+
+        Returns:
+            int: The negotiated ATT_MTU - 3, or 20 before an MTU exchange.
+        """
+        return (self._connection.mtu or _DEFAULT_ATT_MTU) - 3
+
+    @property
+    def notifications(self):
+        """
+        Get the queue of notifications to this connection.
+
+        Returns:
+            NotificationQueue: The queue, through which all notifications to the device
+                should be sent so they keep their order.
+        """
+        return self._notifications
+
+    @property
+    def frames(self):
+        """
+        Get the frame assembler for this connection's commands.
+
+        Returns:
+            FrameAssembler: The assembler.
+        """
+        return self._frames
+
+    @property
+    def android_device(self):
+        """
+        Get the authenticated device.
+
+        Returns:
+            AndroidDevice or None: The device once it has authenticated, None before.
+        """
+        return self._android_device
+
+    @android_device.setter
+    def android_device(self, android_device):
+        self._android_device = android_device
+
+    @property
+    def auth_enabled(self):
+        """
+        Check whether the authentication characteristics can still be read.
+
+        Returns:
+            bool: False once the device has acknowledged its token.
+        """
+        return self._auth_enabled
+
+    def disable_auth(self):
+        """
+        Stop this connection from reading the authentication characteristics.
+        """
+        self._auth_enabled = False
+
+    def value(self, characteristic, default=None):
+        """
+        Get the value this connection should read from a characteristic.
+
+        Args:
+            characteristic (Characteristic): The characteristic being read.
+            default (bytes): Returned if no value was set for this connection.
+
+        Returns:
+            bytes: The value.
+        """
+        return self._values.get(characteristic, default)
+
+    def set_value(self, characteristic, value):
+        """
+        Set the value this connection reads from a characteristic.
+
+        Args:
+            characteristic (Characteristic): The characteristic.
+            value (bytes or None): The value, or None to fall back to the default.
+        """
+        if value is None:
+            self._values.pop(characteristic, None)
+        else:
+            self._values[characteristic] = value
+
+    def _inbox(self, characteristic):
+        inbox = self._inboxes.get(characteristic)
+        if inbox is None:
+            inbox = (deque((), _INBOX_LEN), asyncio.ThreadSafeFlag())
+            self._inboxes[characteristic] = inbox
+        return inbox
+
+    def deliver(self, characteristic, value):
+        """
+        Queue a value this connection wrote to a characteristic.
+
+        If the inbox is full the oldest write is dropped.
+
+        Args:
+            characteristic (Characteristic): The characteristic written to.
+            value (bytes): The written value.
+        """
+        queue, flag = self._inbox(characteristic)
+        queue.append(value)
+        flag.set()
+
+    async def written(self, characteristic):
+        """
+        Wait for this connection to write to a characteristic.
+
+        Args:
+            characteristic (Characteristic): The characteristic.
+
+        Returns:
+            bytes: The oldest write not yet consumed.
+        """
+        queue, flag = self._inbox(characteristic)
+        while not queue:
+            await flag.wait()
+        return queue.popleft()
+
+    def close(self):
+        """
+        Discard the state of the connection once it is gone.
+        """
+        self._frames.reset()
+        self._notifications.close()
+        self._values.clear()
+        self._inboxes.clear()
+        self._android_device = None
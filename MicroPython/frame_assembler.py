@@ -0,0 +1,142 @@
+from collections import deque
+
+_DELIMITER = b"\n"
+
+
+class FrameAssembler:
+    """
+    Reassembles delimiter-terminated frames from BLE write chunks.
+
+    Chunks are copied into a single preallocated buffer and only the newly
+    arrived bytes are scanned for the delimiter, so assembling a frame costs
+    time linear in its size and allocates nothing per chunk. Several complete
+    frames can be held at once if the phone pipelines commands, and a batch of
+    writes drained at once is consumed a few frames at a time.
+    """
+
+    def __init__(self, size=512, max_frames=4):
+        """
+        Initialize a FrameAssembler instance.
+
+        Args:
+            size (int): Size in bytes of the reassembly buffer. A single frame
+                (including its delimiter) must fit in it.
+            max_frames (int): Maximum number of complete frames held before
+                they are consumed with pop().
+        """
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._max_frames = max_frames
+        self._lengths = deque((), max_frames)
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all buffered data and complete frames.
+        """
+        # Start of the oldest unconsumed frame.
+        self._head = 0
+        # End of the buffered data.
+        self._tail = 0
+        # Start of the frame currently being received.
+        self._frame_start = 0
+        while self._lengths:
+            self._lengths.popleft()
+
+    def pending(self):
+        """
+        Get the number of complete frames waiting to be consumed.
+
+        Returns:
+            int: The number of frames available from pop().
+        """
+        return len(self._lengths)
+
+    def idle(self):
+        """
+        Check whether no data at all is buffered, not even part of a frame.
+
+        Returns:
+            bool: True if the next chunk starts a new frame.
+        """
+        return self._head == self._tail
+
+    def feed(self, chunk, start=0):
+        """
+        Append received data and record the frames it completes.
+
+        The data can be a single BLE write or a batch of several. When it
+        completes more frames than can be held, or the buffer is full of
+        complete frames, only part of it is consumed: pop() the complete
+        frames, then feed the rest from the returned offset.
+
+        Args:
+            chunk (bytes): The received data.
+            start (int): The offset in chunk of the first byte to feed.
+
+        Returns:
+            int: The offset in chunk of the first byte not consumed, which is
+                len(chunk) once all of it has been.
+
+        Raises:
+            ValueError: If a single frame does not fit in the buffer. The
+                assembler is reset.
+        """
+        end = len(chunk)
+        pos = start
+        while pos < end and len(self._lengths) < self._max_frames:
+            i = chunk.find(_DELIMITER, pos)
+            stop = end if i < 0 else i + 1
+            n = stop - pos
+            if self._tail + n > len(self._buf):
+                self._compact()
+                if self._tail + n > len(self._buf):
+                    if self._lengths:
+                        # Room is freed as the complete frames are popped.
+                        break
+                    self.reset()
+                    raise ValueError("Frame too long")
+
+            tail = self._tail
+            if pos == 0 and stop == end:
+                self._buf[tail : tail + n] = chunk
+            else:
+                self._buf[tail : tail + n] = memoryview(chunk)[pos:stop]
+            self._tail = tail + n
+            if i >= 0:
+                self._lengths.append(self._tail - 1 - self._frame_start)
+                self._frame_start = self._tail
+            pos = stop
+        return pos
+
+    def pop(self):
+        """
+        Take the oldest complete frame, without its delimiter.
+
+        The returned memoryview refers to the internal buffer and is only
+        valid until the next call to feed().
+
+        Returns:
+            memoryview or None: The frame, or None if no frame is complete.
+        """
+        if not self._lengths:
+            return None
+        length = self._lengths.popleft()
+        head = self._head
+        frame = self._mv[head : head + length]
+        self._head = head + length + 1
+        if self._head == self._tail:
+            # Nothing left, so the next chunk can start at the beginning.
+            self._head = self._tail = self._frame_start = 0
+        return frame
+
+    def _compact(self):
+        # Move unconsumed data to the start of the buffer.
+        head = self._head
+        if head == 0:
+            return
+        remaining = self._tail - head
+        self._buf[0:remaining] = self._mv[head : self._tail]
+        self._head = 0
+        self._tail = remaining
+        self._frame_start -= head
@@ -0,0 +1,263 @@
+from assets.bluetooth_conf import GATT_CACHE_COMPANY_ID, GATT_CACHE_PATH, GATT_CACHE_SIZE
+from aioble.client import ClientService, ClientCharacteristic, ClientDescriptor
+from micropython import const
+import aioble
+import asyncio
+import binascii
+import bluetooth
+import json
+from log import log_info, log_warn
+
+_DISCOVER_TIMEOUT_MS = const(5000)
+
+_FLAG_NOTIFY = const(0x0010)
+_FLAG_INDICATE = const(0x0020)
+
+_SERVICE_CHANGED = bluetooth.UUID(0x2A05)
+
+
+def table_hash(result):
+    """
+    Get the hash of its GATT table that a garment advertises (see
+    aioble.services_hash()).
+
+    Args:
+        result (ScanResult): A scan result, including the scan response.
+
+    Returns:
+        bytes or None: The hash, or None if the device doesn't advertise one.
+    """
+    for _, data in result.manufacturer(GATT_CACHE_COMPANY_ID):
+        return bytes(data)
+    return None
+
+
+class GattCache:
+    """
+    A persistent cache of the GATT tables of peers, for the client role.
+
+    Discovering a garment's services, characteristics and CCCDs takes a round trip per
+    procedure, each one or two connection intervals. The cache keeps the table discovered
+    on each peer in flash, keyed by its address, with the hash of the table the peer
+    advertises. When the peer reconnects advertising the same hash, the table is bound to
+    the connection from the cache, so aioble's services(), characteristics() and
+    descriptors() return it without any radio traffic.
+
+    An entry is dropped, and the table discovered again, when the advertised hash
+    differs, when the peer stops advertising one, when the owner reports the cached
+    handles failed (invalidate()), and when the peer indicates Service Changed.
+    """
+
+    def __init__(self, path=GATT_CACHE_PATH, size=GATT_CACHE_SIZE):
+        """
+        Initialize a GattCache instance with the entries saved in a file, if any.
+
+        Args:
+            path (str): The file in which the entries are kept.
+            size (int): Maximum number of peers kept. When full, the peer used least
+                recently is evicted.
+        """
+        self._path = path
+        self._size = size
+        # "addr_type/addr" -> [table hash, last use, services], see _dump().
+        self._entries = {}
+        self._uses = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    async def bind(self, connection, table_hash=None, timeout_ms=_DISCOVER_TIMEOUT_MS):
+        """
+        Bind the GATT table of a new connection, from the cache if possible.
+
+        On a miss, every service and characteristic is discovered, and the descriptors
+        of the characteristics that notify or indicate (their CCCDs). The descriptors of
+        the others are discovered on demand as usual.
+
+        Args:
+            connection (DeviceConnection): A connection to the peer, before any discovery.
+            table_hash (bytes): The hash the peer advertises (see table_hash()), or None
+                if it advertises none, in which case its table isn't cached.
+            timeout_ms (int): How long discovery may take.
+
+        Returns:
+            bool: True if the table came from the cache.
+
+        Raises:
+            asyncio.TimeoutError: If discovery takes too long.
+            aioble.DeviceDisconnectedError: If the peer disconnects during discovery.
+        """
+        device = connection.device
+        key = _key(device)
+        entry = self._entries.get(key)
+        digest = table_hash and binascii.hexlify(table_hash).decode()
+        hit = entry is not None and entry[0] == digest
+        if hit:
+            try:
+                services = _restore(connection, entry[2])
+            except Exception as e:
+                log_warn("GATT cache entry unreadable, discarded:", e)
+                self.invalidate(device)
+                entry = None
+                hit = False
+        if hit:
+            self._uses += 1
+            entry[1] = self._uses
+            self.hits += 1
+        else:
+            with connection.timeout(timeout_ms):
+                services = await _discover(connection)
+            self.misses += 1
+            if digest:
+                self._store(key, digest, _dump(services))
+            elif entry is not None:
+                self.invalidate(device)
+        connection._cached = services
+
+        for service in services:
+            for characteristic in service._cached:
+                if characteristic.uuid == _SERVICE_CHANGED and (
+                    characteristic.properties & _FLAG_INDICATE
+                ):
+                    if connection.bonded and not hit:
+                        # A bonded peer keeps the subscription, and indicates changes made
+                        # while the hub was away when it reconnects.
+                        await characteristic.subscribe(notify=False, indicate=True)
+                    asyncio.create_task(self._changed(connection, characteristic))
+        return hit
+
+    def invalidate(self, device):
+        """
+        Forget the table of a peer, e.g. because its cached handles failed.
+
+        Args:
+            device (Device): The peer.
+        """
+        if self._entries.pop(_key(device), None) is not None:
+            self._save()
+
+    async def _changed(self, connection, characteristic):
+        try:
+            await characteristic.indicated()
+        except aioble.DeviceDisconnectedError:
+            return
+        # The handles the connection was set up with may no longer be valid, so start
+        # over: the owner reconnects and discovers the new table.
+        log_warn("GATT table changed:", connection.device)
+        self.invalidate(connection.device)
+        connection._cached = None
+        await connection.disconnect()
+
+    def _store(self, key, digest, table):
+        self._entries.pop(key, None)
+        if len(self._entries) >= self._size:
+            oldest = min(self._entries, key=lambda k: self._entries[k][1])
+            del self._entries[oldest]
+        self._uses += 1
+        self._entries[key] = [digest, self._uses, table]
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self._path, "r") as f:
+                entries = json.load(f)
+            for entry in entries.values():
+                digest, uses, table = entry
+                if not (
+                    isinstance(digest, str) and isinstance(uses, int) and isinstance(table, list)
+                ):
+                    raise ValueError("Bad entry")
+                self._uses = max(self._uses, uses)
+            self._entries = entries
+        except OSError:
+            # No cache yet.
+            self._entries = {}
+        except Exception as e:
+            # Not written by _save(), or damaged: start over rather than fail.
+            log_warn("GATT cache unreadable, discarded:", e)
+            self._entries = {}
+            self._uses = 0
+        log_info("GATT tables cached:", len(self._entries))
+
+    def _save(self):
+        # Only called when an entry is added or dropped, not on every hit, to spare the
+        # flash.
+        try:
+            with open(self._path, "w") as f:
+                json.dump(self._entries, f)
+        except OSError as e:
+            log_warn("GATT cache not saved:", e)
+
+
+def _key(device):
+    return "{}/{}".format(device.addr_type, device.addr_hex())
+
+
+def _uuid(text):
+    return bluetooth.UUID(binascii.unhexlify(text))
+
+
+def _hex(uuid):
+    return binascii.hexlify(bytes(uuid)).decode()
+
+
+async def _discover(connection):
+    services = []
+    async for service in connection.services():
+        services.append(service)
+    for service in services:
+        characteristics = []
+        async for characteristic in service.characteristics():
+            characteristics.append(characteristic)
+        for characteristic in characteristics:
+            if characteristic.properties & (_FLAG_NOTIFY | _FLAG_INDICATE):
+                descriptors = []
+                async for descriptor in characteristic.descriptors():
+                    descriptors.append(descriptor)
+                characteristic._cached = descriptors
+        service._cached = characteristics
+    return services
+
+
+# A table is a list of [uuid, start handle, end handle, characteristics] per service,
+# with [end handle, value handle, properties, uuid, descriptors] per characteristic and
+# [handle, uuid] per descriptor (or None if they weren't discovered).
+def _dump(services):
+    return [
+        [
+            _hex(service.uuid),
+            service._start_handle,
+            service._end_handle,
+            [
+                [
+                    characteristic._end_handle,
+                    characteristic._value_handle,
+                    characteristic.properties,
+                    _hex(characteristic.uuid),
+                    characteristic._cached
+                    and [[d._value_handle, _hex(d.uuid)] for d in characteristic._cached],
+                ]
+                for characteristic in service._cached
+            ],
+        ]
+        for service in services
+    ]
+
+
+def _restore(connection, table):
+    services = []
+    for uuid, start_handle, end_handle, characteristics in table:
+        service = ClientService(connection, start_handle, end_handle, _uuid(uuid))
+        service._cached = []
+        for end, value_handle, properties, uuid, descriptors in characteristics:
+            characteristic = ClientCharacteristic(
+                service, end, value_handle, properties, _uuid(uuid)
+            )
+            if descriptors is not None:
+                characteristic._cached = [
+                    ClientDescriptor(characteristic, handle, _uuid(uuid))
+                    for handle, uuid in descriptors
+                ]
+            service._cached.append(characteristic)
+        services.append(service)
+    return services
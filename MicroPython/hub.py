@@ -0,0 +1,506 @@
+"""
+Hub controller for a suit of several garments.
+
+A full-body suit has several electrode modules, each a garment running this firmware. A
+hub (a board running this module in the central role, in place of main.py) scans for
+garments advertising ENV_SERVICE, keeps up to HUB_MAX_GARMENTS of them connected, logs in
+to each through the AUTH service like the app does, switches it to the binary protocol,
+and sends SET, RUN and STOP to all of them at once:
+
+    hub = Hub(username, password)
+    asyncio.create_task(hub.maintain())
+    ...
+    await hub.set(info)
+    await hub.run()
+    ...
+    await hub.stop()
+
+Commands are written to every garment concurrently, so a command costs one round trip
+rather than one per garment, but each still arrives within one or two connection
+intervals of a different link. RUN therefore does not start the garments on arrival: the
+hub picks a common start time HUB_START_LEAD_MS ahead, and tells each garment to start
+after a delay of that time minus when the command is estimated to reach it, which is at
+the next connection event of its link (or after half its measured write round trip). The
+write acknowledgement bounds when the command actually arrived, so the hub knows how far
+apart the garments can have started, and stops all of them if that exceeds
+HUB_MAX_SKEW_MS.
+
+Garments advertise a hash of their GATT table, and the hub keeps the tables it discovered
+in a GattCache, so a garment it knows is logged in to straight after connecting, without
+discovering its services again.
+"""
+
+from assets.ble_services_UUID import (
+    AUTH_SERVICE,
+    AUTH_USERNAME,
+    AUTH_PASSWORD,
+    AUTH_TOKEN,
+    AUTH_RESPONSE,
+    AUTH_RESUME,
+    RUN_SERVICE,
+    RUN_COMMAND,
+    RUN_RESPONSE,
+)
+from assets.bluetooth_conf import (
+    ENV_SERVICE,
+    PREFERRED_MTU,
+    HUB_MAX_GARMENTS,
+    HUB_NAME_PREFIX,
+    HUB_SCAN_MS,
+    HUB_CONN_INTERVAL_US,
+    HUB_COMMAND_TIMEOUT_MS,
+    HUB_START_LEAD_MS,
+    HUB_MAX_SKEW_MS,
+    GATT_CACHE_PATH,
+)
+from micropython import const
+import aioble
+import asyncio
+import json
+import time
+import command_protocol
+from gatt_cache import GattCache, table_hash
+from response_framing import ResponseAssembler
+from log import log_info, log_warn
+
+_CONNECT_TIMEOUT_MS = const(5000)
+
+# Scan at a 100 % duty cycle, so the advertisements of every garment are heard quickly.
+_SCAN_INTERVAL_US = const(30_000)
+_SCAN_WINDOW_US = const(30_000)
+
+# Weight of a new sample in the latency average, as a shift: 1/4.
+_LATENCY_SHIFT = const(2)
+
+# The largest start delay a RUN can carry.
+_MAX_DELAY_MS = const(0xFFFF)
+
+
+class HubError(Exception):
+    """
+    Raised when a garment can't be set up, or a command can't be applied to every garment.
+    """
+
+
+class Garment:
+    """
+    A connection to one garment, logged in and using the binary protocol.
+    """
+
+    def __init__(self, connection, interval_us=None):
+        """
+        Initialize a Garment instance for a new connection.
+
+        Args:
+            connection (DeviceConnection): The connection to the garment.
+            interval_us (int): The connection interval, if known.
+        """
+        self.connection = connection
+        self.interval_us = interval_us
+        self.session_id = None
+        # Average round trip of a write with response, in milliseconds.
+        self.latency_ms = None
+        # When the last command was written and acknowledged, in time.ticks_ms().
+        self.sent_ms = 0
+        self.acked_ms = 0
+        self._command = None
+        self._response = None
+        self._replies = ResponseAssembler()
+
+    def __str__(self):
+        return str(self.connection.device)
+
+    def is_connected(self):
+        return self.connection.is_connected()
+
+    async def open(self, username, password, timeout_ms=HUB_COMMAND_TIMEOUT_MS):
+        """
+        Log in to the garment and negotiate the binary protocol.
+
+        Args:
+            username (str): The username of the garment's credentials.
+            password (str): The password of the garment's credentials.
+            timeout_ms (int): The timeout of each step.
+
+        Raises:
+            HubError: If the device isn't a garment or doesn't support the binary protocol.
+            aioble.DeviceDisconnectedError: If the credentials are wrong, since the garment
+                then drops the connection.
+            asyncio.TimeoutError: If the garment stops answering.
+        """
+        connection = self.connection
+        await connection.exchange_mtu(PREFERRED_MTU)
+        auth = await self._characteristics(AUTH_SERVICE)
+        run = await self._characteristics(RUN_SERVICE)
+        try:
+            token = auth[AUTH_TOKEN]
+            resume = auth[AUTH_RESUME]
+            self._command = run[RUN_COMMAND]
+            self._response = run[RUN_RESPONSE]
+        except KeyError:
+            raise HubError("Not a garment")
+        await token.subscribe()
+        await resume.subscribe()
+        await self._response.subscribe()
+
+        await auth[AUTH_USERNAME].write(username.encode(), True, timeout_ms)
+        await auth[AUTH_PASSWORD].write(password.encode(), True, timeout_ms)
+        # The notification may be cut to the MTU, so read the whole token once it is sent.
+        await token.notified(timeout_ms)
+        tk = (await token.read(timeout_ms)).decode()
+        await auth[AUTH_RESPONSE].write(b"OK", True, timeout_ms)
+        # The garment issues a session ticket once it accepts commands.
+        await resume.notified(timeout_ms)
+
+        request = json.dumps(
+            {"token": tk, "command": "PROTOCOL", "version": command_protocol.PROTOCOL_VERSION}
+        )
+        await self._write((request + "\n").encode(), timeout_ms)
+        reply = (await self._reply(timeout_ms)).split()
+        if len(reply) != 3 or reply[0] != b"PROTOCOL" or reply[1] == b"0":
+            raise HubError("Binary protocol not supported")
+        self.session_id = int(reply[2], 16)
+
+    async def command(self, opcode, info=None, timeout_ms=HUB_COMMAND_TIMEOUT_MS):
+        """
+        Send a binary command and wait for its reply.
+
+        Args:
+            opcode (int): command_protocol.OP_SET, OP_RUN or OP_STOP.
+            info (dict or int, optional): The parameters of OP_SET, or the start delay of
+                OP_RUN in milliseconds.
+            timeout_ms (int): The timeout of the write and of the reply.
+
+        Returns:
+            int: The status of the reply. A garment rejecting a command stops.
+        """
+        await self._write(command_protocol.encode(opcode, self.session_id, info), timeout_ms)
+        while True:
+            reply = await self._reply(timeout_ms)
+            # Skip the late reply to an earlier command that timed out.
+            if len(reply) == 3 and (
+                reply[1] == opcode or reply[2] != command_protocol.STATUS_OK
+            ):
+                return reply[2]
+
+    async def start(self, start_ms, timeout_ms=HUB_COMMAND_TIMEOUT_MS):
+        """
+        Send a RUN that starts the loaded program at a given time.
+
+        Args:
+            start_ms (int): The start time, in time.ticks_ms() of the hub.
+            timeout_ms (int): The timeout of the write and of the reply.
+
+        Returns:
+            tuple: (status, earliest, latest), where earliest and latest bound when the
+                garment started, in milliseconds relative to start_ms.
+
+        Raises:
+            HubError: If start_ms is too close (or too far) to reach the garment in time.
+        """
+        now = time.ticks_ms()
+        if self.interval_us:
+            # The hub times the connection events, so they stay on the grid of the last
+            # acknowledgement (which came back at one), and a write reaches the garment
+            # at the next event.
+            phase_us = time.ticks_diff(self.acked_ms, now) * 1000 % self.interval_us
+            arrival = (phase_us or self.interval_us) // 1000
+        else:
+            arrival = self.latency_ms // 2
+        delay = time.ticks_diff(start_ms, now) - arrival
+        if not 0 <= delay <= _MAX_DELAY_MS:
+            raise HubError("Start time out of reach")
+        status = await self.command(command_protocol.OP_RUN, delay, timeout_ms)
+        # The command arrived between the write and its acknowledgement.
+        earliest = time.ticks_diff(time.ticks_add(self.sent_ms, delay), start_ms)
+        latest = time.ticks_diff(time.ticks_add(self.acked_ms, delay), start_ms)
+        return status, earliest, latest
+
+    async def _characteristics(self, uuid):
+        service = await self.connection.service(uuid)
+        if service is None:
+            raise HubError("Not a garment")
+        found = {}
+        async for characteristic in service.characteristics():
+            found[characteristic.uuid] = characteristic
+        return found
+
+    async def _write(self, data, timeout_ms):
+        # Commands longer than a write (e.g. PROTOCOL at the default MTU) are chunked, like
+        # the app does. Each write with response updates the latency estimate.
+        size = self.connection.mtu - 3
+        for offset in range(0, len(data), size):
+            self.sent_ms = time.ticks_ms()
+            await self._command.write(data[offset : offset + size], True, timeout_ms)
+            self.acked_ms = time.ticks_ms()
+            sample = time.ticks_diff(self.acked_ms, self.sent_ms)
+            if self.latency_ms is None:
+                self.latency_ms = sample
+            else:
+                self.latency_ms += (sample - self.latency_ms) >> _LATENCY_SHIFT
+
+    async def _reply(self, timeout_ms):
+        while True:
+            reply = self._replies.feed(await self._response.notified(timeout_ms))
+            if reply is not None:
+                return reply
+
+
+class Hub:
+    """
+    Keeps a pool of garments connected and sends commands to all of them.
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        max_garments=HUB_MAX_GARMENTS,
+        name_prefix=HUB_NAME_PREFIX,
+        conn_interval_us=HUB_CONN_INTERVAL_US,
+        cache_path=GATT_CACHE_PATH,
+    ):
+        """
+        Initialize a Hub instance, with no garment connected.
+
+        Args:
+            username (str): The username of the garments' credentials.
+            password (str): The password of the garments' credentials.
+            max_garments (int): The number of garments to keep connected.
+            name_prefix (str): Only connect to garments whose name starts with this, or
+                None for any name.
+            conn_interval_us (int): The connection interval to ask the garments for.
+            cache_path (str): The file of the GATT table cache, or None to discover the
+                tables on every connection.
+        """
+        self.username = username
+        self.password = password
+        self.max_garments = max_garments
+        self.name_prefix = name_prefix
+        self.conn_interval_us = conn_interval_us
+        self.garments = []
+        self.cache = GattCache(cache_path) if cache_path else None
+        # Commands are sent to a garment one at a time.
+        self._lock = asyncio.Lock()
+
+    async def maintain(self, scan_ms=HUB_SCAN_MS):
+        """
+        Keep the pool filled, forever: drop the garments that disconnected and scan for
+        others whenever there is a free slot.
+
+        Args:
+            scan_ms (int): How long each scan lasts, and how long to wait between checks.
+        """
+        while True:
+            if await self.fill(scan_ms) == 0:
+                await asyncio.sleep_ms(scan_ms)
+
+    async def fill(self, scan_ms=HUB_SCAN_MS):
+        """
+        Scan for garments and connect to them until the pool is full.
+
+        Args:
+            scan_ms (int): How long to scan at most.
+
+        Returns:
+            int: The number of garments added.
+        """
+        garments = self._prune()
+        if len(garments) >= self.max_garments:
+            return 0
+        connected = [garment.connection.device for garment in garments]
+        found = []
+        # Garments whose scan response, which has the hash of their GATT table, hasn't
+        # come yet. They are only connected to without it if the scan finds too few.
+        pending = []
+        async with aioble.scan(
+            scan_ms,
+            interval_us=_SCAN_INTERVAL_US,
+            window_us=_SCAN_WINDOW_US,
+            active=True,
+            services=[ENV_SERVICE],
+        ) as scanner:
+            # The scan iterator returns the same result for a device each time it changes.
+            async for result in scanner:
+                if result.device in connected or result in found:
+                    continue
+                # The name is in the scan response, so it may only match on a later result.
+                name = result.name()
+                if self.name_prefix and not (name and name.startswith(self.name_prefix)):
+                    continue
+                if result.resp_data is None:
+                    if result not in pending:
+                        pending.append(result)
+                    continue
+                if result in pending:
+                    pending.remove(result)
+                found.append(result)
+                if len(connected) + len(found) >= self.max_garments:
+                    break
+        found += pending[: self.max_garments - len(connected) - len(found)]
+
+        added = 0
+        for result in found:
+            garment = await self._open(result.device, table_hash(result))
+            if garment is not None:
+                self.garments.append(garment)
+                added += 1
+        return added
+
+    async def set(self, info, timeout_ms=HUB_COMMAND_TIMEOUT_MS):
+        """
+        Load a stimulation program on every garment.
+
+        Args:
+            info (dict): The stimulation parameters, with the keys of the app's JSON info.
+            timeout_ms (int): How long to wait for each garment.
+
+        Returns:
+            int: The number of garments.
+
+        Raises:
+            HubError: If no garment is connected, or some didn't accept the program.
+        """
+        async with self._lock:
+            garments = self._garments()
+            statuses = await self._fan_out(
+                garments, Garment.command, command_protocol.OP_SET, info, timeout_ms
+            )
+            failed = sum(1 for status in statuses if status != command_protocol.STATUS_OK)
+            if failed:
+                raise HubError("SET failed on {} of {} garments".format(failed, len(garments)))
+            return len(garments)
+
+    async def run(
+        self,
+        lead_ms=HUB_START_LEAD_MS,
+        max_skew_ms=HUB_MAX_SKEW_MS,
+        timeout_ms=HUB_COMMAND_TIMEOUT_MS,
+    ):
+        """
+        Start the loaded program on every garment at the same time.
+
+        Args:
+            lead_ms (int): How far ahead to schedule the start.
+            max_skew_ms (int): The largest accepted uncertainty between the start times.
+            timeout_ms (int): How long to wait for each garment.
+
+        Returns:
+            int: The uncertainty between the start times, in milliseconds.
+
+        Raises:
+            HubError: If no garment is connected, or some didn't start in time. Every
+                garment has been stopped, or disconnected if it didn't acknowledge the
+                STOP (see stop()).
+        """
+        async with self._lock:
+            garments = self._garments()
+            start_ms = time.ticks_add(time.ticks_ms(), lead_ms)
+            results = await self._fan_out(garments, Garment.start, start_ms, timeout_ms)
+            earliest = latest = 0
+            failed = 0
+            for result in results:
+                if isinstance(result, Exception) or result[0] != command_protocol.STATUS_OK:
+                    failed += 1
+                else:
+                    earliest = min(earliest, result[1])
+                    latest = max(latest, result[2])
+            skew = latest - earliest
+            if failed or skew > max_skew_ms:
+                await self._stop(garments, timeout_ms)
+                raise HubError(
+                    "RUN failed on {} of {} garments, skew {} ms".format(
+                        failed, len(garments), skew
+                    )
+                )
+            log_info("Started", len(garments), "garments, skew (ms):", skew)
+            return skew
+
+    async def stop(self, timeout_ms=HUB_COMMAND_TIMEOUT_MS):
+        """
+        Stop every garment.
+
+        A garment that doesn't acknowledge the STOP is disconnected, which also stops it
+        (a garment stops the program of a device it loses).
+
+        Args:
+            timeout_ms (int): How long to wait for each garment.
+
+        Returns:
+            int: The number of garments that acknowledged the STOP.
+        """
+        async with self._lock:
+            return await self._stop(self._prune(), timeout_ms)
+
+    async def close(self):
+        """
+        Disconnect every garment.
+        """
+        for garment in self._prune():
+            await garment.connection.disconnect()
+        self.garments = []
+
+    async def _stop(self, garments, timeout_ms):
+        # Like stop(), with the lock already held.
+        statuses = await self._fan_out(
+            garments, Garment.command, command_protocol.OP_STOP, None, timeout_ms
+        )
+        stopped = 0
+        for garment, status in zip(garments, statuses):
+            if status == command_protocol.STATUS_OK:
+                stopped += 1
+            else:
+                log_warn("STOP not acknowledged, disconnecting", garment)
+                await garment.connection.disconnect()
+        return stopped
+
+    async def _open(self, device, digest):
+        try:
+            connection = await device.connect(
+                _CONNECT_TIMEOUT_MS,
+                min_conn_interval_us=self.conn_interval_us,
+                max_conn_interval_us=self.conn_interval_us,
+            )
+        except asyncio.TimeoutError:
+            log_warn("Garment not reachable:", device)
+            return None
+        garment = Garment(connection, self.conn_interval_us)
+        cached = False
+        try:
+            if self.cache:
+                cached = await self.cache.bind(connection, digest)
+            await garment.open(self.username, self.password)
+        except (
+            asyncio.TimeoutError,
+            aioble.DeviceDisconnectedError,
+            aioble.GattError,
+            HubError,
+            ValueError,
+        ) as e:
+            log_warn("Garment rejected:", device, e)
+            if cached and not isinstance(e, aioble.DeviceDisconnectedError):
+                # The cached handles may be wrong although the hash matched, so discover
+                # the table next time. A garment drops wrong credentials, which isn't that.
+                self.cache.invalidate(device)
+            await connection.disconnect()
+            return None
+        log_info("Garment connected:", garment, "(cached GATT table)" if cached else "")
+        return garment
+
+    def _prune(self):
+        self.garments = [garment for garment in self.garments if garment.is_connected()]
+        return self.garments
+
+    def _garments(self):
+        garments = self._prune()
+        if not garments:
+            raise HubError("No garments connected")
+        return garments
+
+    @staticmethod
+    async def _fan_out(garments, method, *args):
+        # Sends to every garment concurrently. Failures are returned, not raised, so one
+        # lost garment doesn't cancel the command on the others.
+        return await asyncio.gather(
+            *[method(garment, *args) for garment in garments], return_exceptions=True
+        )
@@ -0,0 +1,220 @@
+"""
+Command latency instrumentation.
+
+Every command is timestamped with time.ticks_us() at five points on its way through the
+RUN service:
+
+    POINT_FRAME_START     the chunk holding the first byte of the command arrived
+    POINT_FRAME_COMPLETE  the command was reassembled
+    POINT_PARSE_DONE      the command was decoded (JSON or binary)
+    POINT_DISPATCH_DONE   the command was applied to the waveform engine
+    POINT_NOTIFY_SENT     the response was notified
+
+The four intervals between consecutive points, and the total from first chunk to
+notification, are counted in fixed-size log-linear histograms, so recording a command
+never allocates. LatencyStats.encode() packs p50/p95/p99/max of each into the value of the
+diagnostics characteristic and decode() unpacks it on the host.
+"""
+
+from micropython import const
+from array import array
+import struct
+import time
+
+POINT_FRAME_START = const(0)
+POINT_FRAME_COMPLETE = const(1)
+POINT_PARSE_DONE = const(2)
+POINT_DISPATCH_DONE = const(3)
+POINT_NOTIFY_SENT = const(4)
+_POINTS = const(5)
+
+STAGE_NAMES = ("assemble", "parse", "dispatch", "notify", "total")
+_STAGE_TOTAL = const(4)
+_STAGES = const(5)
+
+# Values below 8 us get a bucket each, above that every power of two is split into 4
+# buckets (at most 25% error), up to 2^24 us (about 16 s).
+_LINEAR_BUCKETS = const(8)
+_SUB_BUCKETS = const(4)
+_BUCKETS = const(92)
+
+FORMAT_VERSION = const(1)
+_HEADER = "<BB"
+_HEADER_SIZE = const(2)
+_STAGE = "<IIIII"
+_STAGE_SIZE = const(20)
+ENCODED_SIZE = const(102)
+
+
+def _bucket(us):
+    if us < _LINEAR_BUCKETS:
+        return max(us, 0)
+    if us >= 1 << 24:
+        return _BUCKETS - 1
+    # The bit length of us (MicroPython's int has no bit_length()).
+    bits = 0
+    v = us
+    while v:
+        v >>= 1
+        bits += 1
+    index = _LINEAR_BUCKETS + (bits - 4) * _SUB_BUCKETS + ((us >> (bits - 3)) & 3)
+    return min(index, _BUCKETS - 1)
+
+
+def _bucket_limit(index):
+    # The largest value counted in a bucket.
+    if index < _LINEAR_BUCKETS:
+        return index
+    index -= _LINEAR_BUCKETS
+    shift = index // _SUB_BUCKETS + 1
+    return ((_SUB_BUCKETS + index % _SUB_BUCKETS + 1) << shift) - 1
+
+
+class LatencyStats:
+    """
+    Latency histograms for the stages of command processing.
+
+    A command is recorded with start(), mark() at each later point it reaches, and
+    finish() once its response has been notified. Stages whose two points were not both
+    reached (e.g. a command rejected before dispatch) are left out of that command's
+    record; the total is always recorded.
+    """
+
+    def __init__(self):
+        """
+        Initialize a LatencyStats instance with empty histograms.
+        """
+        self._marks = array("I", bytes(4 * _POINTS))
+        self._reached = 0
+        self._counts = array("I", bytes(4 * _STAGES * _BUCKETS))
+        self._totals = array("I", bytes(4 * _STAGES))
+        self._max = array("I", bytes(4 * _STAGES))
+        self._encoded = bytearray(ENCODED_SIZE)
+
+    def reset(self):
+        """
+        Clear the histograms and any command being recorded.
+        """
+        self._reached = 0
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+        for i in range(_STAGES):
+            self._totals[i] = 0
+            self._max[i] = 0
+
+    def start(self, ticks):
+        """
+        Start recording a command.
+
+        Parameters:
+        ticks (int): The time.ticks_us() at which the first chunk of the command arrived.
+        """
+        self._marks[POINT_FRAME_START] = ticks
+        self._reached = 1 << POINT_FRAME_START
+
+    def mark(self, point):
+        """
+        Record that the current command reached a point, if one is being recorded.
+
+        Parameters:
+        point (int): One of the POINT_* constants.
+        """
+        if self._reached:
+            self._marks[point] = time.ticks_us()
+            self._reached |= 1 << point
+
+    def finish(self):
+        """
+        Record that the response to the current command was notified, and add the command
+        to the histograms. Does nothing if no command is being recorded.
+        """
+        if not self._reached:
+            return
+        self.mark(POINT_NOTIFY_SENT)
+        marks = self._marks
+        reached = self._reached
+        # Cleared first, so a failure below doesn't leave the command recording.
+        self._reached = 0
+        for stage in range(_STAGE_TOTAL):
+            if reached & (3 << stage) == 3 << stage:
+                self._add(stage, time.ticks_diff(marks[stage + 1], marks[stage]))
+        self._add(
+            _STAGE_TOTAL, time.ticks_diff(marks[POINT_NOTIFY_SENT], marks[POINT_FRAME_START])
+        )
+
+    def _add(self, stage, us):
+        self._counts[stage * _BUCKETS + _bucket(us)] += 1
+        self._totals[stage] += 1
+        if us > self._max[stage]:
+            self._max[stage] = us
+
+    def percentile(self, stage, pct):
+        """
+        Get an upper bound of a percentile of a stage's latency.
+
+        Parameters:
+        stage (int): The index of the stage in STAGE_NAMES.
+        pct (int): The percentile, 0 to 100.
+
+        Returns:
+            int: The latency in microseconds, or 0 if nothing was recorded.
+        """
+        total = self._totals[stage]
+        if not total:
+            return 0
+        rank = (total * pct + 99) // 100
+        seen = 0
+        base = stage * _BUCKETS
+        for index in range(_BUCKETS):
+            seen += self._counts[base + index]
+            if seen >= rank:
+                return min(_bucket_limit(index), self._max[stage])
+        return self._max[stage]
+
+    def encode(self):
+        """
+        Pack the count, p50, p95, p99 and max of every stage into the diagnostics format.
+
+        Returns:
+            bytearray: ENCODED_SIZE bytes, reused by the next call.
+        """
+        buf = self._encoded
+        struct.pack_into(_HEADER, buf, 0, FORMAT_VERSION, _STAGES)
+        for stage in range(_STAGES):
+            struct.pack_into(
+                _STAGE,
+                buf,
+                _HEADER_SIZE + stage * _STAGE_SIZE,
+                self._totals[stage],
+                self.percentile(stage, 50),
+                self.percentile(stage, 95),
+                self.percentile(stage, 99),
+                self._max[stage],
+            )
+        return buf
+
+
+def decode(buf):
+    """
+    Unpack a value encoded by LatencyStats.encode().
+
+    Parameters:
+    buf (bytes): The value read from the diagnostics characteristic.
+
+    Returns:
+        list: A (name, count, p50, p95, p99, max) tuple per stage, latencies in microseconds.
+
+    Raises:
+        ValueError: If the value has an unknown version or is truncated.
+    """
+    version, stages = struct.unpack_from(_HEADER, buf, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unknown diagnostics version")
+    if len(buf) < _HEADER_SIZE + stages * _STAGE_SIZE:
+        raise ValueError("Truncated diagnostics")
+    result = []
+    for stage in range(stages):
+        name = STAGE_NAMES[stage] if stage < len(STAGE_NAMES) else str(stage)
+        values = struct.unpack_from(_STAGE, buf, _HEADER_SIZE + stage * _STAGE_SIZE)
+        result.append((name,) + values)
+    return result
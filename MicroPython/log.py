@@ -0,0 +1,177 @@
+"""
+Leveled logging for the firmware, in the style of aioble.core's log_error/log_warn/log_info.
+
+Records are kept in a preallocated in-RAM ring buffer of fixed-size slots, so logging never
+blocks on the UART. They are printed either immediately (the default, like print) or, once
+start_flush_task() has been called, by a background task after the event loop has had a
+chance to finish the work that produced them.
+
+Messages below log_level are discarded before they are formatted, so a disabled call costs
+a function call and a comparison. For the command hot path, modules guard debug logging
+with a local `_TRACE = const(0)` flag (`if _TRACE: log_debug(...)`), which the MicroPython
+compiler strips entirely from production builds.
+"""
+
+from micropython import const
+from array import array
+import asyncio
+import time
+
+LEVEL_ERROR = const(1)
+LEVEL_WARN = const(2)
+LEVEL_INFO = const(3)
+LEVEL_DEBUG = const(4)
+
+_LEVEL_NAMES = "?EWID"
+
+# Records at or below this level are kept.
+log_level = LEVEL_INFO
+
+_RECORD_SIZE = const(80)
+_RECORDS = const(32)
+_FLUSH_DELAY_MS = const(20)
+
+_buf = bytearray(_RECORD_SIZE * _RECORDS)
+_mv = memoryview(_buf)
+_lengths = bytearray(_RECORDS)
+_levels = bytearray(_RECORDS)
+_ticks = array("I", bytes(4 * _RECORDS))
+
+# Total number of records ever written, and the number printed so far.
+_written = 0
+_flushed = 0
+
+# Number of records overwritten before they were printed.
+dropped = 0
+
+_flush_event = None
+_flush_task = None
+
+
+def _record(level, args):
+    global _written, _flushed, dropped
+
+    msg = " ".join(str(a) for a in args).encode()
+    slot = _written % _RECORDS
+    n = min(len(msg), _RECORD_SIZE)
+    # Don't cut a multibyte character, so the record stays valid UTF-8: back up past
+    # its continuation bytes (0b10xxxxxx).
+    while n < len(msg) and n and msg[n] & 0xC0 == 0x80:
+        n -= 1
+    offset = slot * _RECORD_SIZE
+    _mv[offset : offset + n] = msg[:n]
+    _lengths[slot] = n
+    _levels[slot] = level
+    _ticks[slot] = time.ticks_ms() & 0xFFFFFFFF
+    _written += 1
+
+    if _written - _flushed > _RECORDS:
+        dropped += _written - _flushed - _RECORDS
+        _flushed = _written - _RECORDS
+
+    if _flush_event:
+        _flush_event.set()
+    else:
+        flush()
+
+
+def log_error(*args):
+    if log_level >= LEVEL_ERROR:
+        _record(LEVEL_ERROR, args)
+
+
+def log_warn(*args):
+    if log_level >= LEVEL_WARN:
+        _record(LEVEL_WARN, args)
+
+
+def log_info(*args):
+    if log_level >= LEVEL_INFO:
+        _record(LEVEL_INFO, args)
+
+
+def log_debug(*args):
+    if log_level >= LEVEL_DEBUG:
+        _record(LEVEL_DEBUG, args)
+
+
+def records():
+    """
+    Get the records still held in the ring buffer, oldest first.
+
+    Returns:
+        list: (ticks_ms, level, message) tuples.
+    """
+    result = []
+    for i in range(max(0, _written - _RECORDS), _written):
+        slot = i % _RECORDS
+        offset = slot * _RECORD_SIZE
+        message = str(_mv[offset : offset + _lengths[slot]], "utf-8")
+        result.append((_ticks[slot], _levels[slot], message))
+    return result
+
+
+def export(buf):
+    """
+    Copy the records still held in the ring buffer into buf as text, oldest first.
+
+    Each record is written as a "{ticks_ms} {level}: {message}" line, in the format used
+    by flush(). Records that don't fit in buf are left out.
+
+    Args:
+        buf (bytearray or memoryview): The buffer to write to.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    n = 0
+    for i in range(max(0, _written - _RECORDS), _written):
+        slot = i % _RECORDS
+        prefix = "{} {}: ".format(_ticks[slot], _LEVEL_NAMES[_levels[slot]]).encode()
+        length = _lengths[slot]
+        end = n + len(prefix) + length + 1
+        if end > len(buf):
+            break
+        buf[n : n + len(prefix)] = prefix
+        n += len(prefix)
+        offset = slot * _RECORD_SIZE
+        buf[n : n + length] = _mv[offset : offset + length]
+        buf[end - 1] = 0x0A
+        n = end
+    return n
+
+
+def flush():
+    """
+    Print the records that have not been printed yet.
+    """
+    global _flushed
+
+    while _flushed < _written:
+        slot = _flushed % _RECORDS
+        offset = slot * _RECORD_SIZE
+        print(
+            "[ems {}] {}:".format(_ticks[slot], _LEVEL_NAMES[_levels[slot]]),
+            str(_mv[offset : offset + _lengths[slot]], "utf-8"),
+        )
+        _flushed += 1
+
+
+async def _run_flush_task():
+    while True:
+        await _flush_event.wait()
+        # Let the code that logged finish its work (e.g. reply to a command) first.
+        await asyncio.sleep_ms(_FLUSH_DELAY_MS)
+        flush()
+
+
+def start_flush_task():
+    """
+    Defer printing to a background task instead of printing on every call.
+    """
+    global _flush_event, _flush_task
+
+    if _flush_task:
+        return
+    _flush_event = asyncio.ThreadSafeFlag()
+    _flush_task = asyncio.create_task(_run_flush_task())
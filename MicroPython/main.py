@@ -1,42 +1,115 @@
-from ble_services import AuthService, RunService
+from ble_services import AuthService, RunService, BulkService
+from assets.bluetooth_conf import MAX_CONNECTIONS
 import asyncio
 from Models import AndroidDevice
-import machine
+import log
+from log import log_error, log_info, log_warn
+from micropython import const
 
+_RESTART_DELAY_MS = const(100)
 
-async def monitor_connection(connection):
+
+async def serve_connection(session):
     """
-    Monitors the connection with a device and performs a soft reset if the connection is lost.
+    Authenticates a connected device, after which the RUN service accepts its commands.
+
+    This asynchronous function performs the following steps:
+    1. Negotiates the largest MTU supported by both sides
+    2. Authenticates the device, by session resumption or by credentials
+    3. Creates an AndroidDevice instance with the authenticated information
+    4. Issues a ticket so the device can resume the session if it reconnects
+    5. Serves bulk transfers on an L2CAP channel until the device disconnects
 
-    This asynchronous function waits for the connection to be disconnected and then
-    performs a soft reset of the machine. It's designed to handle unexpected
-    disconnections and restart the system to maintain operational status.
+    If the credentials are wrong, or an unexpected error occurs, the connection is dropped.
 
     Parameters:
-    connection (object): The connection object to monitor. It must have a 'disconnected'
-                         method that can be awaited.
+    session (DeviceSession): The session of the connection to serve.
 
     Returns:
     None
+    """
+    connection = session.connection
+    try:
+        await RunService.negotiate_mtu(session)
+        credentials = await AuthService.authenticate(session)
+        if credentials is None:
+            await connection.disconnect()
+            return
+        username, password, token = credentials
+        session.android_device = AndroidDevice(username, password, session.mac_address, token)
+        log_info(session.mac_address, "authenticated successfully!")
+        AuthService.issue_ticket(session)
+        await BulkService.serve(session)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log_warn("Session failed:", e)
+        await connection.disconnect()
+
+
+async def supervise_connection(session, slot_freed):
+    """
+    Serves a connection until it is lost, then discards its session.
+
+    Parameters:
+    session (DeviceSession): The session of the new connection.
+    slot_freed (asyncio.Event): Set once the session is closed, so main() can accept
+        another connection.
 
-    Note:
-    This function does not return as it triggers a soft reset upon disconnection.
+    Returns:
+    None
     """
-    await connection.disconnected(timeout_ms=None)
-    print("Connection lost, performing soft reset.")
-    machine.soft_reset()
+    serving = asyncio.create_task(serve_connection(session))
+    await session.connection.disconnected(timeout_ms=None)
+    serving.cancel()
+    log_info("Connection lost:", session.mac_address)
+    AuthService.close_session(session)
+    RunService.close_session(session)
+    slot_freed.set()
 
 
-async def main():
+async def serve_commands():
+    """
+    Runs the command loop shared by all sessions, restarting it if it fails.
+
+    Without it no device could send a command, not even STOP, so an error the loop
+    doesn't handle stops the program and the loop is started again after a short pause.
+
+    Parameters:
+    None
+
+    Returns:
+    None
     """
-    Main asynchronous function that handles the authentication and command execution process.
+    while True:
+        try:
+            await RunService.handle_commands()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_error("Command loop failed, restarting:", repr(e))
+            RunService.execute("STOP")
+            await asyncio.sleep_ms(_RESTART_DELAY_MS)
+
 
-    This function performs the following steps:
-    1. Searches for a BLE connection
-    2. Sets up a connection monitor
-    3. Handles the authentication request
-    4. Creates an AndroidDevice instance with the authenticated information
-    5. Handles incoming commands from the authenticated device
+async def main():
+    """
+    Main asynchronous function that accepts connections from several devices.
+
+    This function starts the services shared by all connections (routing of the
+    authentication writes, the command loop, log flushing and diagnostics), then performs
+    the following steps forever:
+    1. Waits until fewer than MAX_CONNECTIONS devices are connected
+    2. Advertises and waits for a BLE connection
+    3. Opens a session for it and supervises it in its own task
+
+    Each connected device has its own session, so a clinician's tablet and a patient's
+    phone can be connected and authenticated at the same time, and responses are only
+    notified to the device that sent the command. The registered GATT services, imported
+    modules and preallocated buffers are kept across connections, so a reconnect does not
+    pay for a soft reset and boot. Log records are printed by a background task, so the
+    UART never delays a command, and another task keeps the command latency statistics
+    readable from the diagnostics characteristic.
 
     Parameters:
     None
@@ -47,14 +120,19 @@ async def main():
     Raises:
     Any exceptions raised by the called asynchronous functions.
     """
-    connection = await AuthService.search_for_connection()
-    asyncio.create_task(monitor_connection(connection))
-    print("Connection from", connection.device)
-    username, password, token = await AuthService.handle_auth_request(connection)
-    mac_address = ":".join(f"{byte:02x}" for byte in connection.device.addr)
-    android_device = AndroidDevice(username, password, mac_address, token)
-    print(mac_address, "authenticated successfully!")
-    await RunService.handle_command(connection, android_device)
+    log.start_flush_task()
+    asyncio.create_task(RunService.publish_diagnostics())
+    asyncio.create_task(serve_commands())
+    AuthService.start()
+    slot_freed = asyncio.Event()
+    while True:
+        while AuthService.session_count() >= MAX_CONNECTIONS:
+            slot_freed.clear()
+            await slot_freed.wait()
+        connection = await AuthService.search_for_connection()
+        log_info("Connection from", connection.device)
+        session = AuthService.open_session(connection)
+        asyncio.create_task(supervise_connection(session, slot_freed))
 
 
 """
@@ -0,0 +1,171 @@
+"""
+Notifications to one connection, with backpressure from the Bluetooth controller.
+
+gatts_notify() only hands a packet to the controller, which holds a few of them per
+connection until the next connection events. When those buffers are full it fails with
+ENOMEM, and a caller that notifies in a loop (fragments of a long reply, a burst of
+pipelined command replies) would lose the packet. A NotificationQueue sends immediately
+when nothing is waiting, and otherwise keeps the notification in a bounded ring that a
+background task retries every _RETRY_DELAY_MS, in order, until the controller accepts it.
+
+Status values that supersede each other can be queued with coalesce=True: a newer value
+replaces the queued one of the same characteristic instead of taking another slot, so a
+fast producer only ever sends the latest state.
+"""
+
+from micropython import const
+import asyncio
+import errno
+from log import log_warn
+
+_RETRY_DELAY_MS = const(5)
+# Give up on a notification after this many failed attempts (about a second).
+_MAX_ATTEMPTS = const(200)
+
+
+class NotificationQueue:
+    """
+    A bounded, ordered queue of notifications to one connection.
+    """
+
+    def __init__(self, connection, size=8):
+        """
+        Initialize a NotificationQueue instance.
+
+        Args:
+            connection (DeviceConnection): The connection notified.
+            size (int): The number of notifications that can wait for the controller.
+        """
+        self._connection = connection
+        self._size = size
+        self._characteristics = [None] * size
+        self._values = [None] * size
+        self._coalesce = bytearray(size)
+        self._head = 0
+        self._count = 0
+        self._attempts = 0
+        self._ready = asyncio.ThreadSafeFlag()
+        self._room = asyncio.Event()
+        self._task = None
+        # Notifications accepted by the controller, failed attempts that were retried,
+        # notifications given up on, and values replaced by a newer one before being sent.
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, characteristic):
+        for i in range(self._count):
+            slot = (self._head + i) % self._size
+            if self._characteristics[slot] is characteristic and self._coalesce[slot]:
+                return slot
+        return -1
+
+    def notify(self, characteristic, value, coalesce=False):
+        """
+        Send a notification, or queue it if the controller can't take it now.
+
+        Args:
+            characteristic (Characteristic): The characteristic notified.
+            value (bytes or memoryview): The value. It is copied if it has to be queued.
+            coalesce (bool): Replace a queued value of the same characteristic that was
+                also queued with coalesce=True, rather than sending both.
+
+        Returns:
+            bool: False if the queue was full or the connection is gone, and the
+                notification was dropped.
+        """
+        if coalesce:
+            slot = self._find(characteristic)
+            if slot >= 0:
+                self._values[slot] = bytes(value)
+                self.coalesced += 1
+                return True
+
+        if not self._connection.is_connected():
+            self.dropped += 1
+            return False
+        if not self._count:
+            try:
+                characteristic.notify(self._connection, value)
+                self.sent += 1
+                return True
+            except OSError as e:
+                if e.args[0] in (errno.ENOTCONN, errno.EINVAL):
+                    # The connection is gone (the disconnect is handled by its owner), which
+                    # is no fault of the caller's.
+                    self.dropped += 1
+                    return False
+                if e.args[0] != errno.ENOMEM:
+                    raise
+                self.retried += 1
+        elif self._count == self._size:
+            self.dropped += 1
+            log_warn("Notification queue full, dropping notification")
+            return False
+
+        slot = (self._head + self._count) % self._size
+        self._characteristics[slot] = characteristic
+        self._values[slot] = bytes(value)
+        self._coalesce[slot] = coalesce
+        self._count += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._ready.set()
+        return True
+
+    async def send(self, characteristic, value, coalesce=False):
+        """
+        Send a notification, waiting for room in the queue if it is full.
+
+        Args:
+            characteristic (Characteristic): The characteristic notified.
+            value (bytes or memoryview): The value.
+            coalesce (bool): See notify().
+        """
+        while self._count == self._size and not (coalesce and self._find(characteristic) >= 0):
+            self._room.clear()
+            await self._room.wait()
+        self.notify(characteristic, value, coalesce)
+
+    def _pop(self):
+        self._characteristics[self._head] = None
+        self._values[self._head] = None
+        self._head = (self._head + 1) % self._size
+        self._count -= 1
+        self._attempts = 0
+        self._room.set()
+
+    async def _run(self):
+        while True:
+            while not self._count:
+                await self._ready.wait()
+            head = self._head
+            try:
+                self._characteristics[head].notify(self._connection, self._values[head])
+            except OSError as e:
+                self._attempts += 1
+                if e.args[0] == errno.ENOMEM and self._attempts < _MAX_ATTEMPTS:
+                    self.retried += 1
+                    await asyncio.sleep_ms(_RETRY_DELAY_MS)
+                    continue
+                log_warn("Notification dropped:", e)
+                self.dropped += 1
+                self._pop()
+                continue
+            self.sent += 1
+            self._pop()
+
+    def close(self):
+        """
+        Stop sending and discard the queued notifications, once the connection is gone.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.dropped += self._count
+        while self._count:
+            self._pop()
@@ -0,0 +1,140 @@
+"""
+Framing of replies that are longer than one notification.
+
+A reply that fits in a single notification (ATT_MTU - 3 bytes) is sent unchanged, so
+ordinary replies still cost exactly one packet. Longer replies are split into fragments,
+each starting with a one-byte header:
+
+    bits 7-5  0b111 (FRAGMENT_MARKER)
+    bit 4     set on the last fragment of the reply (FRAGMENT_LAST)
+    bit 3     set on the first fragment of the reply (FRAGMENT_FIRST)
+    bits 2-0  fragment index, modulo 8, to detect lost fragments
+
+Unfragmented replies are either ASCII text or binary protocol frames (first byte
+0x80-0xBF, see command_protocol), so they can never be mistaken for a fragment.
+"""
+
+from micropython import const
+
+FRAGMENT_MARKER = const(0xE0)
+FRAGMENT_LAST = const(0x10)
+FRAGMENT_FIRST = const(0x08)
+_MARKER_MASK = const(0xE0)
+_INDEX_MASK = const(0x07)
+
+# Payload size of a notification at the default ATT MTU of 23.
+DEFAULT_PAYLOAD_SIZE = const(20)
+
+
+def is_fragment(notification):
+    """
+    Check whether a received notification is a fragment of a longer reply.
+
+    Args:
+        notification (bytes): The notified value.
+
+    Returns:
+        bool: True if it starts with a fragment header.
+    """
+    return len(notification) > 0 and notification[0] & _MARKER_MASK == FRAGMENT_MARKER
+
+
+class ResponseFramer:
+    """
+    Splits replies into notification-sized fragments in a preallocated buffer.
+    """
+
+    def __init__(self, max_payload_size):
+        """
+        Initialize a ResponseFramer instance.
+
+        Args:
+            max_payload_size (int): The largest notification payload that will be
+                requested, i.e. the largest supported ATT_MTU - 3.
+        """
+        self._buf = bytearray(max_payload_size)
+        self._mv = memoryview(self._buf)
+
+    def fragments(self, data, payload_size):
+        """
+        Generate the notifications that carry a reply.
+
+        Args:
+            data (bytes): The reply.
+            payload_size (int): The largest notification payload of the connection.
+
+        Yields:
+            bytes or memoryview: The reply itself if it fits in one notification, otherwise
+                each fragment in turn. Fragments refer to the internal buffer and are only
+                valid until the next one is generated.
+        """
+        n = len(data)
+        if n <= payload_size:
+            yield data
+            return
+
+        step = min(payload_size, len(self._buf)) - 1
+        mv = memoryview(data)
+        index = 0
+        for start in range(0, n, step):
+            end = min(start + step, n)
+            header = FRAGMENT_MARKER | (index & _INDEX_MASK)
+            if start == 0:
+                header |= FRAGMENT_FIRST
+            if end == n:
+                header |= FRAGMENT_LAST
+            self._buf[0] = header
+            self._buf[1 : 1 + end - start] = mv[start:end]
+            yield self._mv[: 1 + end - start]
+            index += 1
+
+
+class ResponseAssembler:
+    """
+    Reassembles replies from received notifications, for the receiving side.
+    """
+
+    def __init__(self):
+        """
+        Initialize a ResponseAssembler instance.
+        """
+        self._parts = []
+        self._next_index = 0
+
+    def feed(self, notification):
+        """
+        Add a received notification.
+
+        Args:
+            notification (bytes): The notified value.
+
+        Returns:
+            bytes or None: The complete reply once its last fragment (or an unfragmented
+                reply) has been received, None while fragments are missing.
+
+        Raises:
+            ValueError: If a fragment was lost or arrived out of order. The partial reply
+                is discarded.
+        """
+        if not is_fragment(notification):
+            self._parts = []
+            self._next_index = 0
+            return bytes(notification)
+
+        header = notification[0]
+        if header & FRAGMENT_FIRST:
+            # A new reply starts, even if the previous one was cut short.
+            self._parts = []
+            self._next_index = 0
+        elif header & _INDEX_MASK != self._next_index & _INDEX_MASK:
+            self._parts = []
+            self._next_index = 0
+            raise ValueError("Missing fragment")
+        self._parts.append(bytes(notification[1:]))
+        self._next_index += 1
+        if not header & FRAGMENT_LAST:
+            return None
+        reply = b"".join(self._parts)
+        self._parts = []
+        self._next_index = 0
+        return reply
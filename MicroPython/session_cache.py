@@ -0,0 +1,95 @@
+from micropython import const
+import os
+import time
+
+_TICKET_SIZE = const(16)
+
+
+class SessionCache:
+    """
+    A small bounded cache of authenticated sessions that can be resumed.
+
+    Each entry is keyed by the peer's MAC address and holds a random ticket, the
+    hashed credentials and the token of the session, and an expiry time. A device
+    that reconnects before the entry expires can present its ticket instead of
+    going through the full username/password handshake.
+    """
+
+    def __init__(self, size=4, ttl_ms=600_000):
+        """
+        Initialize a SessionCache instance.
+
+        Args:
+            size (int): Maximum number of sessions kept. When full, the session closest
+                to expiring is evicted.
+            ttl_ms (int): How long in milliseconds a ticket stays valid after it is issued.
+        """
+        self._size = size
+        self._ttl_ms = ttl_ms
+        # mac_address -> (ticket, expiry_ticks_ms, username, password, token)
+        self._sessions = {}
+
+    def issue(self, mac_address, username, password, token):
+        """
+        Store an authenticated session and create a ticket for resuming it.
+
+        Any previous ticket for the same device is replaced.
+
+        Args:
+            mac_address (str): The address of the authenticated device.
+            username (str): The hashed username of the session.
+            password (str): The hashed password of the session.
+            token (str): The command token of the session.
+
+        Returns:
+            bytes: The new ticket.
+        """
+        self._sessions.pop(mac_address, None)
+        self._expire()
+        if len(self._sessions) >= self._size:
+            now = time.ticks_ms()
+            oldest = min(
+                self._sessions, key=lambda mac: time.ticks_diff(self._sessions[mac][1], now)
+            )
+            del self._sessions[oldest]
+
+        ticket = os.urandom(_TICKET_SIZE)
+        expiry = time.ticks_add(time.ticks_ms(), self._ttl_ms)
+        self._sessions[mac_address] = (ticket, expiry, username, password, token)
+        return ticket
+
+    def resume(self, mac_address, ticket):
+        """
+        Redeem a ticket. A ticket can only be used once.
+
+        Args:
+            mac_address (str): The address of the device presenting the ticket.
+            ticket (bytes): The presented ticket.
+
+        Returns:
+            tuple or None: (username, password, token) of the cached session if the
+            ticket matches an unexpired session of this device, None otherwise.
+        """
+        self._expire()
+        entry = self._sessions.get(mac_address)
+        if entry is None or entry[0] != bytes(ticket):
+            return None
+        del self._sessions[mac_address]
+        return entry[2], entry[3], entry[4]
+
+    def forget(self, mac_address):
+        """
+        Remove the session of a device, e.g. after an explicit logout.
+
+        Args:
+            mac_address (str): The address of the device.
+        """
+        self._sessions.pop(mac_address, None)
+
+    def _expire(self):
+        now = time.ticks_ms()
+        expired = [
+            mac for mac, entry in self._sessions.items() if time.ticks_diff(entry[1], now) <= 0
+        ]
+        for mac in expired:
+            del self._sessions[mac]
@@ -0,0 +1,120 @@
+"""
+Host-side simulation of the firmware's MicroPython environment.
+
+Calling `install()` registers stand-ins for the `bluetooth`, `micropython`
+and `machine` modules, adds the MicroPython-only parts of `asyncio` and
+`time` that the firmware relies on, and injects a simulated radio as the
+BLE backend. After that, `aioble`, `ble_services` and `Models` import and
+run unmodified under CPython:
+
+    import sim
+    radio = sim.install()
+
+    async def run():
+        import ble_services   # registers the GATT services on `radio`
+        ...
+
+Modules that create tasks at import time (e.g. `ble_services`) must be
+imported from inside a running event loop.
+
+This package is for host testing only and is not copied to the board.
+"""
+
+import asyncio
+import sys
+import time
+
+from .radio import SimBLE
+
+
+class ThreadSafeFlag:
+    """
+    Equivalent of MicroPython's asyncio.ThreadSafeFlag: a single-waiter
+    event that is cleared when a wait() completes.
+    """
+
+    def __init__(self):
+        self._flag = False
+        self._waiter = None
+
+    def set(self):
+        self._flag = True
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        if not self._flag:
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        self._flag = False
+
+
+async def _sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+_TICKS_PERIOD = 1 << 30
+
+
+def _ticks_ms():
+    return (time.perf_counter_ns() // 1_000_000) % _TICKS_PERIOD
+
+
+def _ticks_us():
+    return (time.perf_counter_ns() // 1_000) % _TICKS_PERIOD
+
+
+def _ticks_diff(end, start):
+    return ((end - start + _TICKS_PERIOD // 2) % _TICKS_PERIOD) - _TICKS_PERIOD // 2
+
+
+def _ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+
+def install(radio=None):
+    """
+    Install the simulated MicroPython environment.
+
+    Must be called before `aioble` (or anything importing it) is imported,
+    since aioble binds to `bluetooth.BLE()` at import time.
+
+    Args:
+        radio (SimBLE, optional): The BLE backend to inject. A default
+            SimBLE is created if not given.
+
+    Returns:
+        SimBLE: The injected radio.
+    """
+    from . import bluetooth, machine, micropython
+
+    radio = radio or SimBLE()
+    bluetooth._radio = radio
+
+    if sys.implementation.name == "micropython":
+        # The unix port, for tools/boot_bench.py: only the hardware modules are missing.
+        sys.modules["bluetooth"] = bluetooth
+        sys.modules["machine"] = machine
+        return radio
+
+    sys.modules["bluetooth"] = bluetooth
+    sys.modules["micropython"] = micropython
+    sys.modules["machine"] = machine
+
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+    asyncio.sleep_ms = _sleep_ms
+
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = _ticks_add
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1_000_000)
+
+    return radio
@@ -0,0 +1,72 @@
+"""
+Host stand-in for the MicroPython `bluetooth` module.
+
+`BLE()` returns the simulated radio installed by `sim.install()`, so aioble
+binds to it exactly as it would bind to the on-chip controller.
+"""
+
+import binascii
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+_radio = None
+
+
+def BLE():
+    """
+    Get the BLE singleton.
+
+    Returns:
+        SimBLE: The simulated radio registered with sim.install().
+    """
+    if _radio is None:
+        raise OSError("No simulated radio installed")
+    return _radio
+
+
+class UUID:
+    """
+    A 16, 32 or 128-bit Bluetooth UUID, stored little-endian like the
+    firmware's bluetooth.UUID.
+    """
+
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            self._bytes = value._bytes
+        elif isinstance(value, int):
+            if not 0 <= value <= 0xFFFF:
+                raise ValueError("invalid UUID")
+            self._bytes = value.to_bytes(2, "little")
+        elif isinstance(value, str):
+            raw = binascii.unhexlify(value.replace("-", ""))
+            if len(raw) != 16:
+                raise ValueError("invalid UUID")
+            self._bytes = bytes(reversed(raw))
+        else:
+            raw = bytes(value)
+            if len(raw) not in (2, 4, 16):
+                raise ValueError("invalid UUID")
+            self._bytes = raw
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._bytes)
+
+    def __eq__(self, rhs):
+        return isinstance(rhs, UUID) and self._bytes == rhs._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) == 16:
+            h = binascii.hexlify(bytes(reversed(self._bytes))).decode()
+            return "UUID('{}-{}-{}-{}-{}')".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+        value = int.from_bytes(self._bytes, "little")
+        return "UUID(0x{:0{}x})".format(value, len(self._bytes) * 2)
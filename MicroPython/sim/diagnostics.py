@@ -0,0 +1,66 @@
+"""
+Decoder for the RUN service diagnostics characteristic.
+
+Prints the command latency statistics read from a device, given as the hex value of
+the characteristic (e.g. copied from a BLE explorer app), or produced by running the
+load test on the simulated radio when no value is given.
+
+Usage (from the MicroPython directory):
+    python -m sim.diagnostics [HEX] [--commands N] [--binary]
+"""
+
+import argparse
+import asyncio
+import binascii
+import contextlib
+import os
+import sys
+
+import sim
+
+
+_ROW = "{:<10}{:>8}{:>10}{:>10}{:>10}{:>10}"
+
+
+def report(stats):
+    print(_ROW.format("stage", "count", "p50", "p95", "p99", "max"))
+    for row in stats:
+        print(_ROW.format(*row))
+    print("latencies in microseconds")
+
+
+async def read_after_load(commands, binary):
+    from sim.loadtest import run
+    from assets.ble_services_UUID import RUN_DIAGNOSTICS
+
+    await run(commands, 23, 4, binary)
+    import bluetooth
+    import ble_services
+
+    radio = bluetooth.BLE()
+
+    ble_services.RunService.update_diagnostics()
+    return bytes(radio.gatts_read(radio.handle(RUN_DIAGNOSTICS)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("value", nargs="?", help="characteristic value as hex")
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sim.install()
+    import latency
+
+    if args.value:
+        value = binascii.unhexlify(args.value.replace(" ", "").replace(":", ""))
+    else:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            value = asyncio.run(read_after_load(args.commands, args.binary))
+    report(latency.decode(value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+Start time skew test for the hub controller on the simulated radio.
+
+Plays several garments (SimPeripherals that answer the AUTH and RUN services the way the
+firmware does), lets a Hub find, log in to and load a program on all of them, then starts
+the program repeatedly and measures how far apart the garments actually started: with the
+hub's synchronized RUN, and with a plain RUN sent to all of them at once for comparison.
+A decoy advertising another name and a garment with other credentials must be left out.
+
+Then the hub is restarted and reconnects to the garments several times, to measure what
+its GATT table cache saves: without the cache, with an empty one, with the one saved by
+the previous hub, and after one garment got a firmware update changing its table.
+
+Usage (from the MicroPython directory):
+    python -m sim.hubtest [--garments N] [--runs N] [--interval-ms MS] [--seed N]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import sim
+from sim.bluetooth import FLAG_READ, FLAG_WRITE, FLAG_NOTIFY, UUID
+from sim.peripheral import SimPeripheral
+from sim.loadtest import percentile
+
+_USERNAME = "clinic"
+_PASSWORD = "secret"
+
+_PROGRAM = {
+    "muscle": "BICEPS",
+    "frequency": 1000,
+    "pulseWidth": 300,
+    "stimulationType": "EMS",
+    "onTime": 2,
+    "offTime": 4,
+    "duration": 20,
+}
+
+
+class FakeGarment(SimPeripheral):
+    """
+    A garment's AUTH and RUN services, as seen over the air by a hub.
+
+    Like the firmware, it advertises a hash of its GATT table. A revision other than 0
+    plays a firmware update that adds a characteristic, which moves the handles.
+
+    Attributes:
+        starts (list): The event loop time at which each RUN started the program.
+    """
+
+    def __init__(self, index, name, password, seed, revision=0):
+        import aioble
+        import command_protocol
+        from assets.ble_services_UUID import (
+            AUTH_SERVICE,
+            AUTH_USERNAME,
+            AUTH_PASSWORD,
+            AUTH_TOKEN,
+            AUTH_RESPONSE,
+            AUTH_RESUME,
+            RUN_SERVICE,
+            RUN_COMMAND,
+            RUN_RESPONSE,
+        )
+        from assets.bluetooth_conf import ENV_SERVICE, GENERIC_VALUE, GATT_CACHE_COMPANY_ID
+
+        services = (
+            (
+                AUTH_SERVICE,
+                ((UUID(0x2A26), FLAG_READ),) * revision
+                + (
+                    (AUTH_USERNAME, FLAG_WRITE | FLAG_NOTIFY),
+                    (AUTH_PASSWORD, FLAG_WRITE | FLAG_NOTIFY),
+                    (AUTH_TOKEN, FLAG_READ | FLAG_NOTIFY),
+                    (AUTH_RESPONSE, FLAG_READ | FLAG_WRITE | FLAG_NOTIFY),
+                    (AUTH_RESUME, FLAG_READ | FLAG_WRITE | FLAG_NOTIFY),
+                ),
+            ),
+            (
+                RUN_SERVICE,
+                (
+                    (RUN_COMMAND, FLAG_WRITE | FLAG_NOTIFY),
+                    (RUN_RESPONSE, FLAG_READ | FLAG_NOTIFY),
+                ),
+            ),
+        )
+        table_hash = hashlib.sha256(repr(services).encode()).digest()[:4]
+        adv_data, resp_data = aioble.advertising_payload(
+            name=name,
+            services=[ENV_SERVICE],
+            appearance=GENERIC_VALUE,
+            manufacturer=(GATT_CACHE_COMPANY_ID, table_hash),
+        )
+        super().__init__(
+            bytes((0x24, 0x0A, 0xC4, 0x00, 0x10, index)),
+            services,
+            adv_data,
+            resp_data,
+            seed=seed,
+        )
+        self._protocol = command_protocol
+        self._password = password.encode()
+        self._username_handle = self.handle(AUTH_USERNAME)
+        self._password_handle = self.handle(AUTH_PASSWORD)
+        self._token_handle = self.handle(AUTH_TOKEN)
+        self._response_handle = self.handle(AUTH_RESPONSE)
+        self._resume_handle = self.handle(AUTH_RESUME)
+        self._command_handle = self.handle(RUN_COMMAND)
+        self._reply_handle = self.handle(RUN_RESPONSE)
+        self._token = "{:064x}".format(index + 1)
+        self.starts = []
+        self.on_connect()
+
+    def on_connect(self):
+        self._username = None
+        self._authenticated = False
+        self._session_id = None
+        self._text = b""
+
+    def on_write(self, value_handle, data):
+        protocol = self._protocol
+        if value_handle == self._username_handle:
+            self._username = data
+        elif value_handle == self._password_handle:
+            if self._username != _USERNAME.encode() or data != self._password:
+                # Like the firmware, give up on a device with wrong credentials.
+                self.disconnect()
+                return
+            self.set_value(self._token_handle, self._token.encode())
+            self.notify(self._token_handle, self._token.encode())
+        elif value_handle == self._response_handle and data == b"OK":
+            self._authenticated = True
+            self.set_value(self._resume_handle, b"ticket")
+            self.notify(self._resume_handle, b"ticket")
+        elif value_handle == self._command_handle and self._authenticated:
+            if protocol.is_binary(data):
+                offset = 0
+                while offset < len(data):
+                    opcode, session_id, info, offset = protocol.decode(data, offset)
+                    if opcode == protocol.OP_RUN:
+                        loop = asyncio.get_event_loop()
+                        self.starts.append(loop.time() + info / 1000)
+                    self.notify(
+                        self._reply_handle, protocol.encode_response(opcode, protocol.STATUS_OK)
+                    )
+                return
+            self._text += data
+            if self._text.endswith(b"\n"):
+                request = json.loads(self._text)
+                self._text = b""
+                if request["token"] == self._token and request["command"] == "PROTOCOL":
+                    self._session_id = 0x1234 + self.addr[-1]
+                    reply = "PROTOCOL 1 {:08x}".format(self._session_id).encode()
+                    self.notify(self._reply_handle, reply)
+
+
+def spread_ms(garments):
+    """
+    Get how far apart the last starts of the garments were, in milliseconds.
+    """
+    starts = [garment.starts[-1] for garment in garments]
+    return (max(starts) - min(starts)) * 1000
+
+
+async def reconnect(radio, garments, interval_ms, cache_path):
+    """
+    Connect a new hub to the garments, as after a restart of the hub.
+
+    Returns:
+        tuple: (garments connected, milliseconds until they all were logged in,
+            discovery procedures run).
+    """
+    from hub import Hub
+
+    loop = asyncio.get_event_loop()
+    hub = Hub(
+        _USERNAME,
+        _PASSWORD,
+        len(garments),
+        conn_interval_us=int(interval_ms * 1000),
+        cache_path=cache_path,
+    )
+    discoveries = radio.stats["gattc_discoveries"]
+    start = loop.time()
+    while len(hub.garments) < len(garments):
+        if not await hub.fill(2000):
+            break
+    elapsed_ms = (loop.time() - start) * 1000
+    result = (len(hub.garments), elapsed_ms, radio.stats["gattc_discoveries"] - discoveries)
+    await hub.close()
+    return result
+
+
+async def run(count, runs, interval_ms, seed):
+    radio = sim.install()
+    radio.active(True)
+    import command_protocol
+    from hub import Hub, HubError
+
+    garments = [
+        FakeGarment(i, "Febina EMS {}".format(10000 + i), _PASSWORD, seed + i)
+        for i in range(count)
+    ]
+    decoy = FakeGarment(count, "Other EMS", _PASSWORD, seed + count)
+    impostor = FakeGarment(count + 1, "Febina EMS 666", "other", seed + count + 1)
+    for peripheral in garments + [decoy, impostor]:
+        radio.add_peripheral(peripheral)
+
+    hub = Hub(
+        _USERNAME,
+        _PASSWORD,
+        count + 1,
+        conn_interval_us=int(interval_ms * 1000),
+        cache_path=None,
+    )
+    while len(hub.garments) < count:
+        if not await hub.fill(2000):
+            break
+    connected = [g for g in garments if g.conn_handle is not None]
+    leaked = [p for p in (decoy, impostor) if p.conn_handle is not None]
+    await hub.set(_PROGRAM)
+
+    synchronized = []
+    bounds = []
+    plain = []
+    aborted = 0
+    for _ in range(runs):
+        try:
+            bounds.append(await hub.run())
+            synchronized.append(spread_ms(connected))
+        except HubError:
+            # The hub stopped the garments, since it couldn't bound the skew.
+            aborted += 1
+        await hub.stop()
+        await asyncio.gather(
+            *[garment.command(command_protocol.OP_RUN) for garment in hub.garments]
+        )
+        plain.append(spread_ms(connected))
+        await hub.stop()
+    await hub.close()
+
+    radio.remove_peripheral(decoy)
+    radio.remove_peripheral(impostor)
+    reconnects = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "gatt_cache.json")
+        for label, cache_path in (("no cache", None), ("empty cache", path), ("cached", path)):
+            reconnects.append((label,) + await reconnect(radio, garments, interval_ms, cache_path))
+        garments[0] = FakeGarment(0, "Febina EMS 10000", _PASSWORD, seed, revision=1)
+        radio.add_peripheral(garments[0])
+        reconnects.append(
+            ("one updated",) + await reconnect(radio, garments, interval_ms, path)
+        )
+    return len(connected), len(leaked), synchronized, bounds, plain, aborted, reconnects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--garments", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--interval-ms", type=float, default=15, help="connection interval")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep firmware prints")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        result = asyncio.run(run(args.garments, args.runs, args.interval_ms, args.seed))
+    connected, leaked, synchronized, bounds, plain, aborted, reconnects = result
+
+    print(
+        "garments:        {} of {} connected, {} wrong devices connected".format(
+            connected, args.garments, leaked
+        )
+    )
+    print("runs:            {} ({} aborted, skew bound too large)".format(args.runs, aborted))
+    for label, values in (
+        ("synchronized ms", synchronized),
+        ("hub bound ms", bounds),
+        ("plain RUN ms", plain),
+    ):
+        values = sorted(values)
+        if not values:
+            continue
+        print(
+            "{:<16} p50 {:.1f}  p95 {:.1f}  max {:.1f}".format(
+                label + ":", *(percentile(values, p) for p in (50, 95, 100))
+            )
+        )
+    for label, reconnected, elapsed_ms, discoveries in reconnects:
+        print(
+            "{:<16} {} garments logged in after {:.0f} ms, {} discovery procedures".format(
+                label + ":", reconnected, elapsed_ms, discoveries
+            )
+        )
+    violated = sum(1 for actual, bound in zip(synchronized, bounds) if actual > bound + 1)
+    # With the cache, a reconnect discovers nothing, and only the updated garment's table.
+    missed = any(r[1] < args.garments for r in reconnects) or reconnects[2][3] != 0
+    return 1 if connected < args.garments or leaked or violated or missed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
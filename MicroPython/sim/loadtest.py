@@ -0,0 +1,186 @@
+"""
+Load test for the RUN service on the simulated radio.
+
+Connects a simulated phone, then streams SET/RUN commands into
+`RunService.handle_commands` the way the app does (newline-terminated
+payloads split into ATT-sized chunks) and reports throughput and
+first-chunk-to-notification latency.
+
+Usage (from the MicroPython directory):
+    python -m sim.loadtest [--commands N] [--mtu MTU] [--yields N] [--binary] [--verbose]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+
+import sim
+
+_INFO = json.dumps(
+    {
+        "muscle": "BICEPS",
+        "frequency": 1000,
+        "pulseWidth": 300,
+        "stimulationType": "EMS",
+        "onTime": 2,
+        "offTime": 4,
+        "duration": 20,
+    }
+)
+
+
+def percentile(sorted_values, pct):
+    """
+    Get the pct-th percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+def encode_command(token, command):
+    """
+    Build the newline-terminated JSON payload the app sends for a command.
+    """
+    return (json.dumps({"token": token, "command": command, "info": _INFO}) + "\n").encode()
+
+
+def encode_binary_command(session_id, command):
+    """
+    Build a binary protocol frame for a command.
+    """
+    import command_protocol
+
+    opcode = command_protocol.OP_SET if command == "SET" else command_protocol.OP_RUN
+    return command_protocol.encode(opcode, session_id, json.loads(_INFO))
+
+
+def expected_binary_reply(command):
+    import command_protocol
+
+    opcode = command_protocol.OP_SET if command == "SET" else command_protocol.OP_RUN
+    return command_protocol.encode_response(opcode, command_protocol.STATUS_OK)
+
+
+async def connect(radio, mtu):
+    """
+    Advertise, connect a simulated central and return (connection, conn_handle).
+    """
+    from ble_services import AuthService
+
+    advertising = asyncio.create_task(AuthService.search_for_connection())
+    while radio.adv_interval_us is None:
+        await asyncio.sleep(0)
+    conn_handle = radio.central_connect(mtu=mtu)
+    if mtu > 23:
+        radio.central_exchange_mtu(conn_handle, mtu)
+    return await advertising, conn_handle
+
+
+async def run(commands, mtu, yields, binary):
+    radio = sim.install()
+    import ble_services
+    from assets.ble_services_UUID import RUN_COMMAND, RUN_RESPONSE
+    from Models import AndroidDevice
+
+    connection, conn_handle = await connect(radio, mtu)
+    token = "ab" * 32
+    device = AndroidDevice("user", "pass", connection.device.addr_hex(), token)
+
+    command_handle = radio.handle(RUN_COMMAND)
+    response_handle = radio.handle(RUN_RESPONSE)
+    pending = []
+
+    def on_notify(value_handle, data):
+        if value_handle == response_handle and pending and not pending[0].done():
+            pending[0].set_result(bytes(data))
+
+    radio.central_subscribe(conn_handle, response_handle, on_notify)
+    session = ble_services.AuthService.open_session(connection)
+    session.android_device = device
+    server = asyncio.create_task(ble_services.RunService.handle_commands())
+    chunk_size = connection.mtu - 3 if connection.mtu else 20
+
+    async def request(payload):
+        pending[:] = [asyncio.get_event_loop().create_future()]
+        for i in range(0, len(payload), chunk_size):
+            radio.central_write(conn_handle, command_handle, payload[i : i + chunk_size])
+            # The phone waits for the write response before the next chunk,
+            # which gives the peripheral `yields` event loop iterations.
+            for _ in range(yields):
+                await asyncio.sleep(0)
+        return await asyncio.wait_for(pending[0], 1)
+
+    session_id = None
+    if binary:
+        payload = json.dumps({"token": token, "command": "PROTOCOL", "version": 1}) + "\n"
+        session_id = int((await request(payload.encode())).split()[2], 16)
+
+    commands = ["RUN" if i % 2 else "SET" for i in range(commands)]
+    latencies = []
+    lost = errors = 0
+    start = time.perf_counter_ns()
+    for command in commands:
+        if binary:
+            payload = encode_binary_command(session_id, command)
+            expected = expected_binary_reply(command)
+        else:
+            payload = encode_command(token, command)
+            expected = command.encode()
+        t0 = time.perf_counter_ns()
+        try:
+            reply = await request(payload)
+        except asyncio.TimeoutError:
+            lost += 1
+            continue
+        latencies.append(time.perf_counter_ns() - t0)
+        if reply != expected:
+            errors += 1
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+
+    server.cancel()
+    ble_services.AuthService.close_session(session)
+    return radio.stats, latencies, lost, errors, elapsed, chunk_size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--mtu", type=int, default=23)
+    parser.add_argument(
+        "--yields", type=int, default=4, help="event loop iterations between chunk writes"
+    )
+    parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+    parser.add_argument("--verbose", action="store_true", help="keep firmware prints")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        result = asyncio.run(run(args.commands, args.mtu, args.yields, args.binary))
+    stats, latencies, lost, errors, elapsed, chunk_size = result
+
+    latencies.sort()
+    print(
+        "commands:   {} ({} lost, {} wrong replies), chunk size {}".format(
+            args.commands, lost, errors, chunk_size
+        )
+    )
+    print("writes:     {} ({:.0f}/s)".format(stats["writes"], stats["writes"] / elapsed))
+    print("throughput: {:.0f} commands/s".format(len(latencies) / elapsed))
+    print(
+        "latency us: p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+            *(percentile(latencies, p) / 1000 for p in (50, 95, 99, 100))
+        )
+    )
+    return 1 if lost or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Host stand-in for the MicroPython `machine` module.
+"""
+
+import time
+
+try:
+    import threading
+except ImportError:
+    # The unix MicroPython port (tools/boot_bench.py), where Timer can't be used.
+    threading = None
+
+
+class SoftReset(Exception):
+    """
+    Raised by soft_reset() so the host can observe a board reset instead of
+    the process being restarted.
+    """
+
+
+def soft_reset():
+    raise SoftReset
+
+
+def reset():
+    raise SoftReset
+
+
+class Pin:
+    """
+    A GPIO. Only remembers its configuration.
+    """
+
+    IN = 1
+    OUT = 3
+
+    def __init__(self, id, mode=None, value=None):
+        self.id = id
+        self.mode = mode
+
+
+class PWM:
+    """
+    A PWM output that records every change of its duty cycle.
+
+    Attributes:
+        events (list): (perf_counter_ns, duty_u16) for each call to duty_u16(), used to
+            measure the timing accuracy of the waveform engine on the host.
+    """
+
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+        self.events = []
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        self.events.append((time.perf_counter_ns(), value))
+
+    def deinit(self):
+        self._duty = 0
+
+
+class Timer:
+    """
+    A hardware timer, run on a host thread. Periodic callbacks are scheduled against
+    absolute deadlines so that lateness doesn't accumulate.
+    """
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=0):
+        self.id = id
+        self._thread = None
+        self._stop = None
+
+    def init(self, mode=PERIODIC, period=1000, callback=None):
+        self.deinit()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(mode, period, callback, self._stop), daemon=True
+        )
+        self._thread.start()
+
+    def deinit(self):
+        if self._stop:
+            self._stop.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+        self._stop = None
+        self._thread = None
+
+    def _run(self, mode, period, callback, stop):
+        deadline = time.perf_counter_ns()
+        while True:
+            deadline += period * 1_000_000
+            if stop.wait(max(0, deadline - time.perf_counter_ns()) / 1e9):
+                return
+            if callback:
+                callback(self)
+            if mode == Timer.ONE_SHOT or stop.is_set():
+                return
@@ -0,0 +1,31 @@
+"""
+Host stand-in for the MicroPython `micropython` module.
+
+Only the pieces used by the firmware are provided. Code emitters such as
+`native` and `viper` are no-ops so that decorated functions run as regular
+Python on the host.
+"""
+
+
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    func(arg)
+
+
+def native(func):
+    return func
+
+
+def viper(func):
+    return func
+
+
+def opt_level(level=None):
+    return 0
+
+
+def mem_info(*args):
+    pass
@@ -0,0 +1,197 @@
+"""
+Simulated remote peripherals, for the firmware in the central role.
+
+A SimPeripheral added to the radio with `SimBLE.add_peripheral()` advertises
+while the firmware scans, accepts a connection from `gap_connect()` and serves
+its GATT database to the `gattc_*` calls. Traffic on the link is timed by
+connection events, as on air: a request from the firmware goes out at the next
+event and its response comes back one interval later, and a notification goes
+out at the next event after it is sent. Subclasses play the device's firmware
+by overriding `on_write()`.
+"""
+
+import math
+import random
+
+from .bluetooth import UUID
+
+_FLAG_NOTIFY = 0x0010
+_FLAG_INDICATE = 0x0020
+
+_CCCD_UUID = UUID(0x2902)
+_CCCD_NOTIFY = 1
+
+
+class SimPeripheral:
+    """
+    A remote peripheral.
+
+    Handles are allocated like a GATT server does: the service declaration, then
+    for each characteristic its declaration, its value and, if it can notify or
+    indicate, its CCCD.
+
+    Args:
+        addr (bytes): The 6-byte address.
+        services (sequence): (uuid, ((uuid, flags), ...)) for each service, like
+            the definition passed to gatts_register_services().
+        adv_data (bytes): The advertising payload.
+        resp_data (bytes): The scan response payload, or None.
+        interval_ms (float): The connection interval, unless the firmware asks for
+            one in gap_connect().
+        adv_interval_ms (float): The advertising interval.
+        mtu (int): The largest ATT MTU the peripheral accepts.
+        addr_type (int): 0 for public, 1 for random addresses.
+        seed: Seed of the random phase of the connection events.
+    """
+
+    def __init__(
+        self,
+        addr,
+        services,
+        adv_data,
+        resp_data=None,
+        interval_ms=30,
+        adv_interval_ms=100,
+        mtu=247,
+        addr_type=0,
+        seed=None,
+    ):
+        self.addr = bytes(addr)
+        self.addr_type = addr_type
+        self.adv_data = bytes(adv_data)
+        self.resp_data = bytes(resp_data) if resp_data is not None else None
+        self.interval_ms = interval_ms
+        self.adv_interval_ms = adv_interval_ms
+        self.mtu = mtu
+        self.rng = random.Random(seed)
+
+        # (uuid, start handle, end handle) per service, and (service index, end
+        # handle, value handle, properties, uuid) per characteristic.
+        self.services = []
+        self.characteristics = []
+        self._values = {}
+        self._uuids = {}
+        # CCCD handle -> value handle, and the value handles with notifications on.
+        self._cccds = {}
+        self.subscriptions = set()
+
+        handle = 1
+        for index, (service_uuid, characteristics) in enumerate(services):
+            start = handle
+            handle += 1
+            for uuid, flags in characteristics:
+                value_handle = handle + 1
+                handle += 2
+                if flags & (_FLAG_NOTIFY | _FLAG_INDICATE):
+                    self._cccds[handle] = value_handle
+                    handle += 1
+                properties = flags & 0xFF
+                self.characteristics.append((index, handle - 1, value_handle, properties, uuid))
+                self._values[value_handle] = b""
+                self._uuids[value_handle] = uuid
+            self.services.append((service_uuid, start, handle - 1))
+
+        # Set by SimBLE while connected.
+        self.radio = None
+        self.conn_handle = None
+        self._anchor = 0.0
+
+    def handle(self, uuid):
+        """
+        Find the value handle of the first characteristic with this UUID.
+        """
+        for value_handle, value_uuid in self._uuids.items():
+            if value_uuid == uuid:
+                return value_handle
+        raise KeyError(uuid)
+
+    def value(self, value_handle):
+        return self._values[value_handle]
+
+    def set_value(self, value_handle, data):
+        self._values[value_handle] = bytes(data)
+
+    def notify(self, value_handle, data):
+        """
+        Send a notification to the firmware, if it is connected and subscribed.
+
+        Returns:
+            bool: Whether the notification was sent.
+        """
+        if self.conn_handle is None or value_handle not in self.subscriptions:
+            return False
+        self.radio._link_notify(self, value_handle, bytes(data))
+        return True
+
+    def disconnect(self):
+        """
+        Drop the connection from the peripheral's side.
+        """
+        if self.conn_handle is not None:
+            self.radio._link_down(self.conn_handle)
+
+    # --- Hooks for subclasses ---
+
+    def on_connect(self):
+        pass
+
+    def on_disconnect(self):
+        pass
+
+    def on_write(self, value_handle, data):
+        """
+        Handle a write from the firmware, when it reaches the peripheral.
+        """
+        self._values[value_handle] = bytes(data)
+
+    # --- Used by SimBLE ---
+
+    def event_after(self, now, events=1):
+        """
+        Get the time of the n-th connection event after now.
+
+        Args:
+            now (float): An event loop time, in seconds.
+            events (int): How many events later.
+
+        Returns:
+            float: The event loop time of that event.
+        """
+        interval = self.interval_ms / 1000
+        k = math.floor((now - self._anchor) / interval) + events
+        return self._anchor + k * interval
+
+    def _connected(self, radio, conn_handle, now):
+        self.radio = radio
+        self.conn_handle = conn_handle
+        self.subscriptions = set()
+        # The first connection event comes up to one interval after the connection.
+        self._anchor = now + self.rng.uniform(0, self.interval_ms / 1000)
+        self.on_connect()
+
+    def _disconnected(self):
+        self.conn_handle = None
+        self.subscriptions = set()
+        self.on_disconnect()
+
+    def _read(self, handle):
+        if handle in self._cccds:
+            subscribed = self._cccds[handle] in self.subscriptions
+            return bytes((_CCCD_NOTIFY if subscribed else 0, 0))
+        return self._values.get(handle)
+
+    def _writable(self, handle):
+        return handle in self._cccds or handle in self._values
+
+    def _write(self, handle, data):
+        if handle in self._cccds:
+            value_handle = self._cccds[handle]
+            if data and data[0] & _CCCD_NOTIFY:
+                self.subscriptions.add(value_handle)
+            else:
+                self.subscriptions.discard(value_handle)
+        elif handle in self._values:
+            self.on_write(handle, data)
+
+    def _descriptors(self, start, end):
+        return [(handle, _CCCD_UUID) for handle in self._cccds if start < handle <= end]
@@ -0,0 +1,719 @@
+"""
+In-process simulated BLE controller and GATT database.
+
+SimBLE implements the subset of the MicroPython `bluetooth.BLE` API that
+aioble uses in the peripheral role, and adds a `central_*` API so the host
+can play the part of the phone: connect, write, read, subscribe,
+receive notifications and open L2CAP channels. While the firmware scans,
+`advertiser_report()` plays the part of nearby advertisers. In the central
+role, the firmware connects to the SimPeripherals added with
+`add_peripheral()` (see sim/peripheral.py). IRQs are delivered synchronously
+to the handler registered with `irq()`, matching how the firmware sees them
+from the scheduler.
+"""
+
+import asyncio
+import errno
+
+_IRQ_CENTRAL_CONNECT = 1
+_IRQ_CENTRAL_DISCONNECT = 2
+_IRQ_GATTS_WRITE = 3
+_IRQ_GATTS_READ_REQUEST = 4
+_IRQ_SCAN_RESULT = 5
+_IRQ_SCAN_DONE = 6
+_IRQ_PERIPHERAL_CONNECT = 7
+_IRQ_PERIPHERAL_DISCONNECT = 8
+_IRQ_GATTC_SERVICE_RESULT = 9
+_IRQ_GATTC_SERVICE_DONE = 10
+_IRQ_GATTC_CHARACTERISTIC_RESULT = 11
+_IRQ_GATTC_CHARACTERISTIC_DONE = 12
+_IRQ_GATTC_DESCRIPTOR_RESULT = 13
+_IRQ_GATTC_DESCRIPTOR_DONE = 14
+_IRQ_GATTC_READ_RESULT = 15
+_IRQ_GATTC_READ_DONE = 16
+_IRQ_GATTC_WRITE_DONE = 17
+_IRQ_GATTC_NOTIFY = 18
+_IRQ_GATTS_INDICATE_DONE = 20
+_IRQ_MTU_EXCHANGED = 21
+_IRQ_L2CAP_CONNECT = 23
+_IRQ_L2CAP_DISCONNECT = 24
+_IRQ_L2CAP_RECV = 25
+
+_FLAG_NOTIFY = 0x0010
+_FLAG_INDICATE = 0x0020
+
+_DEFAULT_MTU = 23
+_DEFAULT_BUFFER_LEN = 20
+_ADV_PAYLOAD_MAX_LEN = 31
+
+_ATT_ERROR_INVALID_HANDLE = 0x01
+_REASON_TIMEOUT = 0x08
+
+
+class _Attribute:
+    def __init__(self, uuid, flags):
+        self.uuid = uuid
+        self.flags = flags
+        self.value = b""
+        self.max_len = _DEFAULT_BUFFER_LEN
+        self.append = False
+
+
+class _Connection:
+    def __init__(self, conn_handle, addr_type, addr, mtu):
+        self.conn_handle = conn_handle
+        self.addr_type = addr_type
+        self.addr = addr
+        self.mtu = _DEFAULT_MTU
+        self.peer_mtu = mtu
+        # Value handles the central has enabled notifications on.
+        self.subscriptions = set()
+        # Notifications/indications received by the central, as
+        # (value_handle, data) tuples, unless on_notify is set.
+        self.received = []
+        self.on_notify = None
+        # Controller TX buffer occupancy (released on the next loop tick).
+        self.tx_pending = 0
+        # L2CAP channel: (cid, psm, peripheral MTU, central MTU), data not yet
+        # read by the peripheral, and data sent to the central.
+        self.l2cap = None
+        self.l2cap_rx = bytearray()
+        self.l2cap_tx = bytearray()
+
+
+class SimBLE:
+    """
+    A simulated BLE radio.
+
+    Args:
+        mac (bytes): The 6-byte address reported by config("mac").
+        tx_slots (int or None): Number of notifications the controller can
+            buffer per connection before gatts_notify fails with ENOMEM, or
+            None for an unlimited buffer. Slots are freed on the next event
+            loop iteration, which stands in for a connection event.
+        max_mtu (int): The largest ATT MTU the simulated stack supports.
+    """
+
+    def __init__(self, mac=b"\x24\x0a\xc4\x00\x00\x01", tx_slots=None, max_mtu=512):
+        self._mac = bytes(mac)
+        self._tx_slots = tx_slots
+        self._max_mtu = max_mtu
+        self._active = False
+        self._irq = None
+        self._config = {"mtu": _DEFAULT_MTU, "gap_name": b"MPY ESP32"}
+        self._attributes = {}
+        self._next_handle = 1
+        self._connections = {}
+        self._next_conn_handle = 0
+
+        # Current advertising state, as passed to gap_advertise().
+        self.adv_interval_us = None
+        self.adv_data = None
+        self.resp_data = None
+        self.connectable = False
+        # Whether gap_scan() is running, and whether it is an active scan.
+        self.scanning = False
+        self.scan_active = False
+        self._scan_timer = None
+        # Incremented by every gap_scan(), so advertising of an earlier scan stops.
+        self._scan_generation = 0
+
+        # Remote peripherals by (addr_type, addr), and the connected ones by handle.
+        self._peripherals = {}
+        self._links = {}
+
+        # Counters for load testing.
+        self.stats = {
+            "writes": 0,
+            "reads": 0,
+            "notifies": 0,
+            "indicates": 0,
+            "notify_full": 0,
+            "advertise": 0,
+            "l2cap_sdus": 0,
+            "scan_reports": 0,
+            "gattc_writes": 0,
+            "gattc_notifies": 0,
+            "gattc_discoveries": 0,
+        }
+        self._l2cap_listen = None
+
+    # --- bluetooth.BLE API ---
+
+    def active(self, state=None):
+        if state is not None:
+            self._active = bool(state)
+            if not self._active:
+                self._connections.clear()
+                for peripheral in self._links.values():
+                    peripheral._disconnected()
+                self._links.clear()
+                self.adv_interval_us = None
+                self._l2cap_listen = None
+                self._stop_scan(False)
+        return self._active
+
+    def irq(self, handler):
+        self._irq = handler
+
+    def config(self, *args, **kwargs):
+        if args:
+            if args[0] == "mac":
+                return (0, self._mac)
+            return self._config[args[0]]
+        for key, value in kwargs.items():
+            if key == "mtu" and not 23 <= value <= self._max_mtu:
+                raise ValueError("invalid MTU")
+            self._config[key] = value
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        self._check_active()
+        if interval_us is None:
+            self.adv_interval_us = None
+            return
+        if adv_data is not None:
+            if len(adv_data) > _ADV_PAYLOAD_MAX_LEN:
+                raise OSError(errno.EINVAL)
+            self.adv_data = bytes(adv_data)
+        if resp_data is not None:
+            if len(resp_data) > _ADV_PAYLOAD_MAX_LEN:
+                raise OSError(errno.EINVAL)
+            self.resp_data = bytes(resp_data)
+        self.adv_interval_us = interval_us
+        self.connectable = connectable
+        self.stats["advertise"] += 1
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        self._check_active()
+        if duration_ms is None:
+            asyncio.get_event_loop().call_soon(self._stop_scan)
+            return
+        self._stop_scan(False)
+        self.scanning = True
+        self.scan_active = active
+        self._scan_generation += 1
+        loop = asyncio.get_event_loop()
+        for peripheral in self._peripherals.values():
+            # Advertisers aren't synchronised, so each is first heard at a random time.
+            delay = peripheral.rng.uniform(0, peripheral.adv_interval_ms / 1000)
+            loop.call_later(delay, self._advertise, peripheral, self._scan_generation)
+        if duration_ms:
+            self._scan_timer = asyncio.get_event_loop().call_later(
+                duration_ms / 1000, self._stop_scan
+            )
+
+    def gap_connect(
+        self,
+        addr_type,
+        addr,
+        scan_duration_ms=2000,
+        min_conn_interval_us=None,
+        max_conn_interval_us=None,
+    ):
+        self._check_active()
+        peripheral = self._peripherals.get((addr_type, bytes(addr)))
+        if peripheral is None or peripheral.conn_handle is not None:
+            # Nothing answers, so the firmware's connect times out.
+            return
+        # The connection uses the longest interval the firmware allows, if it
+        # asked for one, and is made at the peripheral's next advertisement.
+        interval_ms = None
+        if max_conn_interval_us or min_conn_interval_us:
+            interval_ms = (max_conn_interval_us or min_conn_interval_us) / 1000
+        delay = peripheral.rng.uniform(0, peripheral.adv_interval_ms / 1000)
+        asyncio.get_event_loop().call_later(delay, self._link_up, peripheral, interval_ms)
+
+    def gap_disconnect(self, conn_handle):
+        if conn_handle in self._links:
+            self._link_down(conn_handle)
+            return True
+        if conn_handle not in self._connections:
+            return False
+        self._disconnect(conn_handle)
+        return True
+
+    def gatts_register_services(self, services_definition):
+        self._check_active()
+        self._attributes.clear()
+        self._next_handle = 1
+        result = []
+        for _service_uuid, characteristics in services_definition:
+            # Service declaration.
+            self._next_handle += 1
+            handles = []
+            for characteristic in characteristics:
+                uuid, flags = characteristic[0], characteristic[1]
+                # Characteristic declaration, then value.
+                self._next_handle += 1
+                handles.append(self._add_attribute(uuid, flags))
+                if flags & (_FLAG_NOTIFY | _FLAG_INDICATE):
+                    # CCCD.
+                    self._next_handle += 1
+                if len(characteristic) > 2:
+                    for dsc_uuid, dsc_flags in characteristic[2]:
+                        handles.append(self._add_attribute(dsc_uuid, dsc_flags))
+            result.append(tuple(handles))
+        return tuple(result)
+
+    def gatts_read(self, value_handle):
+        attr = self._attr(value_handle)
+        value = attr.value
+        if attr.append:
+            attr.value = b""
+        return value
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        attr = self._attr(value_handle)
+        attr.value = bytes(data)
+        if send_update:
+            for conn in list(self._connections.values()):
+                if value_handle in conn.subscriptions:
+                    if attr.flags & _FLAG_NOTIFY:
+                        self.gatts_notify(conn.conn_handle, value_handle)
+                    elif attr.flags & _FLAG_INDICATE:
+                        self.gatts_indicate(conn.conn_handle, value_handle)
+
+    def gatts_set_buffer(self, value_handle, length, append=False):
+        attr = self._attr(value_handle)
+        attr.max_len = length
+        attr.append = append
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        conn = self._conn(conn_handle)
+        if self._tx_slots is not None:
+            if conn.tx_pending >= self._tx_slots:
+                self.stats["notify_full"] += 1
+                raise OSError(errno.ENOMEM)
+            conn.tx_pending += 1
+            asyncio.get_event_loop().call_soon(self._release_tx, conn)
+        payload = self._attr(value_handle).value if data is None else bytes(data)
+        self.stats["notifies"] += 1
+        self._deliver(conn, value_handle, payload[: conn.mtu - 3])
+
+    def gatts_indicate(self, conn_handle, value_handle, data=None):
+        conn = self._conn(conn_handle)
+        payload = self._attr(value_handle).value if data is None else bytes(data)
+        self.stats["indicates"] += 1
+        self._deliver(conn, value_handle, payload[: conn.mtu - 3])
+        # The confirmation arrives in a later connection event.
+        asyncio.get_event_loop().call_soon(
+            self._fire, _IRQ_GATTS_INDICATE_DONE, (conn_handle, value_handle, 0)
+        )
+
+    def gattc_exchange_mtu(self, conn_handle):
+        if conn_handle in self._links:
+            peripheral = self._links[conn_handle]
+            mtu = min(peripheral.mtu, self._config["mtu"])
+            self._link_request(peripheral, self._fire, _IRQ_MTU_EXCHANGED, (conn_handle, mtu))
+            return
+        conn = self._conn(conn_handle)
+        asyncio.get_event_loop().call_soon(self._exchange_mtu, conn, self._config["mtu"])
+
+    def gattc_discover_services(self, conn_handle, uuid=None):
+        peripheral = self._link(conn_handle)
+        self.stats["gattc_discoveries"] += 1
+        self._link_request(peripheral, self._discover_services, peripheral, uuid)
+
+    def gattc_discover_characteristics(self, conn_handle, start_handle, end_handle, uuid=None):
+        peripheral = self._link(conn_handle)
+        self.stats["gattc_discoveries"] += 1
+        self._link_request(
+            peripheral, self._discover_characteristics, peripheral, start_handle, end_handle, uuid
+        )
+
+    def gattc_discover_descriptors(self, conn_handle, start_handle, end_handle):
+        peripheral = self._link(conn_handle)
+        self.stats["gattc_discoveries"] += 1
+        self._link_request(
+            peripheral, self._discover_descriptors, peripheral, start_handle, end_handle
+        )
+
+    def gattc_read(self, conn_handle, value_handle):
+        peripheral = self._link(conn_handle)
+        self._link_request(peripheral, self._read_remote, peripheral, value_handle)
+
+    def gattc_write(self, conn_handle, value_handle, data, mode=0):
+        peripheral = self._link(conn_handle)
+        self.stats["gattc_writes"] += 1
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        # The write reaches the peripheral at the next connection event, and the
+        # write response comes back at the one after.
+        loop.call_at(
+            peripheral.event_after(now),
+            self._write_remote,
+            peripheral,
+            conn_handle,
+            value_handle,
+            bytes(data),
+        )
+        if mode:
+            loop.call_at(
+                peripheral.event_after(now, 2),
+                self._write_done,
+                peripheral,
+                conn_handle,
+                value_handle,
+            )
+
+    def l2cap_listen(self, psm, mtu):
+        self._check_active()
+        self._l2cap_listen = (psm, mtu)
+
+    def l2cap_recvinto(self, conn_handle, cid, buf):
+        conn = self._l2cap_conn(conn_handle, cid)
+        if buf is None:
+            return len(conn.l2cap_rx)
+        n = min(len(buf), len(conn.l2cap_rx))
+        buf[:n] = conn.l2cap_rx[:n]
+        del conn.l2cap_rx[:n]
+        return n
+
+    def l2cap_send(self, conn_handle, cid, buf):
+        conn = self._l2cap_conn(conn_handle, cid)
+        if len(buf) > conn.l2cap[3]:
+            raise OSError(errno.EINVAL)
+        conn.l2cap_tx += buf
+        self.stats["l2cap_sdus"] += 1
+        return True
+
+    def l2cap_disconnect(self, conn_handle, cid):
+        conn = self._l2cap_conn(conn_handle, cid)
+        psm = conn.l2cap[1]
+        conn.l2cap = None
+        asyncio.get_event_loop().call_soon(
+            self._fire, _IRQ_L2CAP_DISCONNECT, (conn_handle, cid, psm, 0)
+        )
+
+    # --- Nearby advertisers ---
+
+    def advertiser_report(self, addr, adv_data, adv_type=0, rssi=-60, addr_type=0):
+        """
+        Deliver an advertising report to the firmware, if it is scanning.
+
+        Like the controller, the address and payload are passed as memoryviews
+        that are only valid during the IRQ.
+
+        Args:
+            addr (bytes): The 6-byte address of the advertiser.
+            adv_data (bytes): The advertising or scan response payload.
+            adv_type (int): 0 (ADV_IND) to 4 (SCAN_RSP).
+            rssi (int): The signal strength.
+            addr_type (int): 0 for public, 1 for random addresses.
+
+        Returns:
+            bool: False if the firmware isn't scanning (or a scan response
+                was reported to a passive scan).
+        """
+        if not self.scanning or (adv_type == 4 and not self.scan_active):
+            return False
+        self.stats["scan_reports"] += 1
+        self._fire(
+            _IRQ_SCAN_RESULT,
+            (addr_type, memoryview(bytes(addr)), adv_type, rssi, memoryview(bytes(adv_data))),
+        )
+        return True
+
+    def add_peripheral(self, peripheral):
+        """
+        Add a remote peripheral the firmware can scan for and connect to.
+
+        Args:
+            peripheral (SimPeripheral): The peripheral. It advertises whenever the
+                firmware scans and it isn't connected. A peripheral with the same
+                address is replaced (e.g. to play a firmware update).
+        """
+        self._peripherals[(peripheral.addr_type, peripheral.addr)] = peripheral
+        if self.scanning:
+            asyncio.get_event_loop().call_soon(
+                self._advertise, peripheral, self._scan_generation
+            )
+
+    def remove_peripheral(self, peripheral):
+        """
+        Remove a remote peripheral, disconnecting it first if it is connected.
+        """
+        peripheral.disconnect()
+        if self._peripherals.get((peripheral.addr_type, peripheral.addr)) is peripheral:
+            del self._peripherals[(peripheral.addr_type, peripheral.addr)]
+
+    # --- Central (phone) side ---
+
+    def central_connect(self, addr=b"\xaa\xbb\xcc\xdd\xee\x01", addr_type=0, mtu=_DEFAULT_MTU):
+        """
+        Connect a simulated central to the advertising peripheral.
+
+        Args:
+            addr (bytes): The 6-byte address of the central.
+            addr_type (int): 0 for public, 1 for random.
+            mtu (int): The largest MTU the central accepts in an exchange.
+
+        Returns:
+            int: The connection handle.
+        """
+        self._check_active()
+        if self.adv_interval_us is None or not self.connectable:
+            raise OSError(errno.ENOTCONN)
+        # Connecting stops advertising, as it does on the controller.
+        self.adv_interval_us = None
+        conn_handle = self._next_conn_handle
+        self._next_conn_handle += 1
+        self._connections[conn_handle] = _Connection(conn_handle, addr_type, bytes(addr), mtu)
+        self._fire(_IRQ_CENTRAL_CONNECT, (conn_handle, addr_type, bytes(addr)))
+        return conn_handle
+
+    def central_disconnect(self, conn_handle):
+        self._disconnect(conn_handle)
+
+    def central_exchange_mtu(self, conn_handle, mtu):
+        self._exchange_mtu(self._conn(conn_handle), mtu)
+
+    def central_subscribe(self, conn_handle, value_handle, on_notify=None):
+        conn = self._conn(conn_handle)
+        conn.subscriptions.add(value_handle)
+        if on_notify:
+            conn.on_notify = on_notify
+
+    def central_write(self, conn_handle, value_handle, data):
+        """
+        Write from the central, as an ATT write request or command.
+
+        Raises:
+            ValueError: If data does not fit in a single ATT PDU.
+        """
+        conn = self._conn(conn_handle)
+        if len(data) > conn.mtu - 3:
+            raise ValueError("write exceeds ATT_MTU - 3")
+        attr = self._attr(value_handle)
+        if attr.append:
+            attr.value = (attr.value + bytes(data))[: attr.max_len]
+        else:
+            attr.value = bytes(data[: attr.max_len])
+        self.stats["writes"] += 1
+        self._fire(_IRQ_GATTS_WRITE, (conn_handle, value_handle))
+
+    def central_read(self, conn_handle, value_handle):
+        self._conn(conn_handle)
+        self.stats["reads"] += 1
+        if self._fire(_IRQ_GATTS_READ_REQUEST, (conn_handle, value_handle)):
+            raise OSError(errno.EACCES)
+        return self._attr(value_handle).value
+
+    def central_l2cap_connect(self, conn_handle, psm, mtu=_DEFAULT_MTU):
+        """
+        Open an L2CAP channel to the peripheral, which must be listening on psm.
+
+        Returns:
+            int: The channel id.
+        """
+        conn = self._conn(conn_handle)
+        if self._l2cap_listen is None or self._l2cap_listen[0] != psm:
+            raise OSError(errno.ECONNREFUSED)
+        our_mtu = self._l2cap_listen[1]
+        conn.l2cap = (0x40, psm, our_mtu, mtu)
+        conn.l2cap_rx = bytearray()
+        conn.l2cap_tx = bytearray()
+        self._fire(_IRQ_L2CAP_CONNECT, (conn_handle, 0x40, psm, our_mtu, mtu))
+        return 0x40
+
+    def central_l2cap_send(self, conn_handle, data):
+        """
+        Send SDUs of at most the peripheral's MTU from the central.
+        """
+        conn = self._conn(conn_handle)
+        cid, _, our_mtu, _ = conn.l2cap
+        for i in range(0, len(data), our_mtu):
+            conn.l2cap_rx += data[i : i + our_mtu]
+            self._fire(_IRQ_L2CAP_RECV, (conn_handle, cid))
+
+    def central_l2cap_recv(self, conn_handle):
+        """
+        Take the data the peripheral has sent to the central so far.
+        """
+        conn = self._conn(conn_handle)
+        data = bytes(conn.l2cap_tx)
+        conn.l2cap_tx = bytearray()
+        return data
+
+    def central_l2cap_disconnect(self, conn_handle):
+        conn = self._conn(conn_handle)
+        cid, psm, _, _ = conn.l2cap
+        conn.l2cap = None
+        self._fire(_IRQ_L2CAP_DISCONNECT, (conn_handle, cid, psm, 0))
+
+    def handle(self, uuid):
+        """
+        Find the value handle of the first attribute with this UUID.
+        """
+        for value_handle, attr in self._attributes.items():
+            if attr.uuid == uuid:
+                return value_handle
+        raise KeyError(uuid)
+
+    # --- Internals ---
+
+    def _check_active(self):
+        if not self._active:
+            raise OSError(errno.EPERM)
+
+    def _add_attribute(self, uuid, flags):
+        value_handle = self._next_handle
+        self._next_handle += 1
+        self._attributes[value_handle] = _Attribute(uuid, flags)
+        return value_handle
+
+    def _attr(self, value_handle):
+        if value_handle not in self._attributes:
+            raise OSError(errno.EINVAL)
+        return self._attributes[value_handle]
+
+    def _conn(self, conn_handle):
+        if conn_handle not in self._connections:
+            raise OSError(errno.ENOTCONN)
+        return self._connections[conn_handle]
+
+    def _l2cap_conn(self, conn_handle, cid):
+        conn = self._conn(conn_handle)
+        if conn.l2cap is None or conn.l2cap[0] != cid:
+            raise OSError(errno.ENOTCONN)
+        return conn
+
+    def _fire(self, event, data):
+        if self._irq:
+            return self._irq(event, data)
+
+    def _deliver(self, conn, value_handle, payload):
+        if conn.on_notify:
+            conn.on_notify(value_handle, payload)
+        else:
+            conn.received.append((value_handle, payload))
+
+    def _stop_scan(self, notify=True):
+        if self._scan_timer:
+            self._scan_timer.cancel()
+            self._scan_timer = None
+        if self.scanning:
+            self.scanning = False
+            if notify:
+                self._fire(_IRQ_SCAN_DONE, None)
+
+    def _advertise(self, peripheral, generation):
+        if generation != self._scan_generation or peripheral.conn_handle is not None:
+            return
+        if self._peripherals.get((peripheral.addr_type, peripheral.addr)) is not peripheral:
+            # Removed or replaced.
+            return
+        if not self.advertiser_report(
+            peripheral.addr, peripheral.adv_data, 0, -60, peripheral.addr_type
+        ):
+            return
+        if self.scan_active and peripheral.resp_data is not None:
+            self.advertiser_report(
+                peripheral.addr, peripheral.resp_data, 4, -60, peripheral.addr_type
+            )
+        asyncio.get_event_loop().call_later(
+            peripheral.adv_interval_ms / 1000, self._advertise, peripheral, generation
+        )
+
+    def _link(self, conn_handle):
+        if conn_handle not in self._links:
+            raise OSError(errno.ENOTCONN)
+        return self._links[conn_handle]
+
+    def _link_up(self, peripheral, interval_ms=None):
+        if not self._active or peripheral.conn_handle is not None:
+            return
+        if interval_ms:
+            peripheral.interval_ms = interval_ms
+        conn_handle = self._next_conn_handle
+        self._next_conn_handle += 1
+        self._links[conn_handle] = peripheral
+        peripheral._connected(self, conn_handle, asyncio.get_event_loop().time())
+        self._fire(_IRQ_PERIPHERAL_CONNECT, (conn_handle, peripheral.addr_type, peripheral.addr))
+
+    def _link_down(self, conn_handle, reason=_REASON_TIMEOUT):
+        peripheral = self._links.pop(conn_handle, None)
+        if peripheral:
+            peripheral._disconnected()
+            self._fire(
+                _IRQ_PERIPHERAL_DISCONNECT, (conn_handle, peripheral.addr_type, peripheral.addr)
+            )
+
+    def _link_request(self, peripheral, callback, *args):
+        # A request goes out at the next connection event and is answered in the
+        # following one, unless the link went down in between.
+        conn_handle = peripheral.conn_handle
+        loop = asyncio.get_event_loop()
+
+        def respond():
+            if self._links.get(conn_handle) is peripheral:
+                callback(*args)
+
+        loop.call_at(peripheral.event_after(loop.time(), 2), respond)
+
+    def _link_notify(self, peripheral, value_handle, data):
+        conn_handle = peripheral.conn_handle
+        loop = asyncio.get_event_loop()
+
+        def deliver():
+            if self._links.get(conn_handle) is peripheral:
+                self.stats["gattc_notifies"] += 1
+                self._fire(_IRQ_GATTC_NOTIFY, (conn_handle, value_handle, memoryview(data)))
+
+        loop.call_at(peripheral.event_after(loop.time()), deliver)
+
+    def _discover_services(self, peripheral, uuid):
+        conn_handle = peripheral.conn_handle
+        for service_uuid, start, end in peripheral.services:
+            if uuid is None or service_uuid == uuid:
+                self._fire(_IRQ_GATTC_SERVICE_RESULT, (conn_handle, start, end, service_uuid))
+        self._fire(_IRQ_GATTC_SERVICE_DONE, (conn_handle, 0))
+
+    def _discover_characteristics(self, peripheral, start_handle, end_handle, uuid):
+        conn_handle = peripheral.conn_handle
+        for _, end, value_handle, properties, char_uuid in peripheral.characteristics:
+            if start_handle <= value_handle <= end_handle and uuid in (None, char_uuid):
+                self._fire(
+                    _IRQ_GATTC_CHARACTERISTIC_RESULT,
+                    (conn_handle, end, value_handle, properties, char_uuid),
+                )
+        self._fire(_IRQ_GATTC_CHARACTERISTIC_DONE, (conn_handle, 0))
+
+    def _discover_descriptors(self, peripheral, start_handle, end_handle):
+        conn_handle = peripheral.conn_handle
+        for dsc_handle, uuid in peripheral._descriptors(start_handle, end_handle):
+            self._fire(_IRQ_GATTC_DESCRIPTOR_RESULT, (conn_handle, dsc_handle, uuid))
+        self._fire(_IRQ_GATTC_DESCRIPTOR_DONE, (conn_handle, 0))
+
+    def _read_remote(self, peripheral, value_handle):
+        conn_handle = peripheral.conn_handle
+        value = peripheral._read(value_handle)
+        if value is None:
+            status = _ATT_ERROR_INVALID_HANDLE
+            self._fire(_IRQ_GATTC_READ_DONE, (conn_handle, value_handle, status))
+            return
+        self._fire(_IRQ_GATTC_READ_RESULT, (conn_handle, value_handle, memoryview(value)))
+        self._fire(_IRQ_GATTC_READ_DONE, (conn_handle, value_handle, 0))
+
+    def _write_remote(self, peripheral, conn_handle, value_handle, data):
+        if self._links.get(conn_handle) is peripheral:
+            peripheral._write(value_handle, data)
+
+    def _write_done(self, peripheral, conn_handle, value_handle):
+        if self._links.get(conn_handle) is peripheral:
+            status = 0 if peripheral._writable(value_handle) else _ATT_ERROR_INVALID_HANDLE
+            self._fire(_IRQ_GATTC_WRITE_DONE, (conn_handle, value_handle, status))
+
+    def _release_tx(self, conn):
+        conn.tx_pending -= 1
+
+    def _exchange_mtu(self, conn, mtu):
+        if conn.conn_handle not in self._connections:
+            return
+        conn.mtu = min(mtu, conn.peer_mtu, self._config["mtu"])
+        self._fire(_IRQ_MTU_EXCHANGED, (conn.conn_handle, conn.mtu))
+
+    def _disconnect(self, conn_handle):
+        conn = self._connections.pop(conn_handle, None)
+        if conn:
+            self._fire(_IRQ_CENTRAL_DISCONNECT, (conn_handle, conn.addr_type, conn.addr))
@@ -0,0 +1,109 @@
+"""
+Timing accuracy benchmark for the waveform engine on the host.
+
+Plays a short program on the host PWM/Timer stand-ins and compares every on/off edge
+recorded by the PWM with the time the schedule says it should happen, first with an
+idle event loop and then while the RUN service load test streams commands.
+
+Usage (from the MicroPython directory):
+    python -m sim.waveform_bench [--cycles N] [--commands N]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+
+import sim
+
+_PROGRAM = {
+    "frequency": 1000,
+    "pulseWidth": 300,
+    "onTime": 0.2,
+    "offTime": 0.3,
+}
+
+
+def edge_errors(events, start_ns, on_ticks, off_ticks, total_ticks, tick_ms):
+    """
+    Get the lateness in microseconds of each recorded edge after the start of a program.
+    """
+    boundaries = []
+    t = 0
+    on = True
+    while True:
+        t += on_ticks if on else off_ticks
+        on = not on
+        if t >= total_ticks:
+            break
+        boundaries.append(t)
+    boundaries.append(total_ticks)
+
+    errors = []
+    for (timestamp, _), ticks in zip(events, boundaries):
+        expected = start_ns + ticks * tick_ms * 1_000_000
+        errors.append((timestamp - expected) / 1000)
+    return errors
+
+
+async def play(cycles, load_commands):
+    from waveform import WaveformEngine, TICK_MS
+    from sim.loadtest import run as loadtest
+
+    program = dict(_PROGRAM, duration=cycles * 0.5 / 60)
+    engine = WaveformEngine(25, timer_id=1)
+    engine.load(program)
+    # Only the host PWM records its duty changes.
+    pwm = engine._pwm
+
+    load = None
+    if load_commands:
+        load = asyncio.create_task(loadtest(load_commands, 23, 1, False))
+        await asyncio.sleep(0.05)
+
+    engine.start()
+    start_ns, _ = pwm.events[-1]
+    first = len(pwm.events)
+    while engine.running:
+        await asyncio.sleep(0.01)
+    if load:
+        await load
+
+    on_ticks = round(program["onTime"] * 10)
+    off_ticks = round(program["offTime"] * 10)
+    total_ticks = round(program["duration"] * 600)
+    return edge_errors(pwm.events[first:], start_ns, on_ticks, off_ticks, total_ticks, TICK_MS)
+
+
+def report(label, errors):
+    errors = sorted(abs(e) for e in errors)
+    if not errors:
+        print("{}: no edges recorded".format(label))
+        return
+    p50 = errors[len(errors) // 2]
+    p99 = errors[int(len(errors) * 0.99)]
+    print(
+        "{}: {} edges, |error| us p50 {:.0f}  p99 {:.0f}  max {:.0f}".format(
+            label, len(errors), p50, p99, errors[-1]
+        )
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=6, help="on/off cycles to play")
+    parser.add_argument("--commands", type=int, default=5000, help="commands sent under load")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sim.install()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        idle = asyncio.run(play(args.cycles, 0))
+        loaded = asyncio.run(play(args.cycles, args.commands))
+    report("idle", idle)
+    report("under command load", loaded)
+
+
+if __name__ == "__main__":
+    main()
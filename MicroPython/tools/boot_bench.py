@@ -0,0 +1,132 @@
+"""
+Compare the import cost of the firmware as source and as compiled .mpy.
+
+Runs on the host with the unix MicroPython port: builds the firmware with tools/build.py
+(for the host architecture, so @micropython.native code runs), then, for each firmware
+module and for the whole boot (aioble then ble_services), imports it in a fresh
+micropython process with tools/import_profile.py and reports the median time, retained
+heap and peak heap of several runs, from source and from .mpy. The radio is simulated, so
+the times are only comparable between runs on the same host, but the heap figures are
+close to the board's.
+
+Usage (from the MicroPython directory):
+    python tools/boot_bench.py [--micropython PATH] [--mpy-cross PATH] [--runs N]
+                               [--heapsize SIZE] [MODULE ...]
+
+The micropython binary and mpy-cross must be the same version as the firmware (v1.24).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import build  # noqa: E402
+
+# import_profile.py's default modules, i.e. what main.py imports before advertising.
+BOOT = "boot"
+
+_HOST_ARCH = "x64"
+
+
+def firmware_modules(root=build.ROOT):
+    """
+    List the firmware's importable modules.
+
+    Args:
+        root (str): The MicroPython directory.
+
+    Returns:
+        list: Dotted module names, sorted, without the entry point.
+    """
+    modules = []
+    for path in build.firmware_sources(root):
+        if path == "main.py":
+            continue
+        name = path[:-3].replace("/", ".")
+        if name.endswith(".__init__"):
+            name = name[: -len(".__init__")]
+        modules.append(name)
+    return modules
+
+
+def _run(micropython, heapsize, path, modules):
+    env = dict(os.environ)
+    env["MICROPYPATH"] = path
+    command = [micropython, "-X", "heapsize=" + heapsize]
+    command += [os.path.join(build.ROOT, "tools", "import_profile.py"), "--json", "--peak"]
+    result = subprocess.run(
+        command + modules, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])["modules"]
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(micropython, heapsize, path, module, runs):
+    """
+    Import a module in fresh micropython processes and take the median of each figure.
+
+    Args:
+        micropython (str): The micropython binary.
+        heapsize (str): The heap size to give it, e.g. "4M".
+        path (str): MICROPYPATH, from which the module is imported.
+        module (str): The module, or BOOT for aioble then ble_services.
+        runs (int): The number of runs.
+
+    Returns:
+        tuple: (microseconds, retained heap bytes, peak heap bytes).
+    """
+    samples = []
+    for _ in range(runs):
+        results = _run(micropython, heapsize, path, [] if module == BOOT else [module])
+        samples.append(
+            (
+                sum(r["us"] for r in results),
+                sum(r["heap"] for r in results),
+                max(r["peak"] for r in results),
+            )
+        )
+    return tuple(_median(s[i] for s in samples) for i in range(3))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--micropython", default="micropython", help="unix port binary")
+    parser.add_argument("--mpy-cross", help="path to the mpy-cross binary")
+    parser.add_argument("--runs", type=int, default=5, help="runs per module and variant")
+    parser.add_argument("--heapsize", default="4M", help="micropython heap size")
+    parser.add_argument("--out", default=os.path.join(build.ROOT, "build", "bench"))
+    parser.add_argument("modules", nargs="*", help="modules to measure (default: all)")
+    args = parser.parse_args(argv)
+
+    build.build(args.out, args.mpy_cross, _HOST_ARCH)
+    # sim is not part of the build, so the source directory stays on the path after the
+    # compiled one, which shadows it for every firmware module.
+    variants = (
+        ("source", build.ROOT),
+        ("mpy", os.path.join(args.out, "fs") + os.pathsep + build.ROOT),
+    )
+    modules = args.modules or firmware_modules() + [BOOT]
+
+    header = "{:<28}" + " {:>9} {:>9} {:>9}" * len(variants)
+    columns = []
+    for name, _ in variants:
+        columns += [name + " ms", "heap", "peak"]
+    print(header.format("module", *columns))
+    for module in modules:
+        row = []
+        for _, path in variants:
+            elapsed, used, peak = measure(args.micropython, args.heapsize, path, module, args.runs)
+            row += ["{:.2f}".format(elapsed / 1000), used, peak]
+        print(header.format(module, *row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
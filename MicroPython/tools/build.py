@@ -0,0 +1,162 @@
+"""
+Cross-compile the firmware to MicroPython bytecode.
+
+The board otherwise compiles every module from source at each boot (and after every soft
+reset), which costs both time and heap. This writes, under the output directory:
+
+    fs/           the files to copy to the board's filesystem: every module as .mpy, and a
+                  one-line main.py that imports the compiled entry point (app.mpy)
+    manifest.py   a freeze manifest listing the same modules, to build them into the
+                  firmware image instead (see below)
+
+The output only depends on the sources and the mpy-cross version: files are compiled in
+sorted order with their path relative to this directory as the source name, so two
+checkouts of the same commit produce byte-identical .mpy files.
+
+Usage (from the MicroPython directory):
+    python tools/build.py [--mpy-cross PATH] [--arch ARCH] [--out DIR]
+
+mpy-cross must match the firmware's MicroPython version (v1.24, `pip install
+mpy-cross==1.24.0.post2`). To deploy, remove the old .py files from the board first, since
+MicroPython prefers a .py over a .mpy of the same name:
+    mpremote fs rm -r :aioble + ... (or erase the filesystem), then
+    mpremote fs cp -r build/fs/. :
+The board's own files (e.g. ble_secrets.json) are not part of the build.
+
+To freeze the modules into the firmware, build MicroPython's esp32 port with
+    make BOARD=ESP32_GENERIC FROZEN_MANIFEST=<this directory>/build/manifest.py
+and copy only build/fs/main.py and build/fs/app.mpy to the board.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Host-only directories, never copied to the board.
+_EXCLUDED_DIRS = ("sim", "tools", "build", "__pycache__")
+
+# The entry point is compiled under this name and imported by the generated main.py.
+ENTRY_MODULE = "app"
+
+_MAIN_STUB = "import {}\n".format(ENTRY_MODULE)
+
+
+def firmware_sources(root=ROOT):
+    """
+    List the firmware's Python files.
+
+    Args:
+        root (str): The MicroPython directory.
+
+    Returns:
+        list: Paths relative to root, with "/" separators, sorted.
+    """
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in _EXCLUDED_DIRS)
+        for filename in filenames:
+            if filename.endswith(".py"):
+                path = os.path.relpath(os.path.join(dirpath, filename), root)
+                sources.append(path.replace(os.sep, "/"))
+    return sorted(sources)
+
+
+def find_mpy_cross(path=None):
+    """
+    Find the mpy-cross command.
+
+    Args:
+        path (str): An explicit path to the mpy-cross binary.
+
+    Returns:
+        list: The command to run.
+
+    Raises:
+        FileNotFoundError: If mpy-cross is neither on PATH nor installed as a package.
+    """
+    if path:
+        return [path]
+    if shutil.which("mpy-cross"):
+        return ["mpy-cross"]
+    try:
+        import mpy_cross  # noqa: F401
+    except ImportError:
+        raise FileNotFoundError("mpy-cross not found; pip install mpy-cross==1.24.0.post2")
+    return [sys.executable, "-m", "mpy_cross"]
+
+
+def _compile(mpy_cross, arch, source, source_name, output):
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    subprocess.run(
+        mpy_cross + ["-march=" + arch, "-s", source_name, "-o", output, source],
+        check=True,
+    )
+
+
+def build(out, mpy_cross=None, arch="xtensawin", root=ROOT):
+    """
+    Compile the firmware and write the freeze manifest.
+
+    Args:
+        out (str): The output directory. Its fs/ subdirectory is replaced.
+        mpy_cross (str): An explicit path to the mpy-cross binary.
+        arch (str): The native architecture of the board (xtensawin for the ESP32).
+        root (str): The MicroPython directory.
+
+    Returns:
+        list: (relative path, source bytes, compiled bytes) for every compiled file.
+    """
+    command = find_mpy_cross(mpy_cross)
+    fs = os.path.join(out, "fs")
+    shutil.rmtree(fs, ignore_errors=True)
+    os.makedirs(fs)
+
+    results = []
+    modules = []
+    for path in firmware_sources(root):
+        source = os.path.join(root, path)
+        if path == "main.py":
+            target = ENTRY_MODULE + ".mpy"
+        else:
+            target = path[:-3] + ".mpy"
+            modules.append(path)
+        output = os.path.join(fs, target)
+        _compile(command, arch, source, path, output)
+        results.append((target, os.path.getsize(source), os.path.getsize(output)))
+
+    with open(os.path.join(fs, "main.py"), "w") as f:
+        f.write(_MAIN_STUB)
+
+    with open(os.path.join(out, "manifest.py"), "w") as f:
+        f.write("# Generated by tools/build.py.\n")
+        f.write('include("$(PORT_DIR)/boards/manifest.py")\n')
+        # The entry point stays on the filesystem (fs/main.py and fs/app.mpy), so it can
+        # be replaced without rebuilding the firmware.
+        for path in modules:
+            f.write('module("{}", base_path="{}")\n'.format(path, root.replace(os.sep, "/")))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mpy-cross", help="path to the mpy-cross binary")
+    parser.add_argument("--arch", default="xtensawin", help="native architecture of the board")
+    parser.add_argument("--out", default=os.path.join(ROOT, "build"), help="output directory")
+    args = parser.parse_args(argv)
+
+    results = build(args.out, args.mpy_cross, args.arch)
+    source_total = sum(r[1] for r in results)
+    compiled_total = sum(r[2] for r in results)
+    for path, source_size, compiled_size in results:
+        print("{:<32} {:>8} {:>8}".format(path, source_size, compiled_size))
+    print("{:<32} {:>8} {:>8}".format("total", source_total, compiled_total))
+    print("Wrote", os.path.join(args.out, "fs"), "and", os.path.join(args.out, "manifest.py"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Measure what importing the firmware's modules costs.
+
+For each module, in order, reports the time its import took, the heap it left allocated
+and the modules it pulled in, then the aioble IRQ handlers registered and the heap still
+free. Modules imported by an earlier one are counted there.
+
+On the board (after copying the firmware), from the MicroPython directory:
+    mpremote run tools/import_profile.py
+
+On the host, with the simulated radio:
+    python -m tools.import_profile [--peak] [--json] [MODULE ...]
+
+On the unix MicroPython port, also with the simulated radio (see tools/boot_bench.py):
+    MICROPYPATH=. micropython tools/import_profile.py [--peak] [--json] [MODULE ...]
+
+The default modules are aioble then ble_services, i.e. everything main.py imports before
+it starts advertising. Host figures come from tracemalloc and are only comparable with
+other host runs.
+
+--peak also reports the most heap each import had allocated at once. On MicroPython this
+runs the import with the garbage collector disabled, so it counts everything allocated
+during the import and needs a heap large enough to hold it (not for the board). --json
+prints the results as a single JSON object instead of a table.
+"""
+
+import gc
+import json
+import sys
+import time
+
+_MICROPYTHON = sys.implementation.name == "micropython"
+
+DEFAULT_MODULES = ("aioble", "ble_services")
+
+
+if _MICROPYTHON:
+
+    def _ticks_us():
+        return time.ticks_us()
+
+    def _heap_used():
+        gc.collect()
+        return gc.mem_alloc()
+
+    def _heap_free():
+        gc.collect()
+        return gc.mem_free()
+
+    def _peak_start():
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+
+    def _peak_end(start):
+        peak = gc.mem_alloc() - start
+        gc.enable()
+        return peak
+
+else:
+    import tracemalloc
+
+    def _ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def _heap_used():
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _heap_free():
+        return None
+
+    def _peak_start():
+        gc.collect()
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _peak_end(start):
+        return tracemalloc.get_traced_memory()[1] - start
+
+
+def profile(modules, peak=False):
+    """
+    Import modules one after the other and measure each import.
+
+    Args:
+        modules (list): Module names, imported in order.
+        peak (bool): Also measure the peak heap of each import (see the module docstring).
+
+    Returns:
+        list: A (name, microseconds, heap bytes, peak heap bytes, new module names) tuple
+            per module. The peak is None unless measured.
+    """
+    results = []
+    for name in modules:
+        loaded = set(sys.modules)
+        used = _heap_used()
+        if peak:
+            peak_start = _peak_start()
+        start = _ticks_us()
+        __import__(name)
+        elapsed = _ticks_us() - start
+        peak_used = _peak_end(peak_start) if peak else None
+        used = _heap_used() - used
+        new = sorted(m for m in sys.modules if m not in loaded)
+        results.append((name, elapsed, used, peak_used, new))
+    return results
+
+
+def main(argv=None):
+    if not _MICROPYTHON:
+        import os
+
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import sim
+
+        sim.install()
+        tracemalloc.start()
+    elif sys.platform == "linux":
+        # The unix port has no radio. sim must be on MICROPYPATH.
+        import sim
+
+        sim.install()
+
+    args = list(argv if argv is not None else sys.argv[1:])
+    peak = "--peak" in args
+    as_json = "--json" in args
+    modules = [a for a in args if not a.startswith("--")] or DEFAULT_MODULES
+    results = profile(modules, peak)
+
+    core = sys.modules.get("aioble.core")
+    irq_handlers = len(core._irq_handlers) if core else None
+    free = _heap_free()
+
+    if as_json:
+        print(
+            json.dumps(
+                {
+                    "implementation": sys.implementation.name,
+                    "modules": [
+                        {"name": name, "us": elapsed, "heap": used, "peak": peak_used}
+                        for name, elapsed, used, peak_used, _ in results
+                    ],
+                    "irq_handlers": irq_handlers,
+                    "heap_free": free,
+                }
+            )
+        )
+        return
+
+    print(
+        "{:<16} {:>10} {:>10} {:>10}  {}".format("module", "ms", "heap", "peak", "modules loaded")
+    )
+    for name, elapsed, used, peak_used, new in results:
+        print(
+            "{:<16} {:>10.1f} {:>10} {:>10}  {}".format(
+                name, elapsed / 1000, used, "-" if peak_used is None else peak_used, " ".join(new)
+            )
+        )
+    total_us = sum(r[1] for r in results)
+    total_heap = sum(r[2] for r in results)
+    print("{:<16} {:>10.1f} {:>10}".format("total", total_us / 1000, total_heap))
+
+    if irq_handlers is not None:
+        print("aioble IRQ handlers:", irq_handlers)
+    if free is not None:
+        print("heap free:", free)
+
+
+if __name__ == "__main__":
+    main()
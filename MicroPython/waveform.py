@@ -0,0 +1,177 @@
+from micropython import const
+import machine
+import micropython
+from array import array
+
+# On/off times have a resolution of 0.1 s, so the schedule advances in 100 ms ticks.
+TICK_MS = const(100)
+_TICKS_PER_SECOND = const(10)
+_TICKS_PER_MINUTE = const(600)
+
+_DUTY_MAX = const(65535)
+
+# The longest on or off time (1 hour) and program (24 hours), in ticks. They keep the
+# schedule within the unsigned 32-bit entries of its table and counters.
+MAX_SEGMENT_TICKS = const(36_000)
+MAX_TOTAL_TICKS = const(864_000)
+
+
+class WaveformEngine:
+    """
+    Plays stimulation programs from hardware PWM and a hardware timer.
+
+    A SET command is compiled into a pulse schedule: the PWM frequency, the duty cycle that
+    gives the requested pulse width, and a table of on/off segment lengths in ticks. RUN
+    starts the PWM and a periodic timer whose callback walks that table. The pulses
+    themselves are generated by the PWM peripheral and the on/off edges by the timer
+    interrupt, so their timing does not depend on the asyncio loop handling BLE traffic.
+    The timer callback only updates preallocated integers and arrays, so it never
+    allocates and is safe to run as a hard interrupt.
+    """
+
+    def __init__(self, pin, timer_id=0):
+        """
+        Initialize a WaveformEngine instance with the output held low.
+
+        Args:
+            pin (int): The GPIO driving the stimulation output stage.
+            timer_id (int): The hardware timer used for on/off cycling.
+        """
+        self._pwm = machine.PWM(machine.Pin(pin, machine.Pin.OUT), freq=1000, duty_u16=0)
+        self._timer = machine.Timer(timer_id)
+        # Segment lengths in ticks and their duty cycles: [on, off].
+        self._segment_ticks = array("I", (0, 0))
+        self._segment_duty = array("H", (0, 0))
+        self._frequency = 0
+        self._total_ticks = 0
+        self._loaded = False
+        self._running = False
+        # Playback state, updated from the timer callback.
+        self._segment = 0
+        self._segment_left = 0
+        self._remaining = 0
+        # Bound once, so arming the timer doesn't allocate a bound method.
+        self._tick_cb = self._tick
+        self._begin_cb = self._begin
+
+    @property
+    def running(self):
+        """
+        Check whether a program is playing.
+
+        Returns:
+            bool: True between start() and the end of the program or stop().
+        """
+        return self._running
+
+    @property
+    def loaded(self):
+        """
+        Check whether a program has been loaded with load().
+
+        Returns:
+            bool: True if start() can be called.
+        """
+        return self._loaded
+
+    def load(self, info):
+        """
+        Compile stimulation parameters into the pulse schedule.
+
+        Loading stops any program that is playing.
+
+        Args:
+            info (dict): The parameters of a SET command, with the keys of the app's
+                Electrotherapy model: frequency (Hz), pulseWidth (us), onTime (s),
+                offTime (s) and duration (minutes).
+
+        Raises:
+            ValueError: If a parameter is missing or out of range. The on and off times
+                must not exceed MAX_SEGMENT_TICKS, and the duration MAX_TOTAL_TICKS.
+        """
+        try:
+            frequency = int(info["frequency"])
+            pulse_width = int(info["pulseWidth"])
+            on_ticks = round(info["onTime"] * _TICKS_PER_SECOND)
+            off_ticks = round(info["offTime"] * _TICKS_PER_SECOND)
+            total_ticks = round(info["duration"] * _TICKS_PER_MINUTE)
+        except (KeyError, TypeError):
+            raise ValueError("Missing stimulation parameter")
+        except OverflowError:
+            # An infinite time.
+            raise ValueError("Invalid stimulation parameter")
+        if frequency <= 0 or pulse_width <= 0 or on_ticks <= 0 or off_ticks < 0:
+            raise ValueError("Invalid stimulation parameter")
+        if on_ticks > MAX_SEGMENT_TICKS or off_ticks > MAX_SEGMENT_TICKS:
+            raise ValueError("On or off time too long")
+        if total_ticks <= 0 or total_ticks > MAX_TOTAL_TICKS:
+            raise ValueError("Invalid duration")
+        if pulse_width * frequency >= 1_000_000:
+            raise ValueError("Pulse width longer than period")
+
+        self.stop()
+        self._frequency = frequency
+        self._segment_ticks[0] = on_ticks
+        self._segment_ticks[1] = off_ticks
+        self._segment_duty[0] = pulse_width * frequency * _DUTY_MAX // 1_000_000
+        self._segment_duty[1] = 0
+        self._total_ticks = total_ticks
+        self._loaded = True
+
+    def start(self, delay_ms=0):
+        """
+        Start playing the loaded program from its beginning.
+
+        Args:
+            delay_ms (int): Start this many milliseconds from now instead of at once. The
+                delay is timed by the hardware timer, so modules told to start at the same
+                moment by a hub (see hub.py) do not drift apart with their asyncio loads.
+                The program counts as running, and stop() cancels it, while it waits.
+
+        Raises:
+            ValueError: If no program has been loaded.
+        """
+        if not self._loaded:
+            raise ValueError("No program loaded")
+        self.stop()
+        self._segment = 0
+        self._segment_left = self._segment_ticks[0]
+        self._remaining = self._total_ticks
+        self._running = True
+        if delay_ms > 0:
+            self._timer.init(
+                mode=machine.Timer.ONE_SHOT, period=delay_ms, callback=self._begin_cb
+            )
+        else:
+            self._begin(self._timer)
+
+    def stop(self):
+        """
+        Stop the program and hold the output low. Safe to call at any time.
+        """
+        self._timer.deinit()
+        self._pwm.duty_u16(0)
+        self._running = False
+
+    def _begin(self, timer):
+        self._pwm.freq(self._frequency)
+        self._pwm.duty_u16(self._segment_duty[0])
+        timer.init(mode=machine.Timer.PERIODIC, period=TICK_MS, callback=self._tick_cb)
+
+    @micropython.native
+    def _tick(self, timer):
+        self._remaining -= 1
+        if self._remaining <= 0:
+            self._pwm.duty_u16(0)
+            timer.deinit()
+            self._running = False
+            return
+        self._segment_left -= 1
+        if self._segment_left <= 0:
+            segment = self._segment ^ 1
+            if self._segment_ticks[segment] == 0:
+                # No off time: stay in the on segment.
+                segment = 0
+            self._segment = segment
+            self._segment_left = self._segment_ticks[segment]
+            self._pwm.duty_u16(self._segment_duty[segment])